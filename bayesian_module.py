@@ -19,10 +19,47 @@ CellProfiler's LICENSE document for details.
 
 import numpy as np
 import sklearn.gaussian_process as gp
+from sklearn.ensemble import ExtraTreesRegressor
 from scipy.stats import norm
+from scipy.special import erfcx
 from copy import deepcopy
 from itertools import product
+import collections
+import contextlib
+import ctypes
+import ctypes.util
+import hashlib
+import json
+import multiprocessing
 import os
+import re
+import threading
+import time
+
+try:
+    import joblib
+except ImportError:
+    from sklearn.externals import joblib
+
+#
+# threadpoolctl limits the thread pools of BLAS and OpenMP; without it (e.g. on Python 2.7, which threadpoolctl does not
+# support), the thread pools of OpenBLAS, MKL and OpenMP are limited through their C functions (see
+# find_native_thread_pools)
+#
+try:
+    from threadpoolctl import threadpool_info, threadpool_limits
+except ImportError:
+    threadpool_info = None
+    threadpool_limits = None
+
+#
+# the history is locked against other processes with fcntl.flock, or with msvcrt.locking on Windows
+#
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 #################################
 #
@@ -63,7 +100,8 @@ Requirements
 There must be at least one evaluation module, either **ManualEvaluation** or **AutomatedEvaluation** placed
 before this module in order to have evaluation measurements available.
 Either only one or both evaluation measurements can be chosen to be taken as quality measure for the optimisation 
-procedure.
+procedure. If the **ManualEvaluation** compares outlines (A/B evaluation), choose its *Evaluation_Preference* 
+measurement; the optimisation then learns from the comparisons alone and runs until the max. number of iterations.
 
 
 Technical notes
@@ -73,6 +111,98 @@ The max. number of parameters to optimise is currently 4.
 There is a filter set for only making parameters form the IdentifyObjects modules available for optimisation. This 
 can be changed by just removing the filter in the get_module_list helper method.
 
+In the *In-process loop* optimisation mode, the module re-runs the adjusted modules itself until the optimisation
+stops. Module outputs are cached, so that only modules whose settings or inputs changed are executed again.
+
+The wall time needed to evaluate each proposal is recorded with the x and y values. With *Cost-aware acquisition*,
+a second Gaussian Process model is fitted on the log of these runtimes and the expected improvement of each candidate
+is divided by its predicted runtime, so that cheap settings are preferred over slow ones promising a similar
+improvement. In Test mode, CellProfiler does not measure the execution times of the modules, so the runtimes are only
+known in the *In-process loop* and in analysis runs.
+
+An evaluation fails if the settings identified no input objects (the automated evaluation then reports a false
+"perfect" score) or if the quality is not finite. Failed evaluations are recorded but kept out of the regression model;
+instead, a Gaussian Process classifier learns which settings yield a valid segmentation and the expected improvement
+is multiplied with the probability of a valid result.
+
+In the *In-process loop*, each evaluation can be given a time and object-count budget. The budget is checked after
+each module of the re-run segment; an evaluation exceeding it is aborted and recorded as failed with the worst quality
+seen so far. A module that is already running is not interrupted. In the same way, an evaluation can be rejected
+right after the module identifying the input objects if their number lies outside a plausible range, so that the
+measurement and evaluation modules do not run for a clearly useless segmentation. The batch optimisation runner
+(bayesopt_batch.py) uses the time budget as a hard timeout and restarts the worker busy with the runaway evaluation.
+
+The kernel of the model has one length scale per parameter. Once its hyperparameters are fitted, the relevance of each
+parameter (the inverse length scale, normalised to add up to 1) is reported as an image measurement and shown in the
+display window together with the partial dependence of the quality on each parameter. Parameters whose relevance
+stays below a threshold for a number of rounds can be frozen at their best value.
+
+Fitting the hyperparameters is the slowest part of a round, so by default it is moved off the critical path: the next
+settings are proposed with the hyperparameters fitted last, and the hyperparameters are fitted to the current data in a
+background thread while the pipeline evaluates the proposed settings. The next round waits for the result and
+uses it, so the proposals stay reproducible.
+While the models are fitted and predict, the thread pools of the linear algebra libraries (BLAS, OpenMP) are limited to
+a thread budget (with the threadpoolctl package, or else through the C functions of OpenBLAS, MKL and OpenMP), by
+default the cores divided by the worker processes of CellProfiler, so that workers fitting their models at the same
+time do not oversubscribe the cores. Fits running at the same time in one process share the smallest of their budgets.
+
+The acquisition functions score all candidates at once. The log expected improvement stays informative where the
+expected improvement underflows to zero; the exploration weight of the upper confidence bound decays geometrically
+with the number of rounds; Thompson sampling draws a function from the model with random Fourier features of the
+fitted kernel. The probability of a valid result and the predicted runtime weigh each acquisition on its own scale.
+
+With an A/B evaluation, the model is a preference Gaussian Process: a latent quality with a probit likelihood for
+each comparison, approximated with the Laplace method. Each round compares the proposed settings with the best ones so
+far, so the acquisition picks the candidate that promises the most informative comparison with the best settings.
+
+Instead of the Gaussian Process, an ensemble of extremely randomised trees can model the quality. The mean and
+standard deviation of the predictions of the trees replace those of the Gaussian Process, the relevance of the
+parameters is their mean decrease of impurity, and Thompson sampling draws one of the trees.
+
+Parameters keep the type of their setting: integer settings receive whole numbers, choice and Yes/No settings are
+represented by the index of their value and one-hot encoded for the model, so that all choices are equally far apart.
+A range setting is optimised as two parameters, its min and its max; candidates whose min is not below their max are
+never proposed. If there are more than 10000 combinations of candidate values, a random subset of the valid ones is
+drawn without enumerating all of them.
+
+A preferred value given for a parameter is a prior belief about where good settings lie. The random rounds at the
+start draw their candidates from the prior, and afterwards the acquisition is weighted with the prior raised to the
+power of beta / n (n: number of rounds, beta: a tenth of the max. number of iterations), as in piBO, so that the
+data overrule a wrong prior as they accumulate.
+
+The raw evaluation results of each round (the manual quality and the deviation of each measurement of the automated
+evaluation) are saved with the history, and y is computed from them with the current weights whenever the history is
+loaded. In the multi-objective mode, each of these results is an objective of its own. As in ParEGO, every round
+draws random weights for the objectives, scaled to [0, 1], and the model learns their augmented Tchebycheff
+scalarisation, so that the rounds spread over the whole Pareto front instead of a single trade-off. The settings on
+the Pareto front are saved to pareto_bo_<module number>.txt; a trade-off can be picked after the optimisation by
+choosing the weights, which decide the best settings shown.
+
+The columns of the history are keyed by the module and setting of their parameter, so parameters can be added, removed
+or reordered without deleting the history: the saved rounds are rearranged for the current parameters, and rounds
+without a value for one of them are left out. Rounds with a value outside the current range of a parameter are left
+out as well, the others are snapped to its current steps.
+
+A new session (e.g. for a new plate) can be warm-started from the sessions saved in a directory: the valid rounds of
+every session with values for the same parameters are added to the data of the model as observations with a larger
+noise (alpha divided by their weight), so that the model knows the quality landscape from the start and the rounds
+of the current session overrule them. The random rounds at the start are skipped once there are enough observations.
+
+In the multi-task mode, the image sets are grouped by a metadata measurement (e.g. the plate or well), and each group
+(task) gets its own settings. The rounds of all tasks are modelled together: the task is one-hot encoded as additional
+features of the model, and the fitted length scales of these features decide how similar the quality landscapes of
+the tasks are (a simple intrinsic coregionalisation model: the correlation of two tasks follows from the length
+scales of their features). The max. number of iterations and the best settings refer to the task of the current image
+set.
+
+The history is a journal (history_bo_<module number>.jsonl in the output directory) with one line per round, written
+and synced to the disk at once together with the settings proposed after the round. A crash can only damage the last
+line, which is dropped when the journal is read again. If the module runs again with the settings of the last round,
+e.g. because the proposed settings were not applied before the crash, they are proposed again instead of recording
+the round twice. The text files of earlier versions are moved to the journal when it is first read. A round holds a
+lock file next to the journal (history_bo_<module number>.lock) from reading the history to writing the round, so that
+image sets processed by several CellProfiler workers at the same time take their turns.
+
 
 References
 ^^^^^^^^^^
@@ -84,9 +214,127 @@ The basic code for the Bayesian Optimisation procedure was provided by Bjørn Sa
 #
 # Constants
 #
-NUM_FIXED_SETTINGS = 9
+NUM_FIXED_SETTINGS = 30
 NUM_GROUP1_SETTINGS = 1
-NUM_GROUP2_SETTINGS = 4
+NUM_GROUP2_SETTINGS = 6
+
+#
+# measurements of the relevance of each parameter for the quality
+#
+CATEGORY = 'BayesianOptimisation'
+RELEVANCE = 'Relevance'
+
+#
+# measurement of the number of BLAS/OpenMP threads the model used
+#
+THREADS = 'Threads'
+
+#
+# the C functions getting and setting the number of threads of the thread pools, by library: OpenBLAS (also with the
+# prefix and suffix of the builds bundled with numpy and scipy), MKL and OpenMP; and the names of the libraries
+#
+NATIVE_THREAD_FUNCTIONS = [("openblas_get_num_threads", "openblas_set_num_threads"),
+                           ("openblas_get_num_threads64_", "openblas_set_num_threads64_"),
+                           ("scipy_openblas_get_num_threads", "scipy_openblas_set_num_threads"),
+                           ("scipy_openblas_get_num_threads64_", "scipy_openblas_set_num_threads64_"),
+                           ("MKL_Get_Max_Threads", "MKL_Set_Num_Threads"),
+                           ("omp_get_max_threads", "omp_set_num_threads")]
+
+NATIVE_THREAD_LIBRARIES = ("openblas", "mkl_rt", "libgomp", "libiomp5", "libomp")
+
+#
+# default memory budget of the module output cache in bytes
+#
+CACHE_MEMORY_BUDGET = 512 * 1024 * 1024
+
+#
+# acquisition functions; see ACQUISITIONS for their implementation
+#
+ACQ_EI = "Expected improvement"
+ACQ_LOG_EI = "Log expected improvement"
+ACQ_PI = "Probability of improvement"
+ACQ_UCB = "Upper confidence bound"
+ACQ_THOMPSON = "Thompson sampling"
+
+#
+# the margin of the probability of improvement, the initial exploration weight of the upper confidence bound and its
+# decay per round, and the number of random Fourier features used to draw Thompson samples
+#
+PI_MARGIN = 0.01
+UCB_KAPPA = 2.576
+UCB_DECAY = 0.97
+UCB_KAPPA_MIN = 0.1
+THOMPSON_FEATURES = 500
+
+#
+# surrogate models of the quality
+#
+SURROGATE_GP = "Gaussian process"
+SURROGATE_TREES = "Extremely randomised trees"
+
+#
+# the number of trees of the tree ensemble and the min. number of samples in each of their leaves
+#
+TREE_COUNT = 100
+TREE_MIN_SAMPLES_LEAF = 1
+
+#
+# the measurement of an A/B evaluation, the noise of the comparisons made by the user (in units of the latent quality)
+# and the max. number of Newton steps of the Laplace approximation of the preference model
+#
+PREFERENCE_FEATURE = "Evaluation_Preference"
+PREFERENCE_NOISE = 0.1
+PREFERENCE_NEWTON_STEPS = 50
+
+#
+# the weight of the sum of the weighted objectives in the augmented Tchebycheff scalarisation of the multi-objective
+# mode (rho in ParEGO)
+#
+PARETO_AUGMENTATION = 0.05
+
+#
+# default weight of the rounds of previous sessions used to warm-start a session
+#
+WARM_START_WEIGHT = 0.25
+
+#
+# guards the history files and the rounds that read and extend them, so that image sets processed at the same time
+# neither interleave their writes nor propose from the same history twice; re-entrant, as a round writes while it
+# holds the lock. Image sets processed by other processes are kept out by the lock file of each history (see
+# InterProcessLock), which is taken while this lock is held
+#
+HISTORY_LOCK = threading.RLock()
+
+#
+# the inter-process lock of each history, by the path of its lock file
+#
+HISTORY_FILE_LOCKS = {}
+
+#
+# kinds of parameters; the kind is derived from the class of the setting that is optimised
+#
+PARAM_FLOAT = "float"
+PARAM_INTEGER = "integer"
+PARAM_CHOICE = "choice"
+PARAM_BINARY = "binary"
+
+#
+# default confidence in the preferred value of a parameter, and the max. confidence (a prior never rules out the
+# other values completely)
+#
+PRIOR_CONFIDENCE = 0.5
+PRIOR_CONFIDENCE_MAX = 0.99
+
+#
+# max. number of candidates the acquisition function is evaluated for
+#
+MAX_CANDIDATES = 10000
+
+#
+# optimisation modes
+#
+MODE_INTERACTIVE = "Interactive (one round per run)"
+MODE_IN_PROCESS = "In-process loop"
 
 #
 # for testing/ printout purposes only
@@ -98,450 +346,3656 @@ np.set_printoptions(suppress=True)
 
 
 #
-# Create module class which inherits from cellprofiler.module.Module class
+# helper function:
+# Return the (min, max) bounds a CellProfiler setting accepts; None where the setting does not define a bound
 #
-class BayesianOptimisation(cellprofiler.module.Module):
+def get_setting_bounds(setting):
+    bounds = []
+    for names in (("min_value", "_minval", "_Number__minval"), ("max_value", "_maxval", "_Number__maxval")):
+        bound = None
+        for name in names:
+            if getattr(setting, name, None) is not None:
+                bound = getattr(setting, name)
+                break
+        bounds += [bound]
+    return tuple(bounds)
 
-    #
-    # Declare the name for displaying the module, e.g. in menus 
-    # Declare the category under which it is stored and grouped in the menu
-    # Declare variable revision number which can be used to provide backwards compatibility  if CellProfiler will be
-    # released in a new version
-    #
-    module_name = "BayesianOptimisation"
-    category = "Advanced"
-    variable_revision_number = 1
 
-    #######################################################################
-    # Create and set CellProfiler settings for GUI and Pipeline execution #
-    #######################################################################
+#
+# helper function:
+# Return the kind of parameter a CellProfiler setting is optimised as. Image and object names are choices as well,
+# but they are not tuned
+#
+def get_parameter_kind(setting):
+    if isinstance(setting, cellprofiler.setting.Binary):
+        return PARAM_BINARY
+
+    if isinstance(setting, cellprofiler.setting.Choice) and \
+            not isinstance(setting, cellprofiler.setting.NameSubscriber):
+        return PARAM_CHOICE
+
+    if isinstance(setting, (cellprofiler.setting.Integer, cellprofiler.setting.IntegerRange)):
+        return PARAM_INTEGER
+
+    return PARAM_FLOAT
+
+
+#
+# helper class:
+# The prior belief of the user about one dimension of a parameter: a preferred value and the confidence (0-1) that
+# good settings lie close to it. For numerical dimensions, the prior is a normal distribution around the preferred
+# value, whose standard deviation shrinks from half the range (confidence 0) towards 1% of it; for categorical
+# dimensions, the preferred choice gets the confidence as extra probability on top of a uniform distribution
+#
+class ParameterPrior(object):
+
+    def __init__(self, preferred, confidence, lower, upper, num_choices=None):
+        self.preferred = float(preferred)
+        self.confidence = min(max(float(confidence), 0.0), PRIOR_CONFIDENCE_MAX)
+        self.num_choices = num_choices
+        self.sd = max(1.0 - self.confidence, 0.01) * max(float(upper) - float(lower), 1e-3) / 2.0
 
     #
-    # Define the setting's data types and grouped elements
+    # return the log of the (unnormalised) prior density of each value
     #
-    def create_settings(self):
-        module_explanation = [
-            "This module uses BayesianOptimisation on parameters (settings) chosen from modules placed before this "
-            "module in the pipeline. Step 1: Choose the object which you have evaluated in the evaluation modules. "
-            "The Bayesian module considers these measures as quality indicators. Step 2: Choose the parameters "
-            "(settings) to be adjusted. Bayesian Optimisation will be executed if required quality thresholds/ranges "
-            "are not met. If an AutomatedEvaluation modue is placed beforehand, the final output of the autoevaluation"
-            "will be displayed and can be evaluated by the user."]
+    def log_density(self, values):
+        values = np.asarray(values, dtype=float)
 
-        #
-        # Notes will appear in the notes-box of the module
-        #
-        self.set_notes([" ".join(module_explanation)])
+        if self.num_choices is not None:
+            p_other = (1.0 - self.confidence) / self.num_choices
+            p_preferred = self.confidence + p_other
 
-        #
-        # Object identified in upstream IndentifyObjects module; accessible via ObjectNameSubscriber
-        #
-        self.input_object_name = cellprofiler.setting.ObjectNameSubscriber(
-            "Input object name",
-            cellprofiler.setting.NONE,
-            doc="""\
-These are the objects that the module operates on."""
-        )
+            return np.where(np.round(values) == self.preferred, np.log(p_preferred), np.log(p_other))
 
-        #
-        # The number of evaluation modules as input for BayesianModule;
-        # necessary for prepare_settings method
-        #
-        self.count1 = cellprofiler.setting.Integer(
-                'No. of evaluation modules',
-                1,
-                minval=1,
-                maxval=2,
-                doc="""\
-No. of evaluation modules before BayesianModule."""
-            )
+        return -0.5 * ((values - self.preferred) / self.sd) ** 2
 
-        #
-        # The number of parameters to be adjusted by BayesianModule;
-        # necessary for prepare_settings method
-        #
-        self.count2 = cellprofiler.setting.Integer(
-            'No. of settings to be adjusted',
-            2,
-            minval=1,
-            maxval=4,
-            doc="""\
-No. of settings that should be adjusted by BayesianModule. You can choose up to 4 settings."""
-        )
 
-        #
-        # Group of measurements made for the object by a Measurements module
-        #
-        self.measurements = []
+#
+# helper function:
+# Return the weight of each row of x (one column per dimension) under the priors (one per dimension, None where there
+# is no prior). The weights are the prior density raised to the given exponent, scaled so that the largest is 1; as
+# the exponent decays, the weights approach 1 and the prior loses its influence
+#
+def get_prior_weights(x, priors, exponent=1.0):
+    log_weights = np.zeros(len(x))
 
-        #
-        # Add first measurement which cannot be deleted; there must be at least one
-        #
-        self.add_measurement(can_delete=False)
+    for i, prior in enumerate(priors):
+        if prior is not None:
+            log_weights += prior.log_density(x[:, i])
 
-        #
-        # Button for adding additional measurements; calls add_measurement helper function
-        #
-        self.add_measurement_button = cellprofiler.setting.DoSomething(
-            "", "Add another measurement", self.add_measurement)
+    if len(x) == 0:
+        return log_weights
 
-        self.spacer = cellprofiler.setting.Divider(line=True)
+    return np.exp((log_weights - np.max(log_weights)) * exponent)
 
-        #
-        # The weighting in % for the automated evaluation results
-        #
-        self.weighting_auto = cellprofiler.setting.Integer(
-            'Weighting of automated evaluation score (%)',
-            50,
-            minval=0,
-            maxval=100,
-            doc="""\
-The weighting of the automated evaluation results in comparison to manual evaluation."""
-        )
 
-        #
-        # The weighting in % for the manual evaluation results
-        #
-        self.weighting_manual = cellprofiler.setting.Integer(
-            'Weighting of manual evaluation score (%)',
-            50,
-            minval=0,
-            maxval=100,
-            doc="""\
-The weighting of the manual evaluation result in comparison to automated evaluation."""
-        )
+#
+# helper class:
+# Binds one optimised parameter to the setting object of its target module.
+# The setting, its kind and the bounds the value is clamped to are looked up once, so that a proposal can be
+# written without searching the pipeline again.
+# The optimisation sees every parameter as one or two numbers x (its dimensions): Choice and Binary settings are
+# represented by the index of their value (all choices are candidates, the user defined range and steps do not apply),
+# Integer settings by whole numbers with a step of at least 1. Range settings (IntegerRange, FloatRange) have two
+# dimensions, their min and their max, which both vary within the user defined range; the min must stay below the max.
+#
+class ParameterBinding(object):
+
+    def __init__(self, module, setting, setting_range, step, prior_value="", prior_confidence=PRIOR_CONFIDENCE):
+        self.module = module
+        self.module_num = module.get_module_num()
+        self.setting = setting
+        self.name = setting.get_text()
+        self.kind = get_parameter_kind(setting)
+        self.choices = None
+
+        if self.kind == PARAM_BINARY:
+            self.choices = [False, True]
+        elif self.kind == PARAM_CHOICE:
+            self.choices = list(setting.choices)
+
+        if isinstance(setting, cellprofiler.setting.Range):
+            self.dimension_names = [self.name + " (min)", self.name + " (max)"]
+        else:
+            self.dimension_names = [self.name]
 
+        if self.choices is not None:
+            self.range = (0, len(self.choices))
+            self.step = 1.0
+            minval, maxval = None, None
+        else:
+            self.range = setting_range
+            self.step = float(step)
 
-        self.spacer6 = cellprofiler.setting.Divider(line=True)
+            if self.kind == PARAM_INTEGER:
+                self.range = (np.ceil(float(setting_range[0])), float(setting_range[1]))
+                self.step = max(1.0, float(np.round(self.step)))
 
-        #
-        # The maximum number of iterations for the Bayesian Optimisation
-        #
-        self.max_iter = cellprofiler.setting.Integer(
-            'Max. iterations for Bayesian Optimisation',
-            150,
-            minval=2,
-            maxval=10000,
-            doc="""\
-Define the maximum number of iterations the Bayesian Optimisation should run. The minimum number is 2, 
-recommended iterations are 50 - 200, depending on the problem to be solved. """
-        )
+            minval, maxval = get_setting_bounds(setting)
 
         #
-        # The length scale for the Bayesian Optimisation kernel function
+        # clamp bounds are the user defined range narrowed down to what the setting itself accepts
         #
-        self.length_scale = cellprofiler.setting.Float(
-            'Length scale for Bayesian Optimisation kernel function',
-            0.1,
-            minval=0,
-            maxval=1000,
-            doc="""\
-Define the length scale for the kernel function of the Bayesian Optimisation model. The value influences the
-smoothness of the objective kernel function. A larger value indicates a smoother function."""
-        )
+        self.lower = float(self.range[0]) if minval is None else max(float(self.range[0]), float(minval))
+        self.upper = float(self.range[1]) if maxval is None else min(float(self.range[1]), float(maxval))
 
-        #
-        # The alpha value for the Bayesian Optimisation model
-        #
-        self.alpha = cellprofiler.setting.Float(
-            'Alpha for Bayesian Optimisation model',
-            0.01,
-            minval=0,
-            maxval=1000,
-            doc="""\
-Define the alpha value for the GaussianProcessRegressor model. A low value indicates low noise in the data."""
-        )
+        if self.choices is not None:
+            self.upper = float(len(self.choices) - 1)
 
-        self.spacer4 = cellprofiler.setting.Divider(line=True)
+        self.priors = self.parse_priors(prior_value, prior_confidence)
 
-        self.parameters = []
+    def __len__(self):
+        return len(self.dimension_names)
 
-        #
-        # Add first parameter which cannot be deleted; there must be at least one
-        #
-        self.add_parameter(can_remove=False)
+    #
+    # return the prior of each dimension given the preferred value as entered by the user: the name of a choice,
+    # Yes/No, one number or two comma-separated numbers (min, max) for a range setting. No value means no prior.
+    # Raises a ValueError if the value can not be parsed
+    #
+    def parse_priors(self, prior_value, prior_confidence):
+        prior_value = prior_value.strip()
 
-        #
-        # Button for adding additional parameters; calls add_parameter helper function
-        #
-        self.add_param_button = cellprofiler.setting.DoSomething("", "Add parameter", self.add_parameter)
+        if prior_value == "":
+            return [None] * len(self)
 
-        self.spacer2 = cellprofiler.setting.Divider(line=True)
+        if self.choices is not None:
+            if self.kind == PARAM_BINARY:
+                names = [cellprofiler.setting.NO, cellprofiler.setting.YES]
+            else:
+                names = [str(choice) for choice in self.choices]
 
-        #
-        # Button for refreshing the GUI; calls refreshGUI helper function
-        # This is necessary as the choices_fn function does not work without
-        # refreshing the GUI if new groups were added
-        #
-        self.refresh_button = cellprofiler.setting.DoSomething(
-            "",
-            "Refresh GUI",
-            self.refreshGUI,
-            doc = """\
-If the dropdown menus are not updated, you can update them again with this button."""
-        )
+            if prior_value not in names:
+                raise ValueError("\"{}\" is not one of the choices {}".format(prior_value, ", ".join(names)))
 
-        self.spacer3 = cellprofiler.setting.Divider(line=True)
+            return [ParameterPrior(names.index(prior_value), prior_confidence, self.lower, self.upper,
+                                   len(self.choices))]
 
-        #
-        # Output directory chooser;
-        # x and y values of previous Optimisation rounds will be saved in files in this directory
-        #
-        self.pathname = cellprofiler.setting.DirectoryPath(
-            "Output file location",
-            dir_choices=[
-                cellprofiler.preferences.DEFAULT_OUTPUT_FOLDER_NAME,
-                cellprofiler.preferences.DEFAULT_INPUT_FOLDER_NAME,
-                cellprofiler.preferences.ABSOLUTE_FOLDER_NAME,
-                cellprofiler.preferences.DEFAULT_OUTPUT_SUBFOLDER_NAME,
-                cellprofiler.preferences.DEFAULT_INPUT_SUBFOLDER_NAME],
-            doc="""\
-Choose the directory where Optimisation data is saved. """
-        )
+        values = [value.strip() for value in prior_value.split(",")]
+        if len(values) != len(self):
+            raise ValueError("Please enter {} comma-separated number(s)".format(len(self)))
 
-        self.spacer5 = cellprofiler.setting.Divider(line=False)
+        try:
+            return [ParameterPrior(float(value), prior_confidence, self.lower, self.upper) for value in values]
+        except ValueError:
+            raise ValueError("\"{}\" is not a number".format(prior_value))
 
-        #
-        # Button for deleting existing files storing values from previous runs
-        #
-        self.delete_button = cellprofiler.setting.DoSomething(
-            "",
-            "Delete previous Data",
-            self.delete_data,
-            doc="""\
-If there is previously gathered data saved in a file you can choose to delete it."""
-        )
+    #
+    # return the current setting value as a list of x values, one per dimension
+    #
+    def get_values(self):
+        if len(self) == 2:
+            return [self.setting.min, self.setting.max]
+
+        value = self.setting.get_value()
+
+        if self.choices is not None:
+            return [self.choices.index(value) if value in self.choices else 0]
+
+        return [value]
 
     #
-    # helper function:
-    # add the quality measurements which should be considered by B.O.
-    # add a remove-button for all measurements except a mandatory one
+    # clamp a value into the bounds and convert it to what the setting accepts
     #
-    def add_measurement(self, can_delete=True):
-        group = cellprofiler.setting.SettingsGroup()
+    def convert_value(self, value):
+        value = min(max(float(value), self.lower), self.upper)
+
+        if self.choices is not None or self.kind == PARAM_INTEGER:
+            return int(round(value))
+
+        return round(value, 3)
+
+    #
+    # write the values of all dimensions to the setting; a range whose min is not below its max is widened by one
+    # step. Return True if the setting value was changed
+    #
+    def set_values(self, values):
+        values = [self.convert_value(value) for value in values]
+
+        if len(self) == 2 and values[0] >= values[1]:
+            if values[0] + self.step <= self.upper:
+                values[1] = self.convert_value(values[0] + self.step)
+            else:
+                values[0] = self.convert_value(values[1] - self.step)
+
+        changed = self.get_values() != values
+
+        if self.choices is not None:
+            self.setting.set_value(self.choices[values[0]])
+        elif len(self) == 2:
+            self.setting.set_value(tuple(values))
+        else:
+            self.setting.set_value(values[0])
+
+        return changed
+
+    #
+    # return a value x as it is shown to the user: the choice of Choice and Binary settings and the number itself
+    # otherwise
+    #
+    def format_value(self, value):
+        if self.choices is not None:
+            choice = self.choices[self.convert_value(value)]
+
+            if self.kind == PARAM_BINARY:
+                return cellprofiler.setting.YES if choice else cellprofiler.setting.NO
+
+            return choice
+
+        return value
+
+
+#
+# helper class:
+# The binding plan holds a ParameterBinding for every parameter chosen in the BayesianOptimisation module.
+# It is compiled once per run and applies a whole proposal as one batched edit of the pipeline. A proposal has one
+# value per dimension; range settings have two dimensions, all other settings one.
+#
+class BindingPlan(object):
+
+    def __init__(self, pipeline, bindings, signature):
+        self.pipeline = pipeline
+        self.bindings = bindings
+        self.signature = signature
+
+    def __len__(self):
+        return sum(len(binding) for binding in self.bindings)
+
+    @property
+    def names(self):
+        return [name for binding in self.bindings for name in binding.dimension_names]
+
+    @property
+    def ranges(self):
+        return [binding.range for binding in self.bindings for _ in range(len(binding))]
+
+    @property
+    def steps(self):
+        return [binding.step for binding in self.bindings for _ in range(len(binding))]
+
+    @property
+    def kinds(self):
+        return [binding.kind for binding in self.bindings for _ in range(len(binding))]
+
+    @property
+    def priors(self):
+        return [prior for binding in self.bindings for prior in binding.priors]
+
+    #
+    # the identity of each dimension: its module ("<module name> #<module number>") and its name; the columns of the
+    # history are keyed by it
+    #
+    @property
+    def identities(self):
+        return [["{} #{}".format(binding.module.module_name, binding.module_num), name]
+                for binding in self.bindings for name in binding.dimension_names]
+
+    #
+    # the index of the parameter (binding) of each dimension
+    #
+    @property
+    def parameter_index(self):
+        return [i for i, binding in enumerate(self.bindings) for _ in range(len(binding))]
+
+    #
+    # the pairs of dimensions (i, j) whose values must satisfy x_i < x_j: the min and max of each range setting
+    #
+    @property
+    def ordered(self):
+        pairs = []
+        first = 0
+
+        for binding in self.bindings:
+            if len(binding) == 2:
+                pairs += [(first, first + 1)]
+            first += len(binding)
+
+        return pairs
+
+    @property
+    def first_module_num(self):
+        return min(binding.module_num for binding in self.bindings)
+
+    #
+    # the plan is only valid for the pipeline it was compiled for, as long as the chosen parameters were not edited and
+    # the bound modules were not moved or removed
+    #
+    def is_valid_for(self, pipeline, signature):
+        if pipeline is not self.pipeline or signature != self.signature:
+            return False
+
+        for binding in self.bindings:
+            try:
+                if pipeline.module(binding.module_num) is not binding.module:
+                    return False
+            except IndexError:
+                return False
+
+        return True
+
+    def get_values(self):
+        return [value for binding in self.bindings for value in binding.get_values()]
+
+    #
+    # split the values of a proposal into the values of each binding
+    #
+    def split_values(self, values):
+        values = list(values)
+        split = []
+
+        for binding in self.bindings:
+            split += [(binding, values[:len(binding)])]
+            values = values[len(binding):]
+
+        return split
+
+    def format_values(self, values):
+        return [binding.format_value(value) for binding, values in self.split_values(values) for value in values]
+
+    #
+    # write all values of a proposal to their settings and inform the pipeline once;
+    # the pipeline re-runs from the earliest module that was modified. Mind that the pipeline-index is 1 smaller
+    # than the module number. With notify=False, the pipeline is not informed (the caller re-runs the modules itself)
+    #
+    def apply(self, values, notify=True):
+        changed_module_nums = []
+
+        for binding, binding_values in self.split_values(values):
+            if binding.set_values(binding_values):
+                changed_module_nums += [binding.module_num]
+
+        if not notify:
+            return
+
+        if len(changed_module_nums) == 0:
+            changed_module_nums = [self.first_module_num]
+
+        self.pipeline.edit_module(min(changed_module_nums) - 1, is_image_set_modification=False)
+
+
+#
+# helper function:
+# Return the names of the images and objects a module reads and whether the module also reads measurements.
+# Modules reading measurements depend on everything that ran before them, as measurements are not tracked by name.
+#
+def get_module_inputs(module):
+    names = set()
+    uses_measurements = False
+
+    for setting in module.settings():
+        if isinstance(setting, cellprofiler.setting.ImageNameSubscriber):
+            names.add(("image", setting.value))
+        elif isinstance(setting, cellprofiler.setting.ObjectNameSubscriber):
+            names.add(("objects", setting.value))
+        elif isinstance(setting, cellprofiler.setting.Measurement):
+            uses_measurements = True
+
+    return names, uses_measurements
+
+
+#
+# helper function:
+# Return the names of the images and objects a module provides
+#
+def get_module_outputs(module):
+    names = set()
+
+    for setting in module.settings():
+        if isinstance(setting, cellprofiler.setting.ImageNameProvider):
+            names.add(("image", setting.value))
+        elif isinstance(setting, cellprofiler.setting.ObjectNameProvider):
+            names.add(("objects", setting.value))
+
+    return names
+
+
+#
+# helper function:
+# Return a hash of a module's name and all of its setting values
+#
+def hash_module_settings(module):
+    md5 = hashlib.md5()
+    md5.update(module.module_name.encode("utf-8"))
+
+    for setting in module.settings():
+        md5.update(u"\x00{}".format(setting.unicode_value).encode("utf-8"))
+
+    return md5.hexdigest()
+
+
+#
+# helper class:
+# The images, objects and measurements one module added to the workspace when it ran for an image set
+#
+class ModuleOutputs(object):
+
+    def __init__(self, images, objects, measurements):
+        self.images = images                # image name -> cellprofiler.image.Image
+        self.objects = objects              # object name -> cellprofiler.object.Objects
+        self.measurements = measurements    # list of (object name, feature name, value)
 
         #
-        # Dropdown selection for measurements taken for the object
+        # the memory used by the entry is dominated by pixel data and label matrices
         #
-        group.append(
-            "evaluation_measurement",
-            cellprofiler.setting.Measurement(
-                "Select measurements for evaluation",
-                self.input_object_name.get_value,
-                "Evaluation_Deviation",
-                doc="""\
-See the **Measurements** modules help pages for more information on the
-features measured."""
+        self.nbytes = 0
+        for image in images.values():
+            self.nbytes += getattr(image.pixel_data, "nbytes", 0)
+        for objects in objects.values():
+            try:
+                self.nbytes += objects.segmented.nbytes
+            except AttributeError:
+                pass
+        for _, _, value in measurements:
+            self.nbytes += getattr(value, "nbytes", 8)
 
-            )
-        )
+    @property
+    def names(self):
+        return [("image", name) for name in self.images] + [("objects", name) for name in self.objects]
 
-        self.measurements.append(group)
+    #
+    # collect the outputs of a module that has just run on the workspace
+    #
+    @classmethod
+    def capture(cls, pipeline, module, workspace):
+        images = {}
+        objects = {}
+
+        for group, name in get_module_outputs(module):
+            if group == "image":
+                images[name] = workspace.image_set.get_image(name)
+            else:
+                objects[name] = workspace.object_set.get_objects(name)
 
-        if can_delete:
-            group.append(
-                "remover",
-                cellprofiler.setting.RemoveSettingButton(
-                    "",
-                    "Remove this measurement",
-                    self.measurements, group
-                )
-            )
+        measurements = []
+        for column in module.get_measurement_columns(pipeline):
+            #
+            # columns are tuples of object name, feature name and data type
+            #
+            if not isinstance(column, (tuple, list)) or len(column) < 3:
+                continue
+
+            object_name, feature_name = column[0], column[1]
+            if workspace.measurements.has_current_measurements(object_name, feature_name):
+                measurements += [(object_name, feature_name,
+                                  workspace.measurements.get_current_measurement(object_name, feature_name))]
+
+        return cls(images, objects, measurements)
 
     #
-    # helper function:
-    # add parameters grouped with corresponding modules
-    # add a remove-button for all parameters except a mandatory one
+    # add the outputs to the workspace as if the module had run again
     #
-    def add_parameter(self, can_remove=True):
+    def restore(self, workspace):
+        for name, image in self.images.items():
+            workspace.image_set.add(name, image)
 
-        group = cellprofiler.setting.SettingsGroup()
+        for name, objects in self.objects.items():
+            workspace.object_set.add_objects(objects, name)
 
-        if can_remove:
-            group.append("divider", cellprofiler.setting.Divider(line=False))
+        for object_name, feature_name, value in self.measurements:
+            workspace.measurements.add_measurement(object_name, feature_name, value)
+
+
+#
+# helper class:
+# Least-recently-used cache for module outputs, keyed by (image set number, module number, hash of the module's
+# settings and inputs). The least recently used entries are evicted once the entries exceed the memory budget.
+#
+class ModuleOutputCache(object):
+
+    def __init__(self, memory_budget=CACHE_MEMORY_BUDGET):
+        self.memory_budget = memory_budget
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+
+        if entry is None:
+            self.misses += 1
+            return None
 
         #
-        # Dropdown selection for modules (IdentifyObjects modules)
+        # re-insert the entry to mark it as the most recently used one
         #
-        group.append("module_names", cellprofiler.setting.Choice(
-            "Select module",
-            choices=[""],
-            choices_fn=self.get_module_list,
-            doc="""\
-This is the module where Bayesian Optimisation will adjust settings
-"""
-        ))
+        self.entries[key] = entry
+        self.hits += 1
+
+        return entry
+
+    def put(self, key, entry):
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key).nbytes
 
         #
-        # Dropdown selection for parameters of the selected modules
+        # entries larger than the whole budget are not cached at all
         #
-        group.append("parameter_names", cellprofiler.setting.Choice(
-            "Select parameter",
-            choices=[""],
-            choices_fn=self.get_settings_from_modules,
-            doc="""\
-These are the settings to be adjusted by Bayesian Optimisation
-"""
-        ))
+        if entry.nbytes > self.memory_budget:
+            return
+
+        self.entries[key] = entry
+        self.nbytes += entry.nbytes
+
+        while self.nbytes > self.memory_budget:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+
+#
+# Exception raised by run_pipeline_segment when an evaluation exceeds its budget
+#
+class EvaluationAborted(Exception):
+    pass
+
+
+#
+# helper class:
+# The time and object-count budget of one evaluation; 0 means no limit. Optionally, the number of objects of one name
+# must lie within a plausible (min, max) window. The budget is checked after each module of a segment, so a module
+# that is already running is not interrupted, but the modules after it are not run any more
+#
+class EvaluationBudget(object):
+
+    def __init__(self, max_seconds=0, max_objects=0, object_name=None, count_window=None):
+        self.max_seconds = max_seconds
+        self.max_objects = max_objects
+        self.object_name = object_name
+        self.count_window = count_window
+        self.start_time = time.time()
+
+    def start(self):
+        self.start_time = time.time()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start_time
+
+    #
+    # raise EvaluationAborted if the evaluation took too long or the module identified too many or an implausible
+    # number of objects
+    #
+    def check(self, module, outputs):
+        if 0 < self.max_seconds < self.elapsed:
+            raise EvaluationAborted("Time budget of {}s exceeded after {} #{}".format(
+                self.max_seconds, module.module_name, module.get_module_num()))
+
+        if self.max_objects > 0:
+            for name, objects in outputs.objects.items():
+                if objects.count > self.max_objects:
+                    raise EvaluationAborted("{} #{} identified {} {} objects, more than the budget of {}".format(
+                        module.module_name, module.get_module_num(), objects.count, name, self.max_objects))
+
+        if self.count_window is not None and self.object_name in outputs.objects:
+            count = outputs.objects[self.object_name].count
+            if not self.count_window[0] <= count <= self.count_window[1]:
+                raise EvaluationAborted("{} #{} identified an implausible number of {} objects ({})".format(
+                    module.module_name, module.get_module_num(), self.object_name, count))
+
+
+#
+# helper function:
+# Run a segment of pipeline modules on the image set of the workspace.
+# A module only re-executes if its settings or the outputs of the modules it reads from changed since it was cached;
+# otherwise its outputs are restored from the cache. The object set of the workspace needs to allow overwriting,
+# as the segment is run repeatedly on the same image set.
+# If a budget is given, EvaluationAborted is raised as soon as a module exceeds it.
+#
+def run_pipeline_segment(pipeline, workspace, modules, cache, image_set_number, budget=None):
+    #
+    # images and objects provided before the segment do not change between runs of the segment
+    #
+    producer_keys = {}
+    segment_md5 = hashlib.md5()
+
+    for module in modules:
+        if not module.enabled:
+            continue
+
+        inputs, uses_measurements = get_module_inputs(module)
+
+        md5 = hashlib.md5(hash_module_settings(module).encode("utf-8"))
+        if uses_measurements:
+            md5.update(segment_md5.hexdigest().encode("utf-8"))
+        else:
+            for group, name in sorted(inputs):
+                md5.update(producer_keys.get((group, name), "upstream").encode("utf-8"))
+
+        module_hash = md5.hexdigest()
+        key = (image_set_number, module.get_module_num(), module_hash)
+
+        outputs = cache.get(key) if cache is not None else None
+
+        if outputs is None:
+            module_workspace = cellprofiler.workspace.Workspace(pipeline,
+                                                                module,
+                                                                workspace.image_set,
+                                                                workspace.object_set,
+                                                                workspace.measurements,
+                                                                workspace.image_set_list)
+            pipeline.run_module(module, module_workspace)
+
+            outputs = ModuleOutputs.capture(pipeline, module, workspace)
+            if cache is not None:
+                cache.put(key, outputs)
+        else:
+            outputs.restore(workspace)
+
+        for name in outputs.names:
+            producer_keys[name] = module_hash
+
+        segment_md5.update(module_hash.encode("utf-8"))
+
+        if budget is not None:
+            budget.check(module, outputs)
+
+
+####################
+# Surrogate models #
+####################
+
+#
+# helper class:
+# Extremely randomised trees as a surrogate model of the quality (as in SMAC). Each tree is fitted on random splits of
+# the data, so the trees disagree where the data are sparse; the mean and standard deviation of their predictions take
+# the place of the mean and standard deviation of the GP. The trees split on each parameter separately, which suits
+# discrete and categorical settings, and fitting them costs time near-linear in the number of evaluations. Fitting and
+# predicting are spread over n_jobs cores (-1: all cores)
+#
+class TreeEnsembleSurrogate(object):
+    def __init__(self, n_estimators=TREE_COUNT, min_samples_leaf=TREE_MIN_SAMPLES_LEAF, random_state=None, n_jobs=-1):
+        self.n_jobs = n_jobs
+        self.forest = ExtraTreesRegressor(n_estimators=n_estimators,
+                                          min_samples_leaf=min_samples_leaf,
+                                          random_state=random_state,
+                                          n_jobs=n_jobs)
+
+    def fit(self, x, y, sample_weight=None):
+        self.forest.fit(x, y, sample_weight=sample_weight)
+
+        return self
+
+    #
+    # the predictions of every tree, one row per tree; the trees predict in parallel threads (the tree code releases
+    # the GIL)
+    #
+    def predict_trees(self, x):
+        predictions = joblib.Parallel(n_jobs=self.n_jobs, backend="threading")(
+            joblib.delayed(tree.predict)(x) for tree in self.forest.estimators_)
+
+        return np.vstack(predictions)
+
+    def predict(self, x, return_std=False):
+        predictions = self.predict_trees(x)
+        mu = np.mean(predictions, axis=0)
+
+        if return_std:
+            return mu, np.std(predictions, axis=0)
+
+        return mu
+
+    #
+    # the prediction of a single tree chosen at random
+    #
+    def sample(self, x, random_state=np.random):
+        tree = self.forest.estimators_[random_state.randint(len(self.forest.estimators_))]
+
+        return tree.predict(x)
+
+    #
+    # the relevance of each parameter: the mean decrease of the impurity of the splits on the parameter, normalised
+    # to add up to 1
+    #
+    @property
+    def feature_importances_(self):
+        return self.forest.feature_importances_
+
+
+#
+# helper function:
+# Return the comparisons (duels) made in an A/B evaluation and the index of the best round so far. The preference
+# of each round is 1 if its settings were preferred over the best ones so far, 0 if not and 0.5 if both were equally
+# good (NaN where there was no comparison). The first compared round is the first best so far; a round becomes the
+# best so far whenever it is preferred. Each duel is a tuple (index of winner, index of loser, weight); a tie counts
+# as half a win for each side
+#
+def get_duels(preferences):
+    duels = []
+    incumbent = None
+
+    for k, preference in enumerate(preferences):
+        if not np.isfinite(preference):
+            continue
+
+        if incumbent is None:
+            incumbent = k
+            continue
+
+        if preference > 0:
+            duels += [(k, incumbent, float(preference))]
+
+        if preference < 1:
+            duels += [(incumbent, k, 1.0 - float(preference))]
+
+        if preference >= 1:
+            incumbent = k
+
+    return duels, incumbent
+
+
+#
+# helper class:
+# Gaussian Process model of the quality learned from comparisons instead of absolute values (Chu & Ghahramani, 2005).
+# A latent utility f with an RBF kernel prior explains each duel with the probit likelihood
+# Phi((f(winner) - f(loser)) / (sqrt(2) noise)); its posterior is approximated with a Gaussian at the mode (Laplace
+# approximation), found with Newton steps. To fit into the optimisation, which minimises the quality, the model
+# predicts the negative utility
+#
+class PreferenceSurrogate(object):
+
+    def __init__(self, length_scale=1.0, noise=PREFERENCE_NOISE, jitter=1e-6):
+        self.kernel = gp.kernels.RBF(length_scale=length_scale)
+        self.noise = noise
+        self.jitter = jitter
+
+    def fit(self, x, duels):
+        n = len(x)
+        scale = np.sqrt(2.0) * self.noise
+
+        self.x = x
+        self.k = self.kernel(x) + self.jitter * np.eye(n)
 
         #
-        # The parameters will be adjusted within this range
+        # each row of d picks the difference f(winner) - f(loser) of one duel
         #
-        group.append(
-            "range",
-            cellprofiler.setting.FloatRange(
-                'Set min and max boundaries for variation',
-                (1.00, 100.00),
-                minval=00.00,
-                maxval=1000.00,
-                doc="""\
-The Bayesian Optimisation will vary the parameter within this range of candidates. Please note that the lower
-bound is inclusive, the upper bound is exclusive."""
-            )
-        )
+        d = np.zeros((len(duels), n))
+        weights = np.zeros(len(duels))
+        for i, (winner, loser, weight) in enumerate(duels):
+            d[i, winner] += 1.0
+            d[i, loser] -= 1.0
+            weights[i] = weight
 
         #
-        # The parameters will be adjusted within this range
+        # Newton steps f = K (I + W K)^-1 (W f + gradient), where W is the negative Hessian of the log likelihood
         #
-        group.append(
-            "steps",
-            cellprofiler.setting.Float(
-                'Set steps between boundaries',
-                0.1,
-                minval=00.00,
-                maxval=10.00,
-                doc="""\
-The variation steps within the chosen range for choosing a candidate set."""
-            )
-        )
+        f = np.zeros(n)
+        w = np.zeros((n, n))
 
-        if can_remove:
-            group.append("remover",
-                         cellprofiler.setting.RemoveSettingButton("", "Remove parameter", self.parameters, group))
+        for _ in range(PREFERENCE_NEWTON_STEPS):
+            z = np.dot(d, f) / scale
+            ratio = np.exp(norm.logpdf(z) - norm.logcdf(z))
 
-        self.parameters.append(group)
+            gradient = np.dot(d.T, weights * ratio) / scale
+            w = np.dot(d.T * (weights * ratio * (z + ratio)), d) / scale ** 2
+
+            f_new = np.dot(self.k, np.linalg.solve(np.eye(n) + np.dot(w, self.k), np.dot(w, f) + gradient))
+
+            converged = np.max(np.abs(f_new - f)) < 1e-6
+            f = f_new
+
+            if converged:
+                break
+
+        self.f = f
+        self.w = w
+        self.alpha = np.linalg.solve(self.k, f)
+
+        return self
+
+    #
+    # the posterior mean and standard deviation of the negative utility
+    #
+    def predict(self, x, return_std=False):
+        k_x = self.kernel(x, self.x)
+        mu = -np.dot(k_x, self.alpha)
+
+        if not return_std:
+            return mu
+
+        #
+        # var = k(x, x) - k_x (K + W^-1)^-1 k_x^T, with (K + W^-1)^-1 = W (I + K W)^-1
+        #
+        a = np.linalg.solve(np.eye(len(self.x)) + np.dot(self.k, self.w), k_x.T)
+        var = 1.0 - np.sum(k_x.T * np.dot(self.w, a), axis=0)
+
+        return mu, np.sqrt(np.maximum(var, 1e-12))
+
+    #
+    # draw the utility of the compared rounds from the Laplace posterior and return the negative posterior mean it
+    # implies for x
+    #
+    def sample(self, x, random_state=np.random):
+        n = len(self.x)
+        covariance = self.k - np.dot(self.k, np.dot(self.w, np.linalg.solve(np.eye(n) + np.dot(self.k, self.w),
+                                                                             self.k)))
+        covariance = (covariance + covariance.T) / 2.0 + self.jitter * np.eye(n)
+
+        f = self.f + np.dot(np.linalg.cholesky(covariance), random_state.normal(size=n))
+
+        return -np.dot(self.kernel(x, self.x), np.linalg.solve(self.k, f))
+
+
+#
+# helper class:
+# Fits the kernel hyperparameters of the Gaussian Processes in a background thread, so that the marginal likelihood
+# is optimised while the pipeline evaluates the proposed settings instead of before they are proposed. Each GP (the
+# quality, the runtime and the feasibility model) is fitted with the kernel fitted last for it, and a fit of the
+# current data starts in the background; its kernel is swapped in under the lock once it is done. The next round
+# waits for it, so each round uses the kernel fitted on the data of the round before and the proposals are
+# reproducible
+#
+class BackgroundKernelFit(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kernels = {}
+        self.threads = {}
+
+    #
+    # Return a copy of the kernel fitted last for the GP with the given name if it has the hyperparameters of the
+    # given kernel (e.g. the same number of length scales), None otherwise
+    #
+    def get_kernel(self, name, kernel):
+        with self.lock:
+            fitted = self.kernels.get(name)
+
+            if fitted is None or np.shape(fitted.theta) != np.shape(kernel.theta):
+                return None
+
+            return deepcopy(fitted)
+
+    def set_kernel(self, name, kernel):
+        with self.lock:
+            self.kernels[name] = deepcopy(kernel)
+
+    #
+    # Fit the model with its optimizer on x and y in a background thread, with the BLAS and OpenMP thread pools limited
+    # to the given number of threads (unlimited if None); the model must not be used elsewhere
+    #
+    def start(self, name, model, x, y, threads=None):
+        with self.lock:
+            if name in self.threads and self.threads[name].is_alive():
+                return
+
+            thread = threading.Thread(target=self.fit, args=(name, model, np.copy(x), np.copy(y), threads))
+            thread.daemon = True
+            self.threads[name] = thread
+
+        thread.start()
+
+    def fit(self, name, model, x, y, threads=None):
+        try:
+            if threads is None:
+                model.fit(x, y)
+            else:
+                with limit_thread_pools(threads):
+                    model.fit(x, y)
+        except Exception as exception:
+            print("BACKGROUND FIT of the {} model failed: {}".format(name, exception))
+            return
+
+        self.set_kernel(name, model.kernel_)
+
+    #
+    # Wait until the running background fit of the GP with the given name is done, or all of them if no name is given
+    #
+    def wait(self, name=None):
+        with self.lock:
+            threads = [thread for key, thread in self.threads.items() if name is None or key == name]
+
+        for thread in threads:
+            thread.join()
+
+    #
+    # the kernels are only valid for the data of one optimisation
+    #
+    def reset(self):
+        self.wait()
+
+        with self.lock:
+            self.kernels = {}
+            self.threads = {}
+
+
+#
+# helper function:
+# Return the number of threads the models may use by default: the number set for BLAS or OpenMP in the environment,
+# otherwise the cores shared out among the worker processes of CellProfiler, so that workers fitting their models at
+# the same time do not oversubscribe the cores
+#
+def get_default_thread_budget():
+    for name in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+        value = os.environ.get(name, "").strip()
+        if value.isdigit() and int(value) > 0:
+            return int(value)
+
+    workers = 1
+    get_max_workers = getattr(cellprofiler.preferences, "get_max_workers", None)
+    if get_max_workers is not None:
+        workers = max(1, int(get_max_workers()))
+
+    return max(1, multiprocessing.cpu_count() // workers)
+
+
+#
+# helper class:
+# Limits the BLAS and OpenMP thread pools while the models are fitted and predict, with threadpoolctl or else through
+# the C functions of the libraries. The thread pools belong to the whole process, so the fits running at the same time
+# (e.g. a proposal and a background fit, or two modules) share one limit: the smallest of their budgets. A fit asking
+# for fewer threads than the current limit lowers it for all of them; a fit asking for more gets the current limit.
+# The limits are lifted when the last fit ends
+#
+class ThreadPoolLimit(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = 0
+        self.limit = None
+        self.restores = []
+        self.threads = None
+        self.native_pools = None
+
+    #
+    # Limit the thread pools to at most the given number of threads and return the number of threads they use (None if
+    # no thread pool was found)
+    #
+    def enter(self, threads):
+        with self.lock:
+            if self.users == 0 or threads < self.limit:
+                restore, self.threads = self.set_threads(threads)
+                self.restores += [restore]
+                self.limit = threads
+
+            self.users += 1
+
+            return self.threads
+
+    def exit(self):
+        with self.lock:
+            self.users -= 1
+
+            if self.users == 0:
+                for restore in reversed(self.restores):
+                    restore()
+
+                self.restores = []
+                self.limit = None
+                self.threads = None
+
+    #
+    # helper method:
+    # Set the thread pools to the given number of threads; returns a function restoring the previous numbers and the
+    # number of threads the pools use now (None if no thread pool was found)
+    #
+    def set_threads(self, threads):
+        if threadpool_limits is not None:
+            limiter = threadpool_limits(limits=threads)
+
+            pools = threadpool_info()
+            used = max(pool["num_threads"] for pool in pools) if len(pools) > 0 else None
+
+            return (lambda: limiter.__exit__(None, None, None)), used
+
+        pools = self.find_native_pools()
+        previous = [get_threads() for get_threads, _ in pools]
+
+        for _, set_threads in pools:
+            set_threads(threads)
+
+        def restore():
+            for (_, set_threads), previous_threads in zip(pools, previous):
+                set_threads(previous_threads)
+
+        used = max(get_threads() for get_threads, _ in pools) if len(pools) > 0 else None
+
+        return restore, used
+
+    #
+    # helper method:
+    # Return the thread pools of the BLAS and OpenMP libraries loaded in the process as (get, set) pairs of their C
+    # functions, for limiting the thread pools without threadpoolctl. On Linux, the libraries are taken from the memory
+    # map of the process; elsewhere, the libraries bundled with numpy and the ones found by name are tried. The
+    # libraries are looked up once
+    #
+    def find_native_pools(self):
+        if self.native_pools is not None:
+            return self.native_pools
+
+        paths = []
+        if os.path.exists("/proc/self/maps"):
+            with open("/proc/self/maps") as maps:
+                for line in maps:
+                    path = line.split()[-1]
+                    if os.path.isabs(path) and path not in paths and any(
+                            name in os.path.basename(path) for name in NATIVE_THREAD_LIBRARIES):
+                        paths += [path]
+        else:
+            numpy_directory = os.path.dirname(np.__file__)
+            for directory in (os.path.join(numpy_directory, ".libs"), "{}.libs".format(numpy_directory)):
+                if os.path.isdir(directory):
+                    paths += [os.path.join(directory, filename) for filename in sorted(os.listdir(directory))
+                              if any(name in filename for name in NATIVE_THREAD_LIBRARIES)]
+
+            for name in NATIVE_THREAD_LIBRARIES:
+                path = ctypes.util.find_library(re.sub(r"^lib", "", name))
+                if path is not None:
+                    paths += [path]
+
+        self.native_pools = []
+        for path in paths:
+            try:
+                library = ctypes.CDLL(path)
+            except OSError:
+                continue
+
+            for get_name, set_name in NATIVE_THREAD_FUNCTIONS:
+                if hasattr(library, get_name) and hasattr(library, set_name):
+                    get_threads = getattr(library, get_name)
+                    get_threads.restype = ctypes.c_int
+                    set_threads = getattr(library, set_name)
+                    set_threads.argtypes = [ctypes.c_int]
+                    set_threads.restype = None
+                    self.native_pools += [(get_threads, set_threads)]
+
+        return self.native_pools
+
+
+THREAD_POOL_LIMIT = ThreadPoolLimit()
+
+
+#
+# helper function:
+# Return a context in which the BLAS and OpenMP thread pools use at most the given number of threads; it yields the
+# number of threads they use, or None if it is not known (e.g. no thread pool was found)
+#
+@contextlib.contextmanager
+def limit_thread_pools(threads):
+    used = THREAD_POOL_LIMIT.enter(threads)
+    try:
+        yield used
+    finally:
+        THREAD_POOL_LIMIT.exit()
+
+
+#########################
+# Acquisition functions #
+#########################
+
+#
+# Each acquisition function scores all candidates at once from the mean mu and standard deviation sigma the model
+# predicts for them and the best (lowest) quality mu_min; the candidate with the highest score is evaluated next.
+# Further arguments are passed as keywords, so that every function can pick the ones it needs:
+# n_iter (the number of data available), model (the fitted GP), x_active/ y_active (the data the model was fitted
+# on), candidates and random_state (a numpy random generator)
+#
+
+#
+# Expected improvement over the best quality
+#
+def expected_improvement(mu, sigma, mu_min, **kwargs):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = (mu_min - mu) / sigma
+        ei = (mu_min - mu) * norm.cdf(z) + sigma * norm.pdf(z)
+
+    ei[sigma == 0.0] = 0.0  # account for the case where sigma==0 to avoid numerical issues (would be NaN otherwise)
+
+    return ei
+
+
+#
+# Logarithm of the expected improvement, computed without the underflow of EI far away from the best quality: with
+# z = (mu_min - mu) / sigma, log EI = log(sigma) + log(pdf(z) + z * cdf(z)), and for z < -1 the second term is
+# rewritten with the scaled complementary error function erfcx, which does not underflow
+#
+def log_expected_improvement(mu, sigma, mu_min, **kwargs):
+    sigma = np.maximum(sigma, 1e-12)
+    z = (mu_min - mu) / sigma
+
+    log_h = np.empty_like(z)
+
+    upper = z > -1
+    log_h[upper] = np.log(norm.pdf(z[upper]) + z[upper] * norm.cdf(z[upper]))
+
+    lower = ~upper
+    with np.errstate(divide="ignore", invalid="ignore"):
+        bracket = 1.0 / np.sqrt(2 * np.pi) + 0.5 * z[lower] * erfcx(-z[lower] / np.sqrt(2))
+        log_h_lower = -0.5 * z[lower] ** 2 + np.log(bracket)
+
+    #
+    # where the bracket cancels out numerically, use its asymptotic expansion pdf(z) / z^2
+    #
+    asymptotic = -0.5 * z[lower] ** 2 - 0.5 * np.log(2 * np.pi) - 2 * np.log(-z[lower])
+    log_h[lower] = np.where(bracket > 1e-12, log_h_lower, asymptotic)
+
+    return np.log(sigma) + log_h
+
+
+#
+# Probability of improving the best quality by at least PI_MARGIN
+#
+def probability_of_improvement(mu, sigma, mu_min, **kwargs):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pi = norm.cdf((mu_min - PI_MARGIN - mu) / sigma)
+
+    pi[sigma == 0.0] = 0.0
+
+    return pi
+
+
+#
+# Upper confidence bound of the improvement, i.e. the negative lower confidence bound of the quality. The exploration
+# weight kappa decays with the number of rounds, so that the optimisation explores first and exploits later
+#
+def upper_confidence_bound(mu, sigma, mu_min, n_iter=0, **kwargs):
+    kappa = max(UCB_KAPPA * UCB_DECAY ** n_iter, UCB_KAPPA_MIN)
+
+    return -(mu - kappa * sigma)
+
+
+#
+# Thompson sampling: draw one function from the posterior of the model and score the candidates by its negative value.
+# The function is drawn with random Fourier features of the fitted RBF kernel (Bayesian linear regression on
+# THOMPSON_FEATURES features), so that drawing it costs time linear in the number of candidates
+#
+def thompson_sampling(mu, sigma, mu_min, model=None, x_active=None, y_active=None, candidates=None,
+                      random_state=np.random, **kwargs):
+    #
+    # the tree ensemble and the preference model draw their own samples (e.g. one of the trees)
+    #
+    if isinstance(model, (TreeEnsembleSurrogate, PreferenceSurrogate)):
+        return -model.sample(candidates, random_state)
+
+    amplitude = model.kernel_.k1.constant_value
+    length_scales = np.atleast_1d(model.kernel_.k2.length_scale)
+
+    #
+    # random Fourier features phi(x) = sqrt(2 amplitude / M) cos(W x + b) approximate the RBF kernel
+    #
+    num_features = THOMPSON_FEATURES
+    w = random_state.normal(size=(num_features, np.size(candidates, axis=1))) / length_scales
+    b = random_state.uniform(0, 2 * np.pi, size=num_features)
+
+    def features(x):
+        return np.sqrt(2.0 * amplitude / num_features) * np.cos(np.dot(x, w.T) + b)
+
+    #
+    # posterior of the feature weights given the standardised y values; the noise of the model is its alpha
+    #
+    y_mean = np.mean(y_active)
+    y_std = np.std(y_active)
+    if y_std == 0:
+        y_std = 1.0
+
+    noise = max(float(np.max(model.alpha)), 1e-6)
+
+    phi = features(x_active)
+    precision = np.dot(phi.T, phi) + noise * np.eye(num_features)
+    cholesky = np.linalg.cholesky(precision)
+
+    weights_mean = np.linalg.solve(cholesky.T, np.linalg.solve(cholesky, np.dot(phi.T, (y_active - y_mean) / y_std)))
+    weights = weights_mean + np.sqrt(noise) * np.linalg.solve(cholesky.T, random_state.normal(size=num_features))
+
+    return -(np.dot(features(candidates), weights) * y_std + y_mean)
+
+
+#
+# The acquisition functions available in the module. The scale tells how the score is weighed with the probability
+# of a valid evaluation or the predicted runtime: linear scores are multiplied, log scores get the log of the weight
+# added and shifted scores (which can be negative) are shifted to start at 0 before they are multiplied
+#
+Acquisition = collections.namedtuple("Acquisition", ["function", "scale"])
+
+SCALE_LINEAR = "linear"
+SCALE_LOG = "log"
+SCALE_SHIFTED = "shifted"
+
+ACQUISITIONS = collections.OrderedDict([
+    (ACQ_EI, Acquisition(expected_improvement, SCALE_LINEAR)),
+    (ACQ_LOG_EI, Acquisition(log_expected_improvement, SCALE_LOG)),
+    (ACQ_PI, Acquisition(probability_of_improvement, SCALE_LINEAR)),
+    (ACQ_UCB, Acquisition(upper_confidence_bound, SCALE_SHIFTED)),
+    (ACQ_THOMPSON, Acquisition(thompson_sampling, SCALE_SHIFTED))
+])
+
+
+#
+# helper function:
+# Encode setting values x (one column per parameter) as the features the surrogate model is fitted on. Numerical and
+# boolean parameters are standardised with the given mean and standard deviation; categorical parameters are one-hot
+# encoded, so that all their choices are equally far apart for the kernel and the trees split on single choices.
+# Returns the features and, for each feature column, the index of its parameter
+#
+def encode_parameters(x, mean, std, kinds, num_choices):
+    columns = []
+    parameter_index = []
+
+    for i, kind in enumerate(kinds):
+        if kind == PARAM_CHOICE:
+            indices = np.round(x[:, i]).astype(int)
+            columns += [(indices == choice).astype(float) for choice in range(num_choices[i])]
+            parameter_index += [i] * num_choices[i]
+        else:
+            columns += [(x[:, i] - mean[i]) / std[i]]
+            parameter_index += [i]
+
+    return np.column_stack(columns).reshape(len(x), len(parameter_index)), np.array(parameter_index, dtype=int)
+
+
+#
+# helper function:
+# Weigh the acquisition scores of the candidates with positive weights according to the scale of the acquisition
+#
+def weigh_acquisition(scores, weights, scale):
+    if scale == SCALE_LOG:
+        return scores + np.log(np.maximum(weights, 1e-300))
+
+    if scale == SCALE_SHIFTED:
+        scores = scores - np.min(scores)
+
+    return scores * weights
+
+
+#
+# helper function:
+# Return the index of the highest score; ties are broken randomly
+#
+def argmax_random_tie(scores, random_state=np.random):
+    ties = np.flatnonzero(scores == np.max(scores))
+
+    return ties[random_state.randint(len(ties))]
+
+
+#
+# helper function:
+# Return a boolean mask of the rows of objectives (one row per round, one column per objective, lower is better) on
+# the Pareto front, i.e. the rows that no other row is at least as good as in all objectives and better in one.
+# Rows with a non-finite objective are never on the front
+#
+def get_pareto_front(objectives):
+    objectives = np.atleast_2d(objectives)
+    finite = np.all(np.isfinite(objectives), axis=1)
+
+    front = finite.copy()
+    for i in np.flatnonzero(finite):
+        dominating = np.all(objectives[finite] <= objectives[i], axis=1) & \
+            np.any(objectives[finite] < objectives[i], axis=1)
+        front[i] = not np.any(dominating)
+
+    return front
+
+
+#
+# helper function:
+# Return the augmented Tchebycheff scalarisation of the objectives with the given weights (ParEGO): each objective is
+# scaled to [0, 1] over the rounds, then max(w * y) + rho * sum(w * y). Rows with a non-finite objective are NaN
+#
+def scalarise_objectives(objectives, weights, augmentation=PARETO_AUGMENTATION):
+    objectives = np.atleast_2d(objectives)
+    finite = np.all(np.isfinite(objectives), axis=1)
+
+    scalarised = np.full(len(objectives), np.nan)
+    if not np.any(finite):
+        return scalarised
+
+    lower = np.min(objectives[finite], axis=0)
+    spread = np.max(objectives[finite], axis=0) - lower
+    spread[spread == 0] = 1
+
+    weighted = weights * (objectives[finite] - lower) / spread
+    scalarised[finite] = np.max(weighted, axis=1) + augmentation * np.sum(weighted, axis=1)
+
+    return scalarised
+
+
+#
+# helper function:
+# Arrange the columns of x, saved for the dimensions with saved_identities, in the order of identities; columns of
+# dimensions that were not saved are NaN. Without saved identities (a history of an older version), the columns are
+# taken as they are if their number matches
+#
+def map_columns(x, saved_identities, identities):
+    x = np.asarray(x, dtype=float)
+    mapped = np.full((len(x), len(identities)), np.nan)
+
+    if saved_identities is None:
+        return x if np.size(x, axis=1) == len(identities) else mapped
+
+    saved = [tuple(identity) for identity in saved_identities]
+    for j, identity in enumerate(identities):
+        if tuple(identity) in saved:
+            mapped[:, j] = x[:, saved.index(tuple(identity))]
+
+    return mapped
+
+
+#
+# helper class:
+# A lock shared with other processes, e.g. the workers of CellProfiler running the module for other image sets: an
+# exclusive lock on a lock file, held from the first enter to the last exit. The thread lock is taken before it and
+# serialises the threads of this process, so the lock is re-entrant within a thread, like the thread lock
+#
+class InterProcessLock(object):
+
+    def __init__(self, path, thread_lock):
+        self.path = path
+        self.thread_lock = thread_lock
+        self.depth = 0
+        self.lock_file = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+
+        try:
+            if self.depth == 0:
+                if not os.path.isdir(os.path.dirname(self.path)):
+                    os.makedirs(os.path.dirname(self.path))
+
+                self.lock_file = open(self.path, "a+")
+                lock_file(self.lock_file)
+        except:
+            if self.lock_file is not None:
+                self.lock_file.close()
+                self.lock_file = None
+
+            self.thread_lock.release()
+            raise
+
+        self.depth += 1
+
+        return self
+
+    def __exit__(self, exception_type, exception, trace):
+        self.depth -= 1
+
+        try:
+            if self.depth == 0:
+                unlock_file(self.lock_file)
+                self.lock_file.close()
+                self.lock_file = None
+        finally:
+            self.thread_lock.release()
+
+
+#
+# helper function:
+# Take an exclusive lock on an open file, waiting as long as another process holds it
+#
+def lock_file(open_file):
+    if fcntl is not None:
+        fcntl.flock(open_file.fileno(), fcntl.LOCK_EX)
+        return
+
+    #
+    # msvcrt locks a byte at the current position and gives up after 10 seconds, so it is tried until it succeeds
+    #
+    open_file.seek(0)
+    while True:
+        try:
+            msvcrt.locking(open_file.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except IOError:
+            pass
+
+
+#
+# helper function:
+# Release the lock taken by lock_file
+#
+def unlock_file(open_file):
+    if fcntl is not None:
+        fcntl.flock(open_file.fileno(), fcntl.LOCK_UN)
+    else:
+        open_file.seek(0)
+        msvcrt.locking(open_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+#
+# helper function:
+# Replace the file at path with the text in one step: the text is written and synced to a temporary file first and
+# then renamed, so that a crash leaves either the old or the new file behind
+#
+def write_file_atomically(path, text):
+    temporary_path = "{}.tmp".format(path)
+
+    with open(temporary_path, "w") as temporary_file:
+        temporary_file.write(text)
+        temporary_file.flush()
+        os.fsync(temporary_file.fileno())
+
+    try:
+        os.rename(temporary_path, path)
+    except OSError:
+        #
+        # Windows does not rename a file onto an existing one
+        #
+        os.remove(path)
+        os.rename(temporary_path, path)
+
+
+#
+# helper class:
+# The setting values x, the quality y, the runtime t and the validity of each round of optimisation. They are saved in
+# a journal in the output directory so that they persist over the runs of the module: one line of JSON per round,
+# written and synced at once, with everything saved for the round and the settings proposed after it. A crash can
+# only damage the last line, which is dropped when the journal is read again. The file names contain the module number
+# in case the module is used in more than one place of the pipeline.
+# A read-only history (e.g. the one of a previous session used to warm-start) is read without taking its lock and is
+# neither migrated nor repaired, as it belongs to another optimisation
+#
+class OptimisationHistory(object):
+
+    def __init__(self, directory, module_num, signature=None, read_only=False):
+        self.signature = signature
+        self.read_only = read_only
+        self.staged = None
+
+        #
+        # the records read from the journal and the state (inode, size and modification time) of the journal they
+        # were read from
+        #
+        self.records = None
+        self.journal_state = None
+
+        self.path = os.path.join(directory, "history_bo_{}.jsonl".format(module_num))
+        self.lock_path = os.path.join(directory, "history_bo_{}.lock".format(module_num))
+        self.r_path = os.path.join(directory, "r_bo_{}.txt".format(module_num))
+        self.pareto_path = os.path.join(directory, "pareto_bo_{}.txt".format(module_num))
+
+        #
+        # older versions saved each value of a round in a text file of its own; these files are migrated to the
+        # journal the first time it is read
+        #
+        self.x_path = os.path.join(directory, "x_bo_{}.txt".format(module_num))
+        self.y_path = os.path.join(directory, "y_bo_{}.txt".format(module_num))
+        self.t_path = os.path.join(directory, "t_bo_{}.txt".format(module_num))
+        self.v_path = os.path.join(directory, "v_bo_{}.txt".format(module_num))
+        self.p_path = os.path.join(directory, "p_bo_{}.txt".format(module_num))
+        self.c_path = os.path.join(directory, "c_bo_{}.txt".format(module_num))
+        self.s_path = os.path.join(directory, "s_bo_{}.txt".format(module_num))
+        self.g_path = os.path.join(directory, "g_bo_{}.txt".format(module_num))
+
+    #
+    # Add one round: the setting values, the quality measured for them, the wall time in seconds it took to
+    # evaluate them (NaN if the runtime is unknown) and whether the evaluation was valid; an evaluation is invalid if
+    # the settings produced a degenerate segmentation whose quality can not be trusted. In an A/B evaluation, the
+    # preference for the settings over the best ones so far is saved as well (NaN otherwise).
+    # The components are the raw evaluation results y was computed from, so y can be computed again with other
+    # weights (None for rounds without evaluation results). In the multi-task mode, the task (the group of image sets)
+    # the round was evaluated for is saved as well
+    #
+    def append(self, values, y, runtime=np.nan, valid=True, preference=np.nan, components=None, task=None):
+        self.write_record(self.get_record(values, y, runtime, valid, preference, components, task))
+
+    #
+    # Add one round like append, but keep it in memory until commit is called with the settings proposed after it, so
+    # that the round and the proposal are written in one record. Staged rounds are included when the history is loaded
+    #
+    def stage(self, values, y, runtime=np.nan, valid=True, preference=np.nan, components=None, task=None):
+        self.staged = self.get_record(values, y, runtime, valid, preference, components, task)
+
+    def commit(self, proposal=None):
+        if self.staged is None:
+            return
+
+        if proposal is not None:
+            self.staged["proposal"] = [float(v) for v in np.ravel(proposal)]
+
+        record = self.staged
+        self.staged = None
+        self.write_record(record)
+
+    def get_record(self, values, y, runtime, valid, preference, components, task):
+        return {"x": [float(v) for v in values],
+                "identities": self.signature,
+                "y": float(y),
+                "runtime": float(runtime),
+                "valid": bool(valid),
+                "preference": float(preference),
+                "components": components,
+                "task": task,
+                "proposal": None,
+                "relevance": None}
+
+    #
+    # The lock guarding the journal against other threads and processes; rounds that read the history, propose from it
+    # and extend it hold it throughout
+    #
+    @property
+    def lock(self):
+        if self.read_only:
+            return HISTORY_LOCK
+
+        with HISTORY_LOCK:
+            path = os.path.abspath(self.lock_path)
+            if path not in HISTORY_FILE_LOCKS:
+                HISTORY_FILE_LOCKS[path] = InterProcessLock(path, HISTORY_LOCK)
+
+            return HISTORY_FILE_LOCKS[path]
+
+    #
+    # Append a record to the journal and sync it to the disk before returning
+    #
+    def write_record(self, record):
+        with self.lock:
+            records = self.read_journal()
+
+            with open(self.path, "a") as journal:
+                journal.write(json.dumps(record) + "\n")
+                journal.flush()
+                os.fsync(journal.fileno())
+
+            self.records = records + [record]
+            self.journal_state = self.get_journal_state()
+
+    #
+    # Return the records of the journal, the staged round last
+    #
+    def load_records(self):
+        with self.lock:
+            records = self.read_journal()
+
+        if self.staged is not None:
+            records += [self.staged]
+
+        return records
+
+    #
+    # Return the records of the journal. The journal is only read and checked again if it changed since it was read
+    # last (e.g. another module appended a round), so the values of a round are loaded from a single read
+    #
+    def read_journal(self):
+        if self.records is None or self.get_journal_state() != self.journal_state:
+            self.records = self.recover()
+            self.journal_state = self.get_journal_state()
+
+        return list(self.records)
+
+    def get_journal_state(self):
+        if not os.path.exists(self.path):
+            return None
+
+        status = os.stat(self.path)
+
+        return status.st_ino, status.st_size, status.st_mtime
+
+    #
+    # Read the journal and check its records. Damaged records (e.g. a line cut off by a crash) are dropped and the
+    # journal is rewritten without them, so the next round is appended to a valid journal. Text files of an older
+    # version are migrated first
+    #
+    def recover(self):
+        if not self.read_only:
+            self.migrate()
+
+        if not os.path.exists(self.path):
+            return []
+
+        with open(self.path) as journal:
+            text = journal.read()
+
+        records = []
+        damaged = 0
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+
+            if not isinstance(record, dict) or "x" not in record or "y" not in record:
+                damaged += 1
+                continue
+
+            records += [record]
+
+        rewrite = damaged > 0 or (len(text) > 0 and not text.endswith("\n"))
+        if rewrite and not self.read_only:
+            print("HISTORY RECOVERED: {} damaged record(s) dropped from {}".format(damaged, self.path))
+
+        if os.path.exists(self.r_path):
+            self.migrate_relevance(records)
+            rewrite = True
+
+        if self.read_only:
+            return records
+
+        if rewrite:
+            write_file_atomically(self.path, "".join(json.dumps(record) + "\n" for record in records))
+
+        if os.path.exists(self.r_path):
+            os.remove(self.r_path)
+
+        return records
+
+    #
+    # Move the relevance saved in the text file of an older version to the records. The file has one row per proposal
+    # for which the hyperparameters were fitted, i.e. for the last rounds; damaged rows and rows saved for other
+    # dimensions than their round are dropped
+    #
+    def migrate_relevance(self, records):
+        rows = []
+        with open(self.r_path) as r_file:
+            for line in r_file:
+                if not line.strip():
+                    continue
+
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = None
+
+                try:
+                    if isinstance(row, dict):
+                        rows += [(row.get("identities"), [float(r) for r in row["relevance"]])]
+                    else:
+                        rows += [(None, [float(r) for r in line.split()])]
+                except (ValueError, KeyError, TypeError):
+                    continue
+
+        for record, (identities, relevance) in zip(records[len(records) - len(rows):], rows[len(rows) - len(records):]):
+            if identities is None and len(relevance) == len(record["x"]):
+                identities = record.get("identities")
+
+            if identities is not None and identities == record.get("identities"):
+                record["relevance"] = relevance
+
+    #
+    # Move the rounds saved in the text files of an older version to the journal. A crash between the writes to these
+    # files could leave x with one row more than y; such rows were never evaluated completely and are dropped. Files
+    # started by later versions (runtimes, validity, ...) cover the last rounds; earlier rounds get default values
+    #
+    def migrate(self):
+        if os.path.exists(self.path) or not os.path.exists(self.x_path) or not os.path.exists(self.y_path):
+            return
+
+        x = np.loadtxt(self.x_path, ndmin=2)
+        y = np.atleast_1d(np.loadtxt(self.y_path))
+        n = min(len(x), len(y))
+
+        def load_column(path, default, convert):
+            column = [default] * n
+            if os.path.exists(path) and os.path.getsize(path) > 0:
+                with open(path) as column_file:
+                    saved = [convert(line) for line in column_file if line.strip()][:n][-n:]
+                column[n - len(saved):] = saved
+            return column
+
+        t = load_column(self.t_path, np.nan, float)
+        valid = load_column(self.v_path, True, lambda line: float(line) > 0)
+        preferences = load_column(self.p_path, np.nan, float)
+        components = load_column(self.c_path, None, json.loads)
+        tasks = load_column(self.g_path, None, json.loads)
+
+        identities = None
+        if os.path.exists(self.s_path):
+            with open(self.s_path) as s_file:
+                identities = json.load(s_file)
+
+        records = []
+        for i in range(n):
+            records += [{"x": [float(v) for v in x[i]],
+                         "identities": identities,
+                         "y": float(y[i]),
+                         "runtime": float(t[i]),
+                         "valid": bool(valid[i]),
+                         "preference": float(preferences[i]),
+                         "components": components[i],
+                         "task": tasks[i],
+                         "proposal": None,
+                         "relevance": None}]
+
+        write_file_atomically(self.path, "".join(json.dumps(record) + "\n" for record in records))
+
+        for path in (self.x_path, self.y_path, self.t_path, self.v_path, self.p_path, self.c_path, self.s_path,
+                     self.g_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+        print("HISTORY MIGRATED: {} rounds moved to {}".format(n, self.path))
+
+    #
+    # Load the x values as a 2D array with one row per round and the y, t and validity values as 1D arrays.
+    # The x values are arranged for the dimensions of the signature (see load_signature); values of dimensions a round
+    # was not saved for are NaN
+    #
+    def load(self):
+        records = self.load_records()
+        identities = self.load_signature(records)
+
+        x = np.zeros((0, len(identities)))
+        if len(records) > 0:
+            x = np.vstack([map_columns([record["x"]], record.get("identities"), identities) for record in records])
+
+        y = np.array([record["y"] for record in records], dtype=float)
+        t = np.array([record.get("runtime", np.nan) for record in records], dtype=float)
+        valid = np.array([record.get("valid", True) for record in records], dtype=bool)
+
+        return x, y, t, valid
+
+    #
+    # Load the preference of each round; NaN for rounds without an A/B evaluation
+    #
+    def load_preferences(self):
+        return np.array([record.get("preference", np.nan) for record in self.load_records()], dtype=float)
+
+    #
+    # Load the raw evaluation results of each round; None for rounds without them and for rounds saved before the
+    # results were recorded
+    #
+    def load_components(self):
+        return [record.get("components") for record in self.load_records()]
+
+    #
+    # Load the task of each round as a string; empty for rounds without a task
+    #
+    def load_tasks(self):
+        return ["" if record.get("task") is None else record["task"] for record in self.load_records()]
+
+    #
+    # Return the identities of the dimensions the x values are loaded for: the signature of the history if it was
+    # given, otherwise the one the last round was saved with. Without any, the dimensions are only numbered
+    #
+    def load_signature(self, records=None):
+        if self.signature is not None:
+            return self.signature
+
+        if records is None:
+            records = self.load_records()
+
+        if len(records) == 0:
+            return []
+
+        if records[-1].get("identities") is not None:
+            return records[-1]["identities"]
+
+        return [[str(i)] for i in range(len(records[-1]["x"]))]
+
+    #
+    # Return whether every round was saved with the identities of its dimensions
+    #
+    def has_identities(self):
+        return all(record.get("identities") is not None for record in self.load_records())
+
+    #
+    # Return the settings proposed after the last round if they were never evaluated: the given values are still
+    # the ones of the last round (of the same task), e.g. because the pipeline was not saved before a crash.
+    # None otherwise
+    #
+    def load_pending_proposal(self, values, task=None):
+        records = self.load_records()
+        if len(records) == 0 or records[-1].get("proposal") is None or records[-1].get("task") != task:
+            return None
+
+        x = self.load()[0]
+        values = np.asarray(values, dtype=float)
+        proposal = np.array([records[-1]["proposal"]], dtype=float)
+        if np.size(x, axis=1) != len(values) or np.size(proposal) != len(values) or \
+                not np.allclose(x[-1], values, equal_nan=True) or np.allclose(proposal[0], values, equal_nan=True):
+            return None
+
+        return proposal
+
+    #
+    # The relevance of each parameter is saved with the staged round, as the hyperparameters are fitted for the
+    # proposal after it (see stage); without a staged round there is nothing to save it with
+    #
+    def append_relevance(self, relevance):
+        if self.staged is not None:
+            self.staged["relevance"] = [float(r) for r in relevance]
+
+    #
+    # Load the relevance as a 2D array with one row per round for which it was saved and one column per dimension of
+    # the signature. Rows saved for other dimensions (e.g. before a parameter was added or removed) are left out
+    #
+    def load_relevance(self):
+        records = self.load_records()
+        identities = self.load_signature(records)
+        rows = np.zeros((0, len(identities)))
+
+        for record in records:
+            if record.get("relevance") is None:
+                continue
+
+            relevance = map_columns([record["relevance"]], record.get("identities"), identities)
+            if np.all(np.isfinite(relevance)):
+                rows = np.vstack((rows, relevance))
+
+        return rows
+
+    #
+    # The settings on the Pareto front of a multi-objective optimisation are saved with their objectives, one row per
+    # setting; the file is replaced whenever the front changes
+    #
+    def save_pareto_front(self, x, objectives, objective_names):
+        header = " ".join(["x_{}".format(i + 1) for i in range(np.size(x, axis=1))] + objective_names)
+
+        np.savetxt(self.pareto_path, np.hstack((x, objectives)), fmt="%g", header=header)
+
+    def delete(self):
+        with self.lock:
+            self.records = None
+            self.journal_state = None
+
+            for path in (self.path, self.r_path, self.pareto_path, self.x_path, self.y_path, self.t_path, self.v_path,
+                         self.p_path, self.c_path, self.s_path, self.g_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+#
+# Create module class which inherits from cellprofiler.module.Module class
+#
+class BayesianOptimisation(cellprofiler.module.Module):
+
+    #
+    # Declare the name for displaying the module, e.g. in menus 
+    # Declare the category under which it is stored and grouped in the menu
+    # Declare variable revision number which can be used to provide backwards compatibility  if CellProfiler will be
+    # released in a new version
+    #
+    module_name = "BayesianOptimisation"
+    category = "Advanced"
+    variable_revision_number = 14
+
+    #######################################################################
+    # Create and set CellProfiler settings for GUI and Pipeline execution #
+    #######################################################################
+
+    #
+    # Define the setting's data types and grouped elements
+    #
+    def create_settings(self):
+        module_explanation = [
+            "This module uses BayesianOptimisation on parameters (settings) chosen from modules placed before this "
+            "module in the pipeline. Step 1: Choose the object which you have evaluated in the evaluation modules. "
+            "The Bayesian module considers these measures as quality indicators. Step 2: Choose the parameters "
+            "(settings) to be adjusted. Bayesian Optimisation will be executed if required quality thresholds/ranges "
+            "are not met. If an AutomatedEvaluation modue is placed beforehand, the final output of the autoevaluation"
+            "will be displayed and can be evaluated by the user."]
+
+        #
+        # Notes will appear in the notes-box of the module
+        #
+        self.set_notes([" ".join(module_explanation)])
+
+        #
+        # Object identified in upstream IndentifyObjects module; accessible via ObjectNameSubscriber
+        #
+        self.input_object_name = cellprofiler.setting.ObjectNameSubscriber(
+            "Input object name",
+            cellprofiler.setting.NONE,
+            doc="""\
+These are the objects that the module operates on."""
+        )
+
+        #
+        # The number of evaluation modules as input for BayesianModule;
+        # necessary for prepare_settings method
+        #
+        self.count1 = cellprofiler.setting.Integer(
+                'No. of evaluation modules',
+                1,
+                minval=1,
+                maxval=2,
+                doc="""\
+No. of evaluation modules before BayesianModule."""
+            )
+
+        #
+        # The number of parameters to be adjusted by BayesianModule;
+        # necessary for prepare_settings method
+        #
+        self.count2 = cellprofiler.setting.Integer(
+            'No. of settings to be adjusted',
+            2,
+            minval=1,
+            maxval=4,
+            doc="""\
+No. of settings that should be adjusted by BayesianModule. You can choose up to 4 settings."""
+        )
+
+        #
+        # Group of measurements made for the object by a Measurements module
+        #
+        self.measurements = []
+
+        #
+        # Add first measurement which cannot be deleted; there must be at least one
+        #
+        self.add_measurement(can_delete=False)
+
+        #
+        # Button for adding additional measurements; calls add_measurement helper function
+        #
+        self.add_measurement_button = cellprofiler.setting.DoSomething(
+            "", "Add another measurement", self.add_measurement)
+
+        self.spacer = cellprofiler.setting.Divider(line=True)
+
+        #
+        # The weighting in % for the automated evaluation results
+        #
+        self.weighting_auto = cellprofiler.setting.Integer(
+            'Weighting of automated evaluation score (%)',
+            50,
+            minval=0,
+            maxval=100,
+            doc="""\
+The weighting of the automated evaluation results in comparison to manual evaluation."""
+        )
+
+        #
+        # The weighting in % for the manual evaluation results
+        #
+        self.weighting_manual = cellprofiler.setting.Integer(
+            'Weighting of manual evaluation score (%)',
+            50,
+            minval=0,
+            maxval=100,
+            doc="""\
+The weighting of the manual evaluation result in comparison to automated evaluation."""
+        )
+
+
+        self.spacer6 = cellprofiler.setting.Divider(line=True)
+
+        #
+        # The maximum number of iterations for the Bayesian Optimisation
+        #
+        self.max_iter = cellprofiler.setting.Integer(
+            'Max. iterations for Bayesian Optimisation',
+            150,
+            minval=2,
+            maxval=10000,
+            doc="""\
+Define the maximum number of iterations the Bayesian Optimisation should run. The minimum number is 2, 
+recommended iterations are 50 - 200, depending on the problem to be solved. """
+        )
+
+        #
+        # The length scale for the Bayesian Optimisation kernel function
+        #
+        self.length_scale = cellprofiler.setting.Float(
+            'Length scale for Bayesian Optimisation kernel function',
+            0.1,
+            minval=0,
+            maxval=1000,
+            doc="""\
+Define the length scale for the kernel function of the Bayesian Optimisation model. The value influences the
+smoothness of the objective kernel function. A larger value indicates a smoother function."""
+        )
+
+        #
+        # The alpha value for the Bayesian Optimisation model
+        #
+        self.alpha = cellprofiler.setting.Float(
+            'Alpha for Bayesian Optimisation model',
+            0.01,
+            minval=0,
+            maxval=1000,
+            doc="""\
+Define the alpha value for the GaussianProcessRegressor model. A low value indicates low noise in the data."""
+        )
+
+        #
+        # Choose the surrogate model of the quality
+        #
+        self.surrogate = cellprofiler.setting.Choice(
+            'Surrogate model',
+            [SURROGATE_GP, SURROGATE_TREES],
+            value=SURROGATE_GP,
+            doc="""\
+Choose the model that predicts the quality of untested settings:
+
+-  *Gaussian process:* A smooth model that works best for continuous settings such as thresholds and sizes.
+-  *Extremely randomised trees:* An ensemble of randomised regression trees; the spread of their predictions 
+   measures the uncertainty. It copes better with discrete and categorical settings and stays fast with a long 
+   history. The trees are fitted and evaluated on all cores."""
+        )
+
+        #
+        # Choose the acquisition function deciding which candidate is evaluated next
+        #
+        self.acquisition = cellprofiler.setting.Choice(
+            'Acquisition function',
+            list(ACQUISITIONS.keys()),
+            value=ACQ_EI,
+            doc="""\
+Choose how the next settings are selected from the candidates:
+
+-  *Expected improvement:* The candidate with the highest expected improvement over the best quality so far.
+-  *Log expected improvement:* The same as expected improvement, but computed on a log scale, so that candidates 
+   can still be told apart when the expected improvement of all of them is tiny.
+-  *Probability of improvement:* The candidate most likely to improve the best quality. This exploits more than 
+   expected improvement.
+-  *Upper confidence bound:* The candidate with the best optimistic estimate of its quality. The optimism decays 
+   over the rounds, so that the optimisation explores first and exploits later.
+-  *Thompson sampling:* The best candidate of a function drawn at random from the model."""
+        )
+
+        #
+        # Choose whether the evaluation results are optimised as separate objectives
+        #
+        self.multi_objective = cellprofiler.setting.Binary(
+            'Optimise the evaluation results as separate objectives',
+            False,
+            doc="""\
+Select *Yes* to treat the manual quality and the deviation of each measurement of the automated evaluation as 
+separate objectives instead of one weighted sum. Each round optimises a random trade-off between them (ParEGO), so 
+that the rounds explore the whole Pareto front: the settings that can not be improved in one objective without 
+getting worse in another. The front is saved to the output directory after each round. The weights then only decide 
+which settings of the front are shown as the best ones, and can be changed after the optimisation. The batch 
+optimisation runner (bayesopt_batch.py) does not support this mode."""
+        )
+
+        #
+        # Choose whether the kernel hyperparameters are fitted while the pipeline runs
+        #
+        self.background_fit = cellprofiler.setting.Binary(
+            'Fit the model hyperparameters in the background',
+            True,
+            doc="""\
+Fitting the hyperparameters of the Gaussian Process (its length scales) is the slowest part of a round. Select *Yes* 
+to propose the next settings right away with the hyperparameters fitted last, while they are fitted to the current 
+data in the background during the evaluation of the proposed settings; the next round waits for them. Select *No* 
+to fit them to the current data before each proposal."""
+        )
+
+        #
+        # Choose how many threads the linear algebra libraries may use while the model is fitted and predicts
+        #
+        self.thread_budget = cellprofiler.setting.Integer(
+            'Threads for fitting the model',
+            0,
+            minval=0,
+            maxval=1024,
+            doc="""\
+The maximum number of threads the linear algebra libraries (BLAS, OpenMP) and the tree ensemble use while the model is 
+fitted and predicts. When CellProfiler runs several worker processes, each library would otherwise start one thread 
+per core in every worker, and the oversubscribed cores make the rounds slower than a single thread would. Enter 0 to 
+use the number of threads set in the environment (e.g. *OMP_NUM_THREADS*), or else the cores divided by the number 
+of worker processes. The number of threads used is saved as the image measurement *{}_{}*. The threads are limited 
+with the threadpoolctl package if it is installed, otherwise through the C functions of OpenBLAS, MKL and 
+OpenMP.""".format(CATEGORY, THREADS)
+        )
+
+        #
+        # Choose whether the groups of image sets are optimised as related tasks
+        #
+        self.multi_task = cellprofiler.setting.Binary(
+            'Optimise groups of image sets as related tasks',
+            False,
+            doc="""\
+Select *Yes* to optimise the settings for each group of image sets (e.g. each plate or well) separately, while the 
+evaluations of all groups inform each other. The model learns how similar the groups are, so each group gets 
+well-tuned settings with far fewer evaluations than separate optimisations. The best settings shown are the ones of 
+the group of the current image set."""
+        )
+
+        #
+        # Choose the metadata measurement that groups the image sets into tasks
+        #
+        self.task_metadata = cellprofiler.setting.Measurement(
+            'Metadata defining the groups',
+            lambda: cellprofiler.measurement.IMAGE,
+            doc="""\
+Choose the image measurement, typically a metadata measurement such as *Metadata_Plate* or *Metadata_Well*, whose 
+value tells which group an image set belongs to."""
+        )
+
+        #
+        # Choose whether the expected improvement is weighed against the predicted runtime of the candidates
+        #
+        self.cost_aware = cellprofiler.setting.Binary(
+            'Cost-aware acquisition (EI per second)',
+            False,
+            doc="""\
+Select *Yes* to divide the expected improvement of each candidate by the runtime predicted for it. The optimisation
+then prefers settings that are cheap to evaluate and avoids settings that make the adjusted modules very slow (e.g.
+thresholds yielding thousands of objects). The runtimes are modelled once at least 3 of them were measured."""
+        )
+
+        #
+        # Choose whether parameters which hardly affect the quality are frozen at their best value
+        #
+        self.freeze_inert = cellprofiler.setting.Binary(
+            'Freeze parameters with low relevance',
+            False,
+            doc="""\
+The model learns one length scale per parameter, from which the relevance of each parameter for the quality is 
+derived (the relevances add up to 1). Select *Yes* to freeze parameters whose relevance stays below a threshold 
+for a number of rounds at their best value so far. This shrinks the search space to the parameters that matter. 
+The most relevant parameter is never frozen."""
+        )
+
+        self.relevance_threshold = cellprofiler.setting.Float(
+            'Relevance threshold',
+            0.05,
+            minval=0,
+            maxval=1,
+            doc="""\
+Parameters with a relevance below this threshold are frozen."""
+        )
+
+        self.freeze_rounds = cellprofiler.setting.Integer(
+            'Rounds below threshold before freezing',
+            5,
+            minval=1,
+            maxval=10000,
+            doc="""\
+The number of consecutive rounds the relevance of a parameter has to stay below the threshold before it is frozen."""
+        )
+
+        #
+        # Choose whether one round of optimisation is done per run or whether the module loops itself
+        #
+        self.optimisation_mode = cellprofiler.setting.Choice(
+            'Optimisation mode',
+            [MODE_INTERACTIVE, MODE_IN_PROCESS],
+            value=MODE_INTERACTIVE,
+            doc="""\
+Choose how the optimisation proceeds:
+
+-  *Interactive (one round per run):* One round of optimisation is done each time the module runs. In Test mode,
+   CellProfiler re-runs the pipeline from the first adjusted module with the new settings when you step on.
+-  *In-process loop:* The module re-runs the adjusted modules up to this module itself until the quality is
+   satisfied, the optimisation stops improving or the max. number of iterations is reached. Only modules whose
+   settings or inputs changed are executed again. This mode needs no user interaction, so it can be used in headless
+   runs (cellprofiler -c), but it can not be used with a ManualEvaluation."""
+        )
+
+        #
+        # The number of rounds without improvement after which the in-process loop stops
+        #
+        self.convergence_rounds = cellprofiler.setting.Integer(
+            'Stop after rounds without improvement',
+            20,
+            minval=0,
+            maxval=10000,
+            doc="""\
+The in-process loop stops when the quality has not improved for this number of rounds. Set it to 0 to only stop 
+when the max. number of iterations is reached."""
+        )
+
+        #
+        # The memory budget for module outputs cached during the in-process loop
+        #
+        self.cache_budget = cellprofiler.setting.Integer(
+            'Memory for cached module outputs (MB)',
+            CACHE_MEMORY_BUDGET // (1024 * 1024),
+            minval=0,
+            maxval=1000000,
+            doc="""\
+Outputs of the adjusted modules are cached during the in-process loop, so that modules whose settings and inputs did 
+not change are not executed again. The least recently used outputs are dropped when this budget is exceeded."""
+        )
+
+        #
+        # The time and object-count budget of one evaluation in the in-process loop
+        #
+        self.time_budget = cellprofiler.setting.Float(
+            'Time budget per evaluation (s)',
+            0,
+            minval=0,
+            maxval=100000,
+            doc="""\
+Settings that make the adjusted modules very slow (e.g. a tiny minimum diameter) can stall the optimisation. An 
+evaluation taking longer than this budget is aborted after the module that exceeded it and recorded as failed. 
+Set it to 0 for no limit. The batch optimisation runner also uses this budget as a hard timeout per evaluation."""
+        )
+
+        self.object_budget = cellprofiler.setting.Integer(
+            'Max. objects per evaluation',
+            0,
+            minval=0,
+            maxval=100000000,
+            doc="""\
+An evaluation is aborted and recorded as failed as soon as a module identifies more objects than this budget, so 
+that the measurement modules do not spend minutes on thousands of fragments. Set it to 0 for no limit."""
+        )
+
+        #
+        # Reject evaluations as soon as the number of input objects is implausible
+        #
+        self.reject_implausible = cellprofiler.setting.Binary(
+            'Reject implausible object counts',
+            False,
+            doc="""\
+Select *Yes* to check the number of input objects right after the module that identifies them. If the number is 
+outside the plausible range, the segmentation is clearly useless: the evaluation is recorded as failed with the worst 
+quality seen so far and the measurement and evaluation modules are not run for it. This saves most of the time spent 
+on bad exploratory settings. The check is done in the in-process loop and by the batch optimisation runner."""
+        )
+
+        self.plausible_count = cellprofiler.setting.IntegerRange(
+            'Plausible number of objects',
+            (1, 10000),
+            minval=0,
+            doc="""\
+The range of input object counts a useful segmentation of an image can have."""
+        )
+
+        self.spacer4 = cellprofiler.setting.Divider(line=True)
+
+        self.parameters = []
+
+        #
+        # Add first parameter which cannot be deleted; there must be at least one
+        #
+        self.add_parameter(can_remove=False)
+
+        #
+        # Button for adding additional parameters; calls add_parameter helper function
+        #
+        self.add_param_button = cellprofiler.setting.DoSomething("", "Add parameter", self.add_parameter)
+
+        self.spacer2 = cellprofiler.setting.Divider(line=True)
+
+        #
+        # Button for refreshing the GUI; calls refreshGUI helper function
+        # This is necessary as the choices_fn function does not work without
+        # refreshing the GUI if new groups were added
+        #
+        self.refresh_button = cellprofiler.setting.DoSomething(
+            "",
+            "Refresh GUI",
+            self.refreshGUI,
+            doc = """\
+If the dropdown menus are not updated, you can update them again with this button."""
+        )
+
+        self.spacer3 = cellprofiler.setting.Divider(line=True)
+
+        #
+        # Output directory chooser;
+        # x and y values of previous Optimisation rounds will be saved in files in this directory
+        #
+        self.pathname = cellprofiler.setting.DirectoryPath(
+            "Output file location",
+            dir_choices=[
+                cellprofiler.preferences.DEFAULT_OUTPUT_FOLDER_NAME,
+                cellprofiler.preferences.DEFAULT_INPUT_FOLDER_NAME,
+                cellprofiler.preferences.ABSOLUTE_FOLDER_NAME,
+                cellprofiler.preferences.DEFAULT_OUTPUT_SUBFOLDER_NAME,
+                cellprofiler.preferences.DEFAULT_INPUT_SUBFOLDER_NAME],
+            doc="""\
+Choose the directory where Optimisation data is saved. """
+        )
+
+        self.spacer5 = cellprofiler.setting.Divider(line=False)
+
+        #
+        # Button for deleting existing files storing values from previous runs
+        #
+        self.delete_button = cellprofiler.setting.DoSomething(
+            "",
+            "Delete previous Data",
+            self.delete_data,
+            doc="""\
+If there is previously gathered data saved in a file you can choose to delete it. The best outlines so far of an A/B
+evaluation are kept by the **ManualEvaluation** module; delete them there as well."""
+        )
+
+        #
+        # Warm-start the optimisation from the histories of previous sessions
+        #
+        self.warm_start = cellprofiler.setting.Binary(
+            'Warm-start from previous sessions',
+            False,
+            doc="""\
+Select *Yes* to use the data gathered by previous optimisation sessions, e.g. on other plates imaged with the same 
+pipeline. Every session saved in the chosen directory or its subdirectories that optimised the same settings of the 
+same modules is used. Its valid rounds are added to the model as less certain observations, so that the optimisation 
+starts from what is known about the quality instead of random settings. Previous sessions are not used in the 
+multi-objective mode or with an A/B evaluation."""
+        )
+
+        self.warm_start_directory = cellprofiler.setting.DirectoryPath(
+            "Previous sessions location",
+            dir_choices=[
+                cellprofiler.preferences.DEFAULT_OUTPUT_FOLDER_NAME,
+                cellprofiler.preferences.DEFAULT_INPUT_FOLDER_NAME,
+                cellprofiler.preferences.ABSOLUTE_FOLDER_NAME,
+                cellprofiler.preferences.DEFAULT_OUTPUT_SUBFOLDER_NAME,
+                cellprofiler.preferences.DEFAULT_INPUT_SUBFOLDER_NAME],
+            doc="""\
+Choose the directory the output files of previous sessions are saved in. The directory of the current session is 
+searched as well, but its own history is not used twice."""
+        )
+
+        self.warm_start_weight = cellprofiler.setting.Float(
+            'Weight of previous rounds',
+            WARM_START_WEIGHT,
+            minval=0.01,
+            maxval=1,
+            doc="""\
+The weight of a round of a previous session relative to a round of the current session. The noise (alpha) assumed 
+for the previous rounds is alpha divided by this weight; with 1, they count as much as the current ones."""
+        )
+
+    #
+    # helper function:
+    # add the quality measurements which should be considered by B.O.
+    # add a remove-button for all measurements except a mandatory one
+    #
+    def add_measurement(self, can_delete=True):
+        group = cellprofiler.setting.SettingsGroup()
+
+        #
+        # Dropdown selection for measurements taken for the object
+        #
+        group.append(
+            "evaluation_measurement",
+            cellprofiler.setting.Measurement(
+                "Select measurements for evaluation",
+                self.input_object_name.get_value,
+                "Evaluation_Deviation",
+                doc="""\
+See the **Measurements** modules help pages for more information on the
+features measured."""
+
+            )
+        )
+
+        self.measurements.append(group)
+
+        if can_delete:
+            group.append(
+                "remover",
+                cellprofiler.setting.RemoveSettingButton(
+                    "",
+                    "Remove this measurement",
+                    self.measurements, group
+                )
+            )
+
+    #
+    # helper function:
+    # add parameters grouped with corresponding modules
+    # add a remove-button for all parameters except a mandatory one
+    #
+    def add_parameter(self, can_remove=True):
+
+        group = cellprofiler.setting.SettingsGroup()
+
+        if can_remove:
+            group.append("divider", cellprofiler.setting.Divider(line=False))
+
+        #
+        # Dropdown selection for modules (IdentifyObjects modules)
+        #
+        group.append("module_names", cellprofiler.setting.Choice(
+            "Select module",
+            choices=[""],
+            choices_fn=self.get_module_list,
+            doc="""\
+This is the module where Bayesian Optimisation will adjust settings
+"""
+        ))
+
+        #
+        # Dropdown selection for parameters of the selected modules
+        #
+        group.append("parameter_names", cellprofiler.setting.Choice(
+            "Select parameter",
+            choices=[""],
+            choices_fn=self.get_settings_from_modules,
+            doc="""\
+These are the settings to be adjusted by Bayesian Optimisation
+"""
+        ))
+
+        #
+        # The parameters will be adjusted within this range
+        #
+        group.append(
+            "range",
+            cellprofiler.setting.FloatRange(
+                'Set min and max boundaries for variation',
+                (1.00, 100.00),
+                minval=00.00,
+                maxval=1000.00,
+                doc="""\
+The Bayesian Optimisation will vary the parameter within this range of candidates. Please note that the lower
+bound is inclusive, the upper bound is exclusive. For a range setting (e.g. the diameter of objects), both its min 
+and its max are varied within this range, keeping the min below the max. Choice and Yes/No settings are varied over 
+all their choices and ignore this range."""
+            )
+        )
+
+        #
+        # The parameters will be adjusted within this range
+        #
+        group.append(
+            "steps",
+            cellprofiler.setting.Float(
+                'Set steps between boundaries',
+                0.1,
+                minval=00.00,
+                maxval=10.00,
+                doc="""\
+The variation steps within the chosen range for choosing a candidate set. Integer settings are varied in steps of 
+at least 1."""
+            )
+        )
+
+        #
+        # Optional prior knowledge about where good values of the parameter lie
+        #
+        group.append(
+            "prior_value",
+            cellprofiler.setting.Text(
+                'Preferred value (optional)',
+                "",
+                doc="""\
+If you know roughly where good values of this parameter lie (e.g. from previous plates), enter the preferred value 
+here: a number, two comma-separated numbers (min, max) for a range setting, or the name of a choice (Yes/No for a 
+Yes/No setting). The first rounds then try settings close to it more often and the optimisation favours them. The 
+influence of the preferred value decays as evaluations accumulate, so a wrong guess is overruled by the data. Leave 
+empty if you have no preference."""
+            )
+        )
+
+        group.append(
+            "prior_confidence",
+            cellprofiler.setting.Float(
+                'Confidence in the preferred value',
+                PRIOR_CONFIDENCE,
+                minval=0.0,
+                maxval=PRIOR_CONFIDENCE_MAX,
+                doc="""\
+How confident you are that good values lie close to the preferred value, from 0 (hardly) to {} (very). For a 
+numerical parameter, the confidence narrows the range around the preferred value that is favoured; for a choice, it 
+is the extra probability given to the preferred choice.""".format(PRIOR_CONFIDENCE_MAX)
+            )
+        )
+
+        if can_remove:
+            group.append("remover",
+                         cellprofiler.setting.RemoveSettingButton("", "Remove parameter", self.parameters, group))
+
+        self.parameters.append(group)
+
+    #
+    # setting_values are stored as unicode strings in the pipeline file.
+    # If the module has settings groups, it needs to be ensured that settings() returns the correct
+    # number of settings as saved in the file.
+    # To do so, look at the number of setting values before settings() is called to determine how many to return.
+    # Add groups if necessary.
+    #
+    def prepare_settings(self, setting_values):
+
+        #
+        # No. of measurements in measurements group
+        #
+        count1 = int(setting_values[1])
+
+        #
+        # No. of parameters in parameters group
+        #
+        count2 = int(setting_values[2])
+
+        #
+        # Handle adding measurements
+        #
+        num_settings_1 = (len(setting_values) - NUM_FIXED_SETTINGS - NUM_GROUP2_SETTINGS*count2) / NUM_GROUP1_SETTINGS
+
+        if len(self.measurements) == 0:
+            self.add_measurement(False)
+        elif len(self.measurements) > num_settings_1:
+            del self.measurements[num_settings_1:]
+        else:
+            for i in range(len(self.measurements), num_settings_1):
+                self.add_measurement()
+
+        #
+        # Handle adding parameters
+        #
+        num_settings_2 = (len(setting_values) - NUM_FIXED_SETTINGS - NUM_GROUP1_SETTINGS * count1) / NUM_GROUP2_SETTINGS
+
+        if len(self.parameters) == 0:
+            self.add_parameter(False)
+        elif len(self.parameters) > num_settings_2:
+            del self.parameters[num_settings_2:]
+        else:
+            for i in range(len(self.parameters), num_settings_2):
+                self.add_parameter()
+
+    #  
+    # CellProfiler must know about the settings in the module.
+    # This method returns the settings in the order that they will be loaded and saved from a pipeline or project file.
+    # Accessing setting members of a group of settings requires looping through the group result list
+    #
+    def settings(self):
+        result = [self.input_object_name]
+        result += [self.count1, self.count2]
+        result += [self.weighting_manual, self.weighting_auto]
+        for m in self.measurements:
+            result += [m.evaluation_measurement]
+        result += [self.max_iter, self.length_scale, self.alpha]
+        for p in self.parameters:
+            result += [p.module_names, p.parameter_names, p.range, p.steps, p.prior_value, p.prior_confidence]
+        result += [self.pathname]
+        result += [self.optimisation_mode, self.convergence_rounds, self.cache_budget]
+        result += [self.cost_aware]
+        result += [self.time_budget, self.object_budget]
+        result += [self.reject_implausible, self.plausible_count]
+        result += [self.freeze_inert, self.relevance_threshold, self.freeze_rounds]
+        result += [self.acquisition, self.surrogate]
+        result += [self.multi_objective]
+        result += [self.warm_start, self.warm_start_directory, self.warm_start_weight]
+        result += [self.multi_task, self.task_metadata]
+        result += [self.background_fit]
+        result += [self.thread_budget]
+
+        return result
+
+    #  
+    # returns what the user should see in the GUI
+    # include buttons and dividers which are not added in the settings method
+    #
+    def visible_settings(self):
+        result = [self.input_object_name]
+        result += [self.count1]
+        for mod in self.measurements:
+            result += [mod.evaluation_measurement]
+            if hasattr(mod, "remover"):
+                result += [mod.remover]
+        result += [self.add_measurement_button, self.spacer, self.weighting_auto, self.weighting_manual, self.spacer6,
+                   self.max_iter, self.length_scale, self.alpha, self.surrogate]
+        if self.surrogate.value == SURROGATE_GP:
+            result += [self.background_fit]
+        result += [self.thread_budget, self.acquisition, self.multi_objective, self.multi_task]
+        if self.multi_task.value:
+            result += [self.task_metadata]
+        result += [self.cost_aware, self.freeze_inert]
+        if self.freeze_inert.value:
+            result += [self.relevance_threshold, self.freeze_rounds]
+        result += [self.optimisation_mode]
+        if self.optimisation_mode.value == MODE_IN_PROCESS:
+            result += [self.convergence_rounds, self.cache_budget, self.time_budget, self.object_budget,
+                       self.reject_implausible]
+            if self.reject_implausible.value:
+                result += [self.plausible_count]
+        result += [self.spacer4]
+        result += [self.count2]
+        for param in self.parameters:
+            if hasattr(param, "divider"):
+                result += [param.divider]
+            result += [param.module_names, param.parameter_names, param.range, param.steps, param.prior_value]
+            if param.prior_value.value.strip() != "":
+                result += [param.prior_confidence]
+            if hasattr(param, "remover"):
+                result += [param.remover]
+        result += [self.add_param_button, self.spacer2, self.refresh_button,
+                   self.spacer3, self.pathname, self.spacer5, self.delete_button, self.warm_start]
+        if self.warm_start.value:
+            result += [self.warm_start_directory, self.warm_start_weight]
+
+        return result
+
+    #
+    # upgrade settings saved with an earlier revision of the module;
+    # new settings are appended to the end of the settings with their default values
+    #
+    def upgrade_settings(self, setting_values, variable_revision_number, module_name, from_matlab):
+        if variable_revision_number == 1:
+            setting_values = setting_values + [MODE_INTERACTIVE, "20", str(CACHE_MEMORY_BUDGET // (1024 * 1024))]
+            variable_revision_number = 2
+
+        if variable_revision_number == 2:
+            setting_values = setting_values + [cellprofiler.setting.NO]
+            variable_revision_number = 3
+
+        if variable_revision_number == 3:
+            setting_values = setting_values + ["0", "0"]
+            variable_revision_number = 4
+
+        if variable_revision_number == 4:
+            setting_values = setting_values + [cellprofiler.setting.NO, "1,10000"]
+            variable_revision_number = 5
+
+        if variable_revision_number == 5:
+            setting_values = setting_values + [cellprofiler.setting.NO, "0.05", "5"]
+            variable_revision_number = 6
+
+        if variable_revision_number == 6:
+            setting_values = setting_values + [ACQ_EI]
+            variable_revision_number = 7
+
+        if variable_revision_number == 7:
+            setting_values = setting_values + [SURROGATE_GP]
+            variable_revision_number = 8
+
+        #
+        # the prior settings are part of each parameter group; insert them after the 4 settings of each parameter
+        #
+        if variable_revision_number == 8:
+            count1 = int(setting_values[1])
+            count2 = int(setting_values[2])
+            first = 5 + count1 + 3
+
+            parameter_values = []
+            for i in range(count2):
+                parameter_values += setting_values[first + 4 * i:first + 4 * (i + 1)] + ["", str(PRIOR_CONFIDENCE)]
+
+            setting_values = setting_values[:first] + parameter_values + setting_values[first + 4 * count2:]
+            variable_revision_number = 9
+
+        if variable_revision_number == 9:
+            setting_values = setting_values + [cellprofiler.setting.NO]
+            variable_revision_number = 10
+
+        if variable_revision_number == 10:
+            setting_values = setting_values + [cellprofiler.setting.NO, self.warm_start_directory.value,
+                                               str(WARM_START_WEIGHT)]
+            variable_revision_number = 11
+
+        if variable_revision_number == 11:
+            setting_values = setting_values + [cellprofiler.setting.NO, cellprofiler.setting.NONE]
+            variable_revision_number = 12
+
+        if variable_revision_number == 12:
+            setting_values = setting_values + [cellprofiler.setting.YES]
+            variable_revision_number = 13
+
+        if variable_revision_number == 13:
+            setting_values = setting_values + ["0"]
+            variable_revision_number = 14
+
+        return setting_values, variable_revision_number, from_matlab
+
+    #
+    # check that every parameter chosen by the user can be found in its module, that the in-process loop is not
+    # combined with a manual evaluation and that A/B comparisons are not combined with other evaluation results
+    #
+    def validate_module(self, pipeline):
+        self.compile_binding_plan(pipeline)
+
+        #
+        # the optimisation learns from the comparisons only, so other evaluation results would be ignored
+        #
+        if self.uses_preferences():
+            for m in self.measurements:
+                if m.evaluation_measurement.value_text != PREFERENCE_FEATURE:
+                    raise cellprofiler.setting.ValidationError(
+                        "The A/B comparisons ({}) can not be combined with other evaluation results".format(
+                            PREFERENCE_FEATURE), m.evaluation_measurement)
+
+        if self.optimisation_mode.value == MODE_IN_PROCESS:
+            for m in self.measurements:
+                if m.evaluation_measurement.value_text in ("Evaluation_ManualQuality", PREFERENCE_FEATURE):
+                    raise cellprofiler.setting.ValidationError(
+                        "The manual evaluation needs user interaction and can not be used in the in-process loop",
+                        self.optimisation_mode)
+
+    #
+    # CellProfiler calls "prepare_run" once before the image sets are processed;
+    # compile the binding plan here so that run does not have to look up the settings again for every image set
+    #
+    def prepare_run(self, workspace):
+        self.binding_plan = self.compile_binding_plan(workspace.get_pipeline())
+
+        return True
+
+    ###################################################################
+    # Run method will be executed in a worker thread of the pipeline #
+    ###################################################################
+
+    #
+    # CellProfiler calls "run" on each image set in the pipeline
+    # The workspace as input parameter contains the state of the analysis so far
+    #
+    def run(self, workspace):
+
+        #
+        # get the pipeline object which saves the setting parameters
+        #
+        pipeline = workspace.get_pipeline()
+
+        #
+        # get the binding plan holding the modules and settings chosen by the user
+        #
+        binding_plan = self.get_binding_plan(pipeline)
+
+        #
+        # the history of previous rounds is saved in files in the output directory, with its columns keyed by the
+        # settings of the binding plan
+        #
+        history = self.get_history(binding_plan)
+
+        #
+        # the time the adjusted modules took with the current settings; NaN if CellProfiler did not measure it
+        #
+        runtime = self.get_segment_runtime(workspace.measurements, self.get_segment(pipeline, binding_plan))
+
+        #
+        # in the in-process mode, the module re-runs the adjusted modules itself until the optimisation stops
+        #
+        if self.optimisation_mode.value == MODE_IN_PROCESS:
+            with history.lock:
+                self.run_in_process(workspace, binding_plan)
+            return
+
+        number_of_params = len(binding_plan)
+
+        # the lists operate with indices; an index corresponds to a certain setting in a module
+        target_setting_names_list = binding_plan.names          # saves setting names
+        target_setting_values_list = binding_plan.get_values()  # saves setting values of the selected settings
+        target_setting_range = binding_plan.ranges              # saves the ranges in which the values shall vary
+        target_setting_steps = binding_plan.steps               # saves the steps the range can vary
+
+        #
+        # save the quality measurements and determine whether optimisation is needed or not
+        #
+        manual_evaluation_result, auto_evaluation_results, optimisation_on = \
+            self.get_evaluation_results(workspace.measurements)
+
+        valid = self.is_valid_evaluation(workspace.measurements, manual_evaluation_result, auto_evaluation_results)
+
+        preference = self.get_preference(workspace.measurements)
+
+        components = self.get_components(pipeline, manual_evaluation_result, auto_evaluation_results)
+
+        task = self.get_task(workspace.measurements)
+
+        #
+        # the relevance of the parameters, filled in by the optimisation once the model hyperparameters are fitted
+        #
+        report = {}
+
+        #
+        # in an A/B evaluation, a comparison the user did not answer (the window was closed) is skipped: nothing is
+        # recorded and the settings stay the same, so they are compared again with the next image set
+        #
+        if self.uses_preferences() and not np.isfinite(preference):
+            optimisation_on = False
+
+            print("SKIPPED: the comparison was not answered")
+
+            if self.show_window:
+                values = binding_plan.format_values(target_setting_values_list)
+
+                workspace.display_data.statistics = []
+                for i in range(number_of_params):
+                    workspace.display_data.statistics.append((target_setting_names_list[i], values[i]))
+
+                workspace.display_data.col_labels = ("Setting Name", "Value")
+                workspace.display_data.stop_info = "The comparison was not answered. Round skipped."
+
+        #
+        # start optimisation if quality is not satisfying
+        #
+        elif optimisation_on:
+
+            #
+            # do the bayesian optimisation with a new function that takes the lists and returns new parameters for
+            # the settings
+            #
+            new_target_settings_array, current_y_values = self.bayesian_optimisation(manual_evaluation_result,
+                                                                                     auto_evaluation_results,
+                                                                                     target_setting_values_list,
+                                                                                     target_setting_range,
+                                                                                     target_setting_steps,
+                                                                                     number_of_params,
+                                                                                     self.weighting_auto.value,
+                                                                                     self.weighting_manual.value,
+                                                                                     self.length_scale.value,
+                                                                                     self.alpha.value,
+                                                                                     runtime,
+                                                                                     valid,
+                                                                                     report,
+                                                                                     binding_plan.kinds,
+                                                                                     binding_plan.ordered,
+                                                                                     binding_plan.priors,
+                                                                                     preference,
+                                                                                     components,
+                                                                                     task,
+                                                                                     binding_plan)
+
+            #
+            # when the bayesian_optimisation method returns None, this indicates that max_iterations
+            # are reached and B.O. is stopped
+            #
+            if new_target_settings_array is None:
+                optimisation_on = False
+
+                #
+                # if user wants to show the display-window, save data needed for display in workspace.display_data
+                #
+                if self.show_window:
+                    #
+                    # we first need to search for the lowest available y and the corresponding X settings
+                    #
+                    x_best = binding_plan.format_values(self.get_best_x(binding_plan))
+                    final_values = binding_plan.format_values(target_setting_values_list)
+
+                    workspace.display_data.statistics = []
+                    for i in range(number_of_params):
+                        workspace.display_data.statistics.append(
+                            (target_setting_names_list[i], x_best[i], final_values[i]))
+
+                    workspace.display_data.col_labels = ("Setting Name", "Best Value so far", "Final Value")
+                    workspace.display_data.stop_info = "Max. number of iterations reached. Optimisation stopped."
+
+            #
+            # adjust the module settings with new x parameters returned form B.O.
+            #
+            else:
+                new_target_settings = new_target_settings_array.flatten()
+                current_y_values = current_y_values.flatten()
+
+                #
+                # modify modules with new setting values; the pipeline is informed once and re-runs from the first
+                # module that was modified
+                #
+                binding_plan.apply(new_target_settings)
+
+                #
+                # if user wants to show the display-window, save data needed for display in workspace.display_data
+                #
+                if self.show_window:
+                    #
+                    # we first need to search for the lowest available y and the corresponding X settings
+                    #
+                    x_best = binding_plan.format_values(self.get_best_x(binding_plan))
+                    old_values = binding_plan.format_values(target_setting_values_list)
+                    new_values = binding_plan.format_values(new_target_settings)
+
+                    workspace.display_data.statistics = []
+                    for i in range(number_of_params):
+                        workspace.display_data.statistics.append(
+                            (target_setting_names_list[i], x_best[i], old_values[i], new_values[i]))
+
+                    workspace.display_data.col_labels = ("Setting Name", "Best Value so far", "Old Value", "New Value")
+                    workspace.display_data.y_values = current_y_values
+
+        #
+        # no optimisation when quality is already satisfying
+        #
+        else:
+
+            info = "Quality satisfied. No Optimisation necessary."
+
+            #
+            # y is 0 as indicator that BO was not needed as quality is already satisfying or satisfying after some
+            # optimisation has already taken place
+            #
+            final_y = 0
+
+            #
+            # When quality is determined to be satisfying and an autoevaluation module exists, the final output of
+            # the automated evaluation is displayed to the user and can be rated with satisfying or unsatisfying
+            #
+
+            if self.weighting_auto.value > 0:
+
+                overlay_image = workspace.image_set.get_image("AutoEvaluationOverlay")
+                #b = overlay_image.has_parent_image
+                #print ("Has parent image: ")
+                #print (b)
+
+                base_image = overlay_image.parent_image
+
+                base_image_pxdata = base_image.pixel_data
+
+                #print ("Base image px data:")
+                #print (base_image_pxdata)
+
+                overlay_image_pxdata = overlay_image.pixel_data
+
+                #print ("Overlay image px data:")
+                #print (overlay_image_pxdata)
+
+                #
+                # Interrupt pipeline execution and send interaction request to workspace.
+                # As the run-method is executed in a separate thread, it needs to give control to the UI thread.
+                # The handle_interaction method will be called and gets the pixel data passed as parameters.
+                # It will then return a result.
+                #
+                result = workspace.interaction_request(self, base_image_pxdata, overlay_image_pxdata)
+
+                # if user finds the AutoEval result satisfying, do nothing and continue with pipeline run
+                if result == 1:
+                    print("OK button pressed, continuing pipeline run")
+
+                # if user finds result unsatisfying, document this in y with 1 as indicator that quality is not
+                # satisfying
+                else:
+                    final_y = 1
+                    print("Result not ok, documenting bad quality in y-value")
+                    info = "Quality not satisfying. Please adjust ranges in AutoEvaluation module."
+
+            #
+            # write the final values of the setting parameters and y to the history
+            #
+            with history.lock:
+                history.append(target_setting_values_list, final_y, runtime, task=task)
+
+            print("NO OPTIMISATION")
+
+            if self.show_window:
+                final_values = binding_plan.format_values(target_setting_values_list)
+
+                workspace.display_data.statistics = []
+                for i in range(number_of_params):
+                    workspace.display_data.statistics.append(
+                        (target_setting_names_list[i], final_values[i]))
+
+                workspace.display_data.col_labels = ("Setting Name", "Final Best Value")
+
+                workspace.display_data.stop_info = info
+
+        #
+        # the state of the image set is kept in its workspace, not in the module, which all image sets share
+        #
+        workspace.display_data.optimisation_on = optimisation_on
+
+        self.add_sensitivity_report(workspace, binding_plan, report)
+        self.add_thread_measurement(workspace, report)
+
+    #
+    # Optimise within a single run of the module: propose new settings, re-run the adjusted segment of the pipeline
+    # in-process and evaluate the result again until the quality is satisfied, the optimisation stops improving or the
+    # max. number of iterations is reached. There is no user interaction and no display during the loop, so this also
+    # works when CellProfiler runs headless (cellprofiler -c).
+    #
+    def run_in_process(self, workspace, binding_plan):
+        history = self.get_history(binding_plan)
+
+        pipeline = workspace.get_pipeline()
+
+        segment = self.get_segment(pipeline, binding_plan)
+
+        cache = ModuleOutputCache(self.cache_budget.value * 1024 * 1024)
+
+        budget = EvaluationBudget(self.time_budget.value, self.object_budget.value,
+                                  self.input_object_name.value, self.get_plausible_count_window())
+
+        #
+        # the segment runs repeatedly on the same image set, so its objects must be allowed to be overwritten
+        #
+        object_set = cellprofiler.object.ObjectSet(can_overwrite=True)
+        for object_name in workspace.object_set.get_object_names():
+            object_set.add_objects(workspace.object_set.get_objects(object_name), object_name)
+
+        segment_workspace = cellprofiler.workspace.Workspace(pipeline,
+                                                             self,
+                                                             workspace.image_set,
+                                                             object_set,
+                                                             workspace.measurements,
+                                                             workspace.image_set_list)
+
+        image_set_number = workspace.measurements.image_set_number
+
+        start_values = binding_plan.get_values()
+
+        task = self.get_task(workspace.measurements)
+
+        #
+        # the first evaluation was done by the pipeline itself; the later ones are timed here
+        #
+        runtime = self.get_segment_runtime(workspace.measurements, segment)
+
+        report = {}
+
+        rounds = 0
+        rounds_without_improvement = 0
+        best_y = None
+        quality_satisfied = False
+        aborted = False
+        stop_info = "Max. number of iterations reached. Optimisation stopped."
+
+        #
+        # modules in the segment do not prepare display data while the loop is running
+        #
+        show_windows = [module.show_window for module in segment]
+        for module in segment:
+            module.show_window = False
+
+        try:
+            while True:
+                #
+                # an aborted evaluation has no results; it was recorded as failed and the next settings are proposed
+                # from the history right away
+                #
+                round_report = {}
+
+                if aborted:
+                    valid = False
+
+                    next_x, y_values = self.propose_from_history(history,
+                                                                 binding_plan,
+                                                                 binding_plan.ranges,
+                                                                 binding_plan.steps,
+                                                                 len(binding_plan),
+                                                                 self.length_scale.value,
+                                                                 self.alpha.value,
+                                                                 round_report,
+                                                                 binding_plan.kinds,
+                                                                 binding_plan.ordered,
+                                                                 binding_plan.priors)
+
+                    history.commit(next_x)
+
+                else:
+                    manual_evaluation_result, auto_evaluation_results, optimisation_on = \
+                        self.get_evaluation_results(workspace.measurements)
+
+                    if not optimisation_on:
+                        quality_satisfied = True
+                        stop_info = "Quality satisfied after {} rounds.".format(rounds)
+                        break
+
+                    valid = self.is_valid_evaluation(workspace.measurements,
+                                                     manual_evaluation_result,
+                                                     auto_evaluation_results)
+
+                    components = self.get_components(pipeline, manual_evaluation_result, auto_evaluation_results)
+
+                    next_x, y_values = self.bayesian_optimisation(manual_evaluation_result,
+                                                                  auto_evaluation_results,
+                                                                  binding_plan.get_values(),
+                                                                  binding_plan.ranges,
+                                                                  binding_plan.steps,
+                                                                  len(binding_plan),
+                                                                  self.weighting_auto.value,
+                                                                  self.weighting_manual.value,
+                                                                  self.length_scale.value,
+                                                                  self.alpha.value,
+                                                                  runtime,
+                                                                  valid,
+                                                                  round_report,
+                                                                  binding_plan.kinds,
+                                                                  binding_plan.ordered,
+                                                                  binding_plan.priors,
+                                                                  components=components,
+                                                                  task=task,
+                                                                  binding_plan=binding_plan)
+
+                if "relevance" in round_report:
+                    report = round_report
+                elif "threads" in round_report:
+                    report["threads"] = round_report["threads"]
+
+                #
+                # max. number of iterations reached
+                #
+                if next_x is None:
+                    break
+
+                rounds += 1
+
+                #
+                # stop when the last evaluations did not improve the best quality found so far; failed evaluations
+                # never count as an improvement
+                #
+                current_y = np.atleast_1d(y_values)[-1]
+                if valid and (best_y is None or current_y < best_y):
+                    best_y = current_y
+                    rounds_without_improvement = 0
+                else:
+                    rounds_without_improvement += 1
+
+                if 0 < self.convergence_rounds.value <= rounds_without_improvement:
+                    stop_info = "No improvement for {} rounds. Optimisation stopped.".format(rounds_without_improvement)
+                    break
+
+                binding_plan.apply(next_x.flatten(), notify=False)
+
+                #
+                # abort the evaluation once it exceeds its time or object-count budget and record it as failed with
+                # the worst quality seen so far
+                #
+                budget.start()
+                try:
+                    run_pipeline_segment(pipeline, segment_workspace, segment, cache, image_set_number, budget)
+                    aborted = False
+                except EvaluationAborted as exception:
+                    print("EVALUATION ABORTED: {}".format(exception))
+                    aborted = True
+                runtime = budget.elapsed
+
+                if aborted:
+                    _, y, _, valid_rounds = self.load_history(history, binding_plan)
+                    history.stage(binding_plan.get_values(), self.get_failure_penalty(y, valid_rounds), runtime, False,
+                                  task=task)
+
+            if quality_satisfied:
+                #
+                # write the final values of the setting parameters and 0 as indicator that the quality is satisfying
+                # to the history
+                #
+                history.append(binding_plan.get_values(), 0, runtime, task=task)
+
+            else:
+                #
+                # leave the pipeline with the best settings found and their outputs in the workspace
+                #
+                binding_plan.apply(self.get_best_x(binding_plan), notify=False)
+
+                run_pipeline_segment(pipeline, segment_workspace, segment, cache, image_set_number)
+
+        finally:
+            for module, show_window in zip(segment, show_windows):
+                module.show_window = show_window
+
+            #
+            # an aborted round that was staged but not proposed from yet is written without a proposal
+            #
+            history.commit()
+
+        print("IN-PROCESS OPTIMISATION: {} ({} of {} module runs taken from cache)".format(
+            stop_info, cache.hits, cache.hits + cache.misses))
+
+        #
+        # if user wants to show the display-window, save data needed for display in workspace.display_data
+        #
+        workspace.display_data.optimisation_on = rounds > 0
+
+        if self.show_window:
+            start_values = binding_plan.format_values(start_values)
+            final_values = binding_plan.format_values(binding_plan.get_values())
+
+            workspace.display_data.statistics = []
+            for i in range(len(binding_plan)):
+                workspace.display_data.statistics.append(
+                    (binding_plan.names[i], start_values[i], final_values[i]))
+
+            workspace.display_data.col_labels = ("Setting Name", "Start Value", "Final Value")
+            workspace.display_data.stop_info = stop_info
+
+            if rounds > 0:
+                workspace.display_data.y_values = self.load_history(history, binding_plan)[1]
+
+        self.add_sensitivity_report(workspace, binding_plan, report)
+        self.add_thread_measurement(workspace, report)
 
     #
-    # setting_values are stored as unicode strings in the pipeline file.
-    # If the module has settings groups, it needs to be ensured that settings() returns the correct
-    # number of settings as saved in the file.
-    # To do so, look at the number of setting values before settings() is called to determine how many to return.
-    # Add groups if necessary.
+    # if user wants to show the display window during pipeline execution, this method is called by UI thread
+    # display the data saved in display_data of workspace
+    # used a CP defined figure to plot/display data via matplotlib
+    #
+    def display(self, workspace, figure):
+        #
+        # data plotted when BO was run
+        #
+        if getattr(workspace.display_data, "optimisation_on", False):
+            #
+            # create two subplots, and two more for the sensitivity report once the relevance of the parameters is
+            # known
+            #
+            sensitivity = getattr(workspace.display_data, "relevance", None) is not None
+
+            if sensitivity:
+                figure.set_subplots((2, 2))
+            else:
+                figure.set_subplots((1, 2))
+
+            #
+            # prepare first plot showing a scatter plot with the development of y (quality indicator) over the rounds
+            #
+            num_y = np.size(workspace.display_data.y_values)
+
+            x_values_axis = np.arange(1, num_y+1)
+
+            figure.subplot_scatter(0, 0,
+                                   x_values_axis, workspace.display_data.y_values,
+                                   xlabel="Iteration", ylabel="Quality", title="Quality over iterations")
+
+            #
+            # prepare second plot showing a table with old and new values
+            #
+            figure.subplot_table(0, 1,
+                                 workspace.display_data.statistics,
+                                 col_labels=workspace.display_data.col_labels)
+
+            if sensitivity:
+                #
+                # prepare third plot showing the partial dependence curve of each parameter; the x axis is the
+                # position of the value within the range of the parameter, so that all curves fit in one plot
+                #
+                axes = figure.subplot(1, 0)
+                for name, values, mu in workspace.display_data.partial_dependence:
+                    values = np.asarray(values, dtype=float)
+                    position = (values - np.min(values)) / max(np.ptp(values), 1e-12)
+                    axes.plot(position, mu, label=name)
+                axes.set_xlabel("Position in range")
+                axes.set_ylabel("Predicted quality")
+                axes.set_title("Partial dependence")
+                axes.legend(loc="best", fontsize="small")
+
+                #
+                # prepare fourth plot showing a table with the relevance of each parameter
+                #
+                figure.subplot_table(1, 1,
+                                     workspace.display_data.relevance,
+                                     col_labels=("Setting Name", "Relevance", "Frozen"))
+
+        #
+        # information plotted when BO was not run or max_iter was reached
+        #
+        else:
+            figure.set_subplots((1, 2))
+            figure.set_subplot_title(workspace.display_data.stop_info, 0, 0)
+            figure.subplot_table(0, 1,
+                                 workspace.display_data.statistics,
+                                 col_labels=workspace.display_data.col_labels)
+
+    ####################################################################
+    # Tell CellProfiler about the measurements produced in this module #
+    ####################################################################
+
+    #
+    # Provide the measurements for use in the database or a spreadsheet
+    #
+    def get_measurement_columns(self, pipeline):
+        return [(cellprofiler.measurement.IMAGE,
+                 "{}_{}".format(CATEGORY, feature),
+                 cellprofiler.measurement.COLTYPE_FLOAT) for feature in self.get_relevance_features() + [THREADS]]
+
+    #
+    # Return a list of the measurement categories produced by this module if the object_name matches
+    #
+    def get_categories(self, pipeline, object_name):
+        if object_name == cellprofiler.measurement.IMAGE:
+            return [CATEGORY]
+
+        return []
+
+    #
+    # Return the feature names if the object_name and category match to the GUI for measurement subscribers
+    #
+    def get_measurements(self, pipeline, object_name, category):
+        if object_name == cellprofiler.measurement.IMAGE and category == CATEGORY:
+            return self.get_relevance_features() + [THREADS]
+
+        return []
+
+    #
+    # helper function:
+    # Return the relevance feature of each parameter, e.g. Relevance_Threshold_correction_factor; parameters with the
+    # same setting name are numbered
+    #
+    def get_relevance_features(self):
+        features = []
+        for p in self.parameters:
+            feature = "{}_{}".format(RELEVANCE, re.sub("[^A-Za-z0-9]+", "_", p.parameter_names.value).strip("_"))
+            if feature in features:
+                feature = "{}_{}".format(feature, len(features) + 1)
+            features += [feature]
+
+        return features
+
+    #
+    # helper function:
+    # Add the relevance of each parameter as image measurements (NaN while it is not known) and, if the user wants to
+    # show the display window, save the relevance and partial dependence curves in workspace.display_data
+    #
+    def add_sensitivity_report(self, workspace, binding_plan, report):
+        relevance = report.get("relevance")
+
+        #
+        # the relevance is reported per dimension; the measurement of a range setting is the sum over its min and max
+        #
+        parameter_relevance = None
+        if relevance is not None and len(relevance) == len(binding_plan):
+            parameter_relevance = np.bincount(binding_plan.parameter_index, weights=relevance,
+                                              minlength=len(binding_plan.bindings))
+
+        for i, feature in enumerate(self.get_relevance_features()):
+            value = parameter_relevance[i] if parameter_relevance is not None and i < len(parameter_relevance) \
+                else np.nan
+            workspace.add_measurement(cellprofiler.measurement.IMAGE, "{}_{}".format(CATEGORY, feature), value)
+
+        if self.show_window and relevance is not None:
+            workspace.display_data.relevance = [
+                (binding_plan.names[i], "{:.3f}".format(relevance[i]), "Yes" if report["frozen"][i] else "")
+                for i in range(len(binding_plan))]
+
+            workspace.display_data.partial_dependence = [
+                (binding_plan.names[i], values, mu)
+                for i, (values, mu) in enumerate(report["partial_dependence"])]
+
+    #
+    # helper function:
+    # Add the number of BLAS/OpenMP threads the model used in the round as image measurement (NaN if no model was
+    # fitted or the number is not known)
+    #
+    def add_thread_measurement(self, workspace, report):
+        threads = report.get("threads")
+
+        workspace.add_measurement(cellprofiler.measurement.IMAGE, "{}_{}".format(CATEGORY, THREADS),
+                                  np.nan if threads is None else float(threads))
+
+    #
+    # helper function:
+    # Return the number of threads the models may use: the budget chosen by the user, or the default for the
+    # environment if it is 0 (see get_default_thread_budget)
+    #
+    def get_thread_budget(self):
+        if self.thread_budget.value > 0:
+            return self.thread_budget.value
+
+        return get_default_thread_budget()
+
+    #
+    # Return a context in which the models use at most the thread budget (see limit_thread_pools)
+    #
+    def limit_threads(self):
+        return limit_thread_pools(self.get_thread_budget())
+
+    #
+    # helper function:
+    # Return a list of pipeline modules (only IdentifyObjects modules)
+    #
+    def get_module_list(self, pipeline):
+        modules = pipeline.modules()
+        module_list = []
+        for module in modules:
+            #
+            # there is a filter for only using IdentifyObjects modules; the filter can be switchen on by uncommenting
+            # the following two lines and commenting the 3rd line
+            #
+            # if "Identify" in module.module_name:
+            #     module_list.append("{} #{}".format(module.module_name, module.get_module_num()))
+            module_list.append("{} #{}".format(module.module_name, module.get_module_num()))
+        return module_list
+
+    #
+    # helper function:
+    # Return a list of settings from the chosen modules
+    #
+    def get_settings_from_modules(self, pipeline):
+        setting_list = []
+        modules = pipeline.modules()
+        mod_name_list = []
+
+        for parameter in self.parameters:
+            name_list = parameter.module_names.value_text.split(" ")
+            name = name_list[0]
+            mod_name_list += [name]
+
+        for module in modules:
+            if module.module_name in mod_name_list:
+                for setting in module.visible_settings():
+                    setting_text = setting.get_text()
+                    if setting_text not in setting_list:
+                        setting_list.append(setting_text)
+
+        return setting_list
+
+    #
+    # helper function:
+    # Return a tuple describing the parameters chosen by the user; used to detect whether a binding plan is outdated
+    #
+    def get_parameter_signature(self):
+        return tuple((p.module_names.value_text, p.parameter_names.value_text, tuple(p.range.value), p.steps.value,
+                      p.prior_value.value, p.prior_confidence.value)
+                     for p in self.parameters)
+
+    #
+    # helper function:
+    # Look up the module and setting object for every parameter chosen by the user and return them as a BindingPlan
+    #
+    def compile_binding_plan(self, pipeline):
+        bindings = []
+
+        for p in self.parameters:
+
+            #
+            # get the module object; the module choice is saved as "<module name> #<module number>"
+            #
+            name_list = p.module_names.value_text.split(" #")
+            if len(name_list) < 2 or not name_list[1].isdigit():
+                raise cellprofiler.setting.ValidationError("Please choose a module to adjust", p.module_names)
+
+            try:
+                target_module = pipeline.module(int(name_list[1]))
+            except IndexError:
+                target_module = None
+
+            if target_module is None:
+                raise cellprofiler.setting.ValidationError(
+                    "Module {} does not exist in the pipeline".format(p.module_names.value_text), p.module_names)
+
+            #
+            # get the setting object by its name
+            #
+            target_setting = None
+            for setting in target_module.settings():
+                if setting.get_text() == p.parameter_names.value_text:
+                    target_setting = setting
+                    break
+
+            if target_setting is None:
+                raise cellprofiler.setting.ValidationError(
+                    "Setting \"{}\" not found in module {}".format(p.parameter_names.value_text,
+                                                                 p.module_names.value_text), p.parameter_names)
+
+            try:
+                bindings += [ParameterBinding(target_module, target_setting, p.range.value, p.steps.value,
+                                              p.prior_value.value, p.prior_confidence.value)]
+            except ValueError as e:
+                raise cellprofiler.setting.ValidationError(
+                    "Invalid preferred value of {}: {}".format(p.parameter_names.value_text, e), p.prior_value)
+
+            #
+            # the min and max of a range setting are chosen from the same grid and the min must stay below the max,
+            # so the grid needs at least two values
+            #
+            binding = bindings[-1]
+            if len(binding) == 2 and len(np.arange(float(binding.range[0]), float(binding.range[1]), binding.step)) < 2:
+                raise cellprofiler.setting.ValidationError(
+                    "The range of {} needs at least two steps, one for its min and one for its max; please widen the "
+                    "range or choose smaller steps".format(p.parameter_names.value_text), p.range)
+
+        return BindingPlan(pipeline, bindings, self.get_parameter_signature())
+
+    #
+    # helper function:
+    # Return the binding plan compiled in prepare_run; compile it again if it is missing (e.g. in an analysis worker)
+    # or outdated because the pipeline or the chosen parameters changed
+    #
+    def get_binding_plan(self, pipeline):
+        binding_plan = getattr(self, "binding_plan", None)
+
+        if binding_plan is None or not binding_plan.is_valid_for(pipeline, self.get_parameter_signature()):
+            binding_plan = self.compile_binding_plan(pipeline)
+            self.binding_plan = binding_plan
+
+        return binding_plan
+
+    #
+    # helper function:
+    # Necessary to refresh the dropdown menus in GUI
+    #
+    def refreshGUI(self):
+        print("GUI refreshed")
+
+    #
+    # helper function:
+    # Return the history of previous rounds saved in the output directory; its columns are keyed by the identities of
+    # the dimensions of the binding plan, or left as they were saved without a binding plan (e.g. to delete the history)
+    #
+    def get_history(self, binding_plan=None):
+        return OptimisationHistory(self.pathname.get_absolute_path(), self.get_module_num(),
+                                   None if binding_plan is None else binding_plan.identities)
+
+    #
+    # helper function:
+    # Return the x and y values of the valid rounds of the previous sessions saved in the warm-start directory that
+    # have values for the current parameters; x is a 2D array with one row per round. Both are empty if warm-starting
+    # is off or no previous session matches
+    #
+    def load_previous_sessions(self, history, num_params, binding_plan):
+        x_previous = np.zeros((0, num_params))
+        y_previous = np.zeros(0)
+
+        if not self.warm_start.value:
+            return x_previous, y_previous
+
+        for directory, _, filenames in os.walk(self.warm_start_directory.get_absolute_path()):
+            for filename in sorted(filenames):
+                match = re.match(r"history_bo_(\d+)\.jsonl$", filename)
+                if match is None:
+                    continue
+
+                previous = OptimisationHistory(directory, int(match.group(1)), history.signature, read_only=True)
+                if os.path.abspath(previous.path) == os.path.abspath(history.path) or not previous.has_identities():
+                    continue
+
+                x, y, _, valid, _ = self.load_compatible_history(previous, binding_plan)
+                if np.size(x, axis=1) != num_params:
+                    continue
+
+                keep = valid & np.isfinite(y)
+                x_previous = np.vstack((x_previous, x[keep]))
+                y_previous = np.concatenate((y_previous, y[keep]))
+
+        if len(y_previous) > 0:
+            print("WARM START: {} rounds of previous sessions".format(len(y_previous)))
+
+        return x_previous, y_previous
+
+    #
+    # helper function:
+    # Load the x, y, runtime and validity values of the previous rounds that can be used with the current parameters;
+    # x is returned as a 2D array with one row per round. y is computed from the raw evaluation results of the rounds
+    # with the current weights
+    #
+    def load_history(self, history, binding_plan):
+        return self.load_compatible_history(history, binding_plan)[:4]
+
+    #
+    # helper function:
+    # Load the history like load_history and also return the mask of the saved rounds that were kept, to select the
+    # other values saved per round (preferences, tasks, ...)
+    #
+    def load_compatible_history(self, history, binding_plan):
+        x, y, t, valid = history.load()
+        y = self.recompute_y(y, history.load_components())
+
+        x, compatible = self.fit_to_binding_plan(x, history.load_signature(), binding_plan)
+
+        return x[compatible], y[compatible], t[compatible], valid[compatible], compatible
+
+    #
+    # helper function:
+    # Return the x values of the history for the dimensions of the current binding plan and a mask of the rounds that
+    # can be used with them. The columns are matched by their identities; rounds without a value for a dimension or
+    # with a value outside its current range are left out, the other values are snapped to the current steps, so a
+    # range or steps can be edited without losing the rounds evaluated so far. Without a binding plan, all rounds are
+    # used as they were saved
     #
-    def prepare_settings(self, setting_values):
+    def fit_to_binding_plan(self, x, signature, binding_plan):
+        if binding_plan is None:
+            return x, np.ones(len(x), dtype=bool)
 
-        #
-        # No. of measurements in measurements group
-        #
-        count1 = int(setting_values[1])
+        x = map_columns(x, signature, binding_plan.identities)
+        compatible = np.all(np.isfinite(x), axis=1)
 
-        #
-        # No. of parameters in parameters group
-        #
-        count2 = int(setting_values[2])
+        for i, (setting_range, step) in enumerate(zip(binding_plan.ranges, binding_plan.steps)):
+            lower = float(setting_range[0])
+            upper = float(setting_range[1])
+            step = float(step)
 
-        #
-        # Handle adding measurements
-        #
-        num_settings_1 = (len(setting_values) - NUM_FIXED_SETTINGS - NUM_GROUP2_SETTINGS*count2) / NUM_GROUP1_SETTINGS
+            compatible[compatible] &= (x[compatible, i] >= lower - 1e-9) & (x[compatible, i] <= upper + 1e-9)
 
-        if len(self.measurements) == 0:
-            self.add_measurement(False)
-        elif len(self.measurements) > num_settings_1:
-            del self.measurements[num_settings_1:]
-        else:
-            for i in range(len(self.measurements), num_settings_1):
-                self.add_measurement()
+            #
+            # the candidate values are the ones of np.arange(lower, upper, step)
+            #
+            grid = np.arange(lower, upper, step)
+            if len(grid) > 0:
+                snapped = lower + np.round((x[:, i] - lower) / step) * step
+                x[:, i] = np.around(np.clip(snapped, grid[0], grid[-1]), 3)
 
-        #
-        # Handle adding parameters
-        #
-        num_settings_2 = (len(setting_values) - NUM_FIXED_SETTINGS - NUM_GROUP1_SETTINGS * count1) / NUM_GROUP2_SETTINGS
+        for i, j in binding_plan.ordered:
+            compatible[compatible] &= x[compatible, i] < x[compatible, j]
 
-        if len(self.parameters) == 0:
-            self.add_parameter(False)
-        elif len(self.parameters) > num_settings_2:
-            del self.parameters[num_settings_2:]
-        else:
-            for i in range(len(self.parameters), num_settings_2):
-                self.add_parameter()
+        return x, compatible
 
-    #  
-    # CellProfiler must know about the settings in the module.
-    # This method returns the settings in the order that they will be loaded and saved from a pipeline or project file.
-    # Accessing setting members of a group of settings requires looping through the group result list
     #
-    def settings(self):
-        result = [self.input_object_name]
-        result += [self.count1, self.count2]
-        result += [self.weighting_manual, self.weighting_auto]
-        for m in self.measurements:
-            result += [m.evaluation_measurement]
-        result += [self.max_iter, self.length_scale, self.alpha]
-        for p in self.parameters:
-            result += [p.module_names, p.parameter_names, p.range, p.steps]
-        result += [self.pathname]
-
-        return result
+    # helper function:
+    # Return the modules re-run for each proposal: from the first adjusted module up to the module before this one,
+    # so the segment includes the measurement and evaluation modules
+    #
+    def get_segment(self, pipeline, binding_plan):
+        return [module for module in pipeline.modules()
+                if binding_plan.first_module_num <= module.get_module_num() < self.get_module_num()]
 
-    #  
-    # returns what the user should see in the GUI
-    # include buttons and dividers which are not added in the settings method
     #
-    def visible_settings(self):
-        result = [self.input_object_name]
-        result += [self.count1]
-        for mod in self.measurements:
-            result += [mod.evaluation_measurement]
-            if hasattr(mod, "remover"):
-                result += [mod.remover]
-        result += [self.add_measurement_button, self.spacer, self.weighting_auto, self.weighting_manual, self.spacer6,
-                   self.max_iter, self.length_scale, self.alpha, self.spacer4]
-        result += [self.count2]
-        for param in self.parameters:
-            if hasattr(param, "divider"):
-                result += [param.divider]
-            result += [param.module_names, param.parameter_names, param.range, param.steps]
-            if hasattr(param, "remover"):
-                result += [param.remover]
-        result += [self.add_param_button, self.spacer2, self.refresh_button,
-                   self.spacer3, self.pathname, self.spacer5, self.delete_button]
+    # helper function:
+    # Return the time in seconds the modules of the segment took on the current image set. CellProfiler measures the
+    # execution time of each module in analysis runs, but not in Test mode; NaN is returned if a time is missing
+    #
+    def get_segment_runtime(self, measurements, segment):
+        runtime = 0.0
 
-        return result
+        for module in segment:
+            if not module.enabled:
+                continue
 
-    ###################################################################
-    # Run method will be executed in a worker thread of the pipeline #
-    ###################################################################
+            feature = "ExecutionTime_{:02d}{}".format(module.get_module_num(), module.module_name)
+            if not measurements.has_current_measurements(cellprofiler.measurement.IMAGE, feature):
+                return np.nan
+
+            runtime += float(measurements.get_current_image_measurement(feature))
+
+        return runtime
 
     #
-    # CellProfiler calls "run" on each image set in the pipeline
-    # The workspace as input parameter contains the state of the analysis so far
+    # helper function:
+    # Return the setting values of the valid round with the lowest y
     #
-    def run(self, workspace):
+    def get_best_x(self, binding_plan):
+        history = self.get_history(binding_plan)
+        x, y, _, valid, compatible = self.load_compatible_history(history, binding_plan)
 
         #
-        # create absolute pathname for data files to be saved
+        # in an A/B evaluation, the best settings are the ones preferred last
         #
-        x_filename = "x_bo_{}.txt".format(self.get_module_num())
-        y_filename = "y_bo_{}.txt".format(self.get_module_num())
-
-        x_absolute_path = "{}/{}".format(self.pathname.get_absolute_path(), x_filename)
-        y_absolute_path = "{}/{}".format(self.pathname.get_absolute_path(), y_filename)
+        _, incumbent = get_duels(history.load_preferences()[compatible])
+        if incumbent is not None:
+            return x[incumbent].flatten()
 
         #
-        # get the measurements made so far from workspace data
+        # in the multi-task mode, the best settings are the ones of the task of the last round
         #
-        workspace_measurements = workspace.measurements
+        if self.multi_task.value and len(y) > 0:
+            tasks = np.array(history.load_tasks())[compatible]
+            in_task = tasks == tasks[-1]
+            x = x[in_task]
+            y = y[in_task]
+            valid = valid[in_task]
 
         #
-        # get the pipeline object which saves the setting parameters
+        # if no round can be used with the current ranges, the settings are kept as they are
         #
-        pipeline = workspace.get_pipeline()
+        if len(y) == 0:
+            return np.array(binding_plan.get_values(), dtype=float)
 
-        #
-        # assume that optimisation is off
-        #
-        self.optimisation_on = False
+        if np.any(valid):
+            x = x[valid]
+            y = y[valid]
+
+        return x[np.argmin(y)].flatten()
+
+    #
+    # helper function:
+    # Return the manual and automated evaluation results measured for the input object and whether they indicate
+    # that optimisation is needed
+    #
+    def get_evaluation_results(self, measurements):
+        optimisation_on = False
 
         #
         # create empty lists to hold evaluation measurements
@@ -549,405 +4003,254 @@ The variation steps within the chosen range for choosing a candidate set."""
         manual_evaluation_result = []
         auto_evaluation_results = []
 
-        #
-        # save the quality measurements and determine whether optimisation is needed or not
-        #
         for m in self.measurements:
 
             if m.evaluation_measurement.value_text == "Evaluation_ManualQuality":
-                manual_evaluation_result = workspace_measurements.get_current_measurement(
+                manual_evaluation_result = measurements.get_current_measurement(
                     self.input_object_name.value, m.evaluation_measurement.value_text)
                 for e in manual_evaluation_result:
                     if float(e) > 0.0:
-                        self.optimisation_on = True
+                        optimisation_on = True
+
+            #
+            # comparisons do not tell whether the quality is good enough; the optimisation goes on until the max.
+            # number of iterations is reached
+            #
+            elif m.evaluation_measurement.value_text == PREFERENCE_FEATURE:
+                optimisation_on = True
 
             elif m.evaluation_measurement.value_text == "Evaluation_Deviation":
-                auto_evaluation_results = workspace_measurements.get_current_measurement(
+                auto_evaluation_results = measurements.get_current_measurement(
                     self.input_object_name.value, m.evaluation_measurement.value_text)
                 for e in auto_evaluation_results:
                     if float(e) > 0.0:
-                        self.optimisation_on = True
-
-        #
-        # get modules and their settings
-        #
-        number_of_params = self.parameters.__len__()
-
-        # save operational data in lists; the lists operate with indices;
-        # an indices corresponds to a certain module, a setting name in this module and the value of this setting
-        target_setting_module_list = []     # saves module objects
-        target_setting_names_list = []      # saves setting names
-        target_setting_values_list = []     # saves setting values of the selected settings in the module
-        target_setting_range = []           # saves the ranges in which the setting values shall be manipulated
-        target_setting_steps = []           # saves the steps the range can vary
-
-
-        #
-        # get the data for the lists by looping through all settings chosen by the user
-        #
-        for p in self.parameters:
-
-            #
-            # get the module object
-            #
-            name_list = p.module_names.value_text.split(" #")
-            number = int(name_list[1])
-            target_module = pipeline.module(number)
-
-            #
-            # save module number in module_list
-            #
-            target_setting_module_list += [number]
-
-            #
-            # get the setting name
-            #
-            target_setting_name = p.parameter_names.value_text
-
-            for setting in target_module.settings():
-                if setting.get_text() == target_setting_name:
-                    #
-                    # add setting name to Names_list and setting value to values_list
-                    #
-                    target_setting_names_list += [setting.get_text()]
-                    target_setting_values_list += [setting.get_value()]
-
-            #
-            # save range and steps into lists; ranges are saved as a tuple
-            #
-            target_setting_range += [p.range.value]
-            target_setting_steps += [float(p.steps.value)]
-
+                        optimisation_on = True
 
         #
-        # start optimisation if quality is not satisfying
+        # a degenerate segmentation is never satisfying, even if its evaluation results look perfect
         #
-        if self.optimisation_on:
-
-            #
-            # do the bayesian optimisation with a new function that takes the lists and returns new parameters for
-            # the settings
-            #
-            new_target_settings_array, current_y_values = self.bayesian_optimisation(manual_evaluation_result,
-                                                                                     auto_evaluation_results,
-                                                                                     target_setting_values_list,
-                                                                                     target_setting_range,
-                                                                                     target_setting_steps,
-                                                                                     number_of_params,
-                                                                                     self.weighting_auto.value,
-                                                                                     self.weighting_manual.value,
-                                                                                     self.length_scale.value,
-                                                                                     self.alpha.value)
-
-            #
-            # when the bayesian_optimisation method returns None, this indicates that max_iterations
-            # are reached and B.O. is stopped
-            #
-            if new_target_settings_array is None:
-                self.optimisation_on = False
-
-                #
-                # if user wants to show the display-window, save data needed for display in workspace.display_data
-                #
-                if self.show_window:
-                    #
-                    # we first need to search for the lowest available y and the corresponding X settings
-                    #
-                    x = np.loadtxt(x_absolute_path)
-                    y = np.loadtxt(y_absolute_path)
-
-                    ind_best = np.argmin(y)
-
-                    #
-                    # account for case with 1D array in first round and several dimension issues
-                    #
-                    try:
-                        num_dimensions = x.ndim
-                    except AttributeError:
-                        num_dimensions = 0
-
-                    if num_dimensions == 1 and number_of_params == 1:  # otherwise would also reshape 1st round of x 2D
-                        x = x.reshape(-1, 1)
-                    elif num_dimensions == 0:  # accounts for x 1D in first round
-                        x = np.array([x])
-                    elif np.size(y) == 1:
-                        x = np.array([x])
-
-                    x_best = x[ind_best]
-                    x_best = x_best.flatten()
-
-                    workspace.display_data.statistics = []
-                    for i in range(number_of_params):
-                        workspace.display_data.statistics.append(
-                            (target_setting_names_list[i], x_best[i], target_setting_values_list[i]))
-
-                    workspace.display_data.col_labels = ("Setting Name", "Best Value so far", "Final Value")
-                    workspace.display_data.stop_info = "Max. number of iterations reached. Optimisation stopped."
-
-            #
-            # adjust the module settings with new x parameters returned form B.O.
-            #
-            else:
-                new_target_settings = new_target_settings_array.flatten()
-                current_y_values = current_y_values.flatten()
-
-                #
-                # modify modules with new setting values
-                #
-                for i in range(number_of_params):
-                    target_module = pipeline.module(target_setting_module_list[i])
-                    for setting in target_module.settings():
-                        if setting.get_text() == target_setting_names_list[i]:
-                            setting.set_value(new_target_settings[i])
-
-                            #
-                            # inform the pipeline about the edit
-                            # pipeline re-runs from where the module has been changed; mind that pipeline-index is 1
-                            # smaller than module number, so it needs to take module number of list -1
-                            #
-                            pipeline.edit_module(target_setting_module_list[i]-1, is_image_set_modification=False)
-
-                #
-                # ensure that CP is running the pipeline from the first module that was modified
-                #
-                pipeline.edit_module(min(target_setting_module_list) - 1, is_image_set_modification=False)
+        if not self.is_valid_evaluation(measurements, manual_evaluation_result, auto_evaluation_results):
+            optimisation_on = True
 
-                #
-                # if user wants to show the display-window, save data needed for display in workspace.display_data
-                #
-                if self.show_window:
-                    #
-                    # we first need to search for the lowest available y and the corresponding X settings
-                    #
-                    x = np.loadtxt(x_absolute_path)
-                    y = np.loadtxt(y_absolute_path)
+        return manual_evaluation_result, auto_evaluation_results, optimisation_on
 
-                    ind_best = np.argmin(y)
+    #
+    # helper function:
+    # Return True if the quality is evaluated by A/B comparisons
+    #
+    def uses_preferences(self):
+        return any(m.evaluation_measurement.value_text == PREFERENCE_FEATURE for m in self.measurements)
 
-                    #
-                    # account for case with 1D array in first round and several dimension issues
-                    #
-                    try:
-                        num_dimensions = x.ndim
-                    except AttributeError:
-                        num_dimensions = 0
+    #
+    # helper function:
+    # Return the preference measured by an A/B evaluation, or NaN if the quality is not evaluated by comparisons or
+    # the comparison was not answered
+    #
+    def get_preference(self, measurements):
+        for m in self.measurements:
+            if m.evaluation_measurement.value_text == PREFERENCE_FEATURE:
+                return float(np.mean(measurements.get_current_measurement(self.input_object_name.value,
+                                                                          PREFERENCE_FEATURE)))
 
-                    if num_dimensions == 1 and number_of_params == 1:  # otherwise would also reshape 1st round of x 2D
-                        x = x.reshape(-1, 1)
-                    elif num_dimensions == 0:  # accounts for x 1D in first round
-                        x = np.array([x])
-                    elif np.size(y) == 1:
-                        x = np.array([x])
+        return np.nan
 
-                    x_best = x[ind_best]
-                    x_best = x_best.flatten()
+    #
+    # helper function:
+    # Return the task of the current image set in the multi-task mode: the value of the metadata measurement defining
+    # the groups of image sets. None if the mode is off or the image set has no such measurement
+    #
+    def get_task(self, measurements):
+        if not self.multi_task.value:
+            return None
 
-                    workspace.display_data.statistics = []
-                    for i in range(number_of_params):
-                        workspace.display_data.statistics.append(
-                            (target_setting_names_list[i], x_best[i], target_setting_values_list[i],
-                             new_target_settings[i]))
+        feature = self.task_metadata.value
+        if not measurements.has_current_measurements(cellprofiler.measurement.IMAGE, feature):
+            return None
 
-                    workspace.display_data.col_labels = ("Setting Name", "Best Value so far", "Old Value", "New Value")
-                    workspace.display_data.y_values = current_y_values
+        return str(measurements.get_current_image_measurement(feature))
 
-        #
-        # no optimisation when quality is already satisfying
-        #
-        else:
+    #
+    # helper function:
+    # Return the names of the measurements the automated evaluation of the input object computed its deviations for,
+    # in the order of the Evaluation_Deviation values; the deviations are numbered if the evaluation module is not found
+    #
+    def get_deviation_names(self, pipeline, count):
+        names = []
 
-            #
-            # open or create x_file and write the final values of the setting parameters to it
-            #
-            with open(x_absolute_path, "a+") as x_file:
-                for v in target_setting_values_list:
-                    x_file.write("{} ".format(v))
-                x_file.write("\n")
+        for module in pipeline.modules():
+            if module.get_module_num() >= self.get_module_num():
+                break
 
-            info = "Quality satisfied. No Optimisation necessary."
+            if module.module_name == "AutomatedEvaluation" and \
+                    module.outlines[0].objects_name.value == self.input_object_name.value:
+                names = [m.measurement.value_text for m in module.measurements]
 
-            #
-            # When quality is determined to be satisfying and an autoevaluation module exists, the final output of
-            # the automated evaluation is displayed to the user and can be rated with satisfying or unsatisfying
-            #
+        if len(names) != count:
+            names = ["Deviation_{}".format(i + 1) for i in range(count)]
 
-            if self.weighting_auto.value > 0:
+        return names
 
-                overlay_image = workspace.image_set.get_image("AutoEvaluationOverlay")
-                #b = overlay_image.has_parent_image
-                #print ("Has parent image: ")
-                #print (b)
+    #
+    # helper function:
+    # Return the raw evaluation results saved in the history: the manual quality and the deviation of each measurement
+    # of the automated evaluation by name
+    #
+    def get_components(self, pipeline, manual_evaluation_result, auto_evaluation_results):
+        deviations = [float(e) for e in np.atleast_1d(auto_evaluation_results)]
 
-                base_image = overlay_image.parent_image
+        return {"manual": [float(e) for e in np.atleast_1d(manual_evaluation_result)],
+                "deviations": [[name, e] for name, e in zip(self.get_deviation_names(pipeline, len(deviations)),
+                                                            deviations)]}
 
-                base_image_pxdata = base_image.pixel_data
+    #
+    # helper function:
+    # Return the names of the raw evaluation results that make up the quality with the current evaluation
+    # measurements: the manual quality and the measurements of the automated evaluation in the last round with raw
+    # results. A measurement added later is left out of the quality of earlier rounds
+    #
+    def get_objective_names(self, components):
+        recorded = [c for c in components if c is not None]
+        if len(recorded) == 0:
+            return [], []
 
-                #print ("Base image px data:")
-                #print (base_image_pxdata)
+        selected = [m.evaluation_measurement.value_text for m in self.measurements]
 
-                overlay_image_pxdata = overlay_image.pixel_data
+        manual_names = []
+        if "Evaluation_ManualQuality" in selected and len(recorded[-1]["manual"]) > 0:
+            manual_names = ["Evaluation_ManualQuality"]
 
-                #print ("Overlay image px data:")
-                #print (overlay_image_pxdata)
+        deviation_names = []
+        if "Evaluation_Deviation" in selected:
+            deviation_names = [name for name, _ in recorded[-1]["deviations"]]
 
-                #
-                # Interrupt pipeline execution and send interaction request to workspace.
-                # As the run-method is executed in a separate thread, it needs to give control to the UI thread.
-                # The handle_interaction method will be called and gets the pixel data passed as parameters.
-                # It will then return a result.
-                #
-                result = workspace.interaction_request(self, base_image_pxdata, overlay_image_pxdata)
+        return manual_names, deviation_names
 
-                # if user finds the AutoEval result satisfying, do nothing and continue with pipeline run
-                if result == 1:
-                    #
-                    # open or create y_file and write 0 to it as indicator that BO was not needed as quality is already
-                    # satisfying or satisfying after some optimisation has already taken place
-                    #
-                    with open(y_absolute_path, "a+") as y_file:
-                        y_file.write("{}\n".format(0))
+    #
+    # helper function:
+    # Compute y of each round again from its raw evaluation results with the current weights and evaluation
+    # measurements, so the rounds evaluated so far are reused when these change.
+    # Rounds without raw results (A/B evaluations, aborted or satisfying rounds and rounds saved before the results
+    # were recorded) and rounds missing a part of the current evaluation keep the y saved for them
+    #
+    def recompute_y(self, y, components):
+        y = np.array(y, dtype=float)
 
-                    print("OK button pressed, continuing pipeline run")
+        manual_names, deviation_names = self.get_objective_names(components)
+        if len(manual_names) + len(deviation_names) == 0:
+            return y
 
-                # if user finds result unsatisfying, document this in y
-                else:
-                    #
-                    # open or create y_file and write 1 to it as indicator that quality not satisfying
-                    #
-                    with open(y_absolute_path, "a+") as y_file:
-                        y_file.write("{}\n".format(1))
-                    print("Result not ok, documenting bad quality in y-value")
-                    info = "Quality not satisfying. Please adjust ranges in AutoEvaluation module."
+        for i, c in enumerate(components):
+            if c is None:
+                continue
 
-            else:
-                #
-                # open or create y_file and write 0 to it as indicator that BO was not needed as quality is already
-                # satisfying or satisfying after some optimisation has already taken place
-                #
-                with open(y_absolute_path, "a+") as y_file:
-                    y_file.write("{}\n".format(0))
+            manual = c["manual"] if len(manual_names) > 0 else []
 
-            print("NO OPTIMISATION")
+            deviations = dict(c["deviations"])
+            auto = [deviations[name] for name in deviation_names if name in deviations]
 
-            if self.show_window:
-                workspace.display_data.statistics = []
-                for i in range(number_of_params):
-                    workspace.display_data.statistics.append(
-                        (target_setting_names_list[i], target_setting_values_list[i]))
+            if (len(manual_names) > 0 and len(manual) == 0) or (len(deviation_names) > 0 and len(auto) == 0):
+                continue
 
-                workspace.display_data.col_labels = ("Setting Name", "Final Best Value")
+            y[i] = self.normalise_y(np.array(manual), np.array(auto), self.weighting_manual.value,
+                                    self.weighting_auto.value)
 
-                workspace.display_data.stop_info = info
+        return y
 
     #
-    # if user wants to show the display window during pipeline execution, this method is called by UI thread
-    # display the data saved in display_data of workspace
-    # used a CP defined figure to plot/display data via matplotlib
+    # helper function:
+    # Return the names of the objectives of the multi-objective mode and their values with one row per round; NaN
+    # where a round has no raw result for an objective
     #
-    def display(self, workspace, figure):
-        #
-        # data plotted when BO was run
-        #
-        if self.optimisation_on:
-            #
-            # create two subplots
-            #
-            figure.set_subplots((1, 2))
+    def get_objectives(self, components):
+        manual_names, deviation_names = self.get_objective_names(components)
 
-            #
-            # prepare first plot showing a scatter plot with the development of y (quality indicator) over the rounds
-            #
-            num_y = np.size(workspace.display_data.y_values)
+        objectives = np.full((len(components), len(manual_names) + len(deviation_names)), np.nan)
+        for i, c in enumerate(components):
+            if c is None:
+                continue
 
-            x_values_axis = np.arange(1, num_y+1)
+            deviations = dict(c["deviations"])
 
-            figure.subplot_scatter(0, 0,
-                                   x_values_axis, workspace.display_data.y_values,
-                                   xlabel="Iteration", ylabel="Quality", title="Quality over iterations")
+            values = [np.mean(c["manual"]) if len(c["manual"]) > 0 else np.nan for _ in manual_names]
+            values += [deviations.get(name, np.nan) for name in deviation_names]
 
-            #
-            # prepare second plot showing a table with old and new values
-            #
-            figure.subplot_table(0, 1,
-                                 workspace.display_data.statistics,
-                                 col_labels=workspace.display_data.col_labels)
+            objectives[i] = values
 
-        #
-        # information plotted when BO was not run or max_iter was reached
-        #
-        else:
-            figure.set_subplots((1, 2))
-            figure.set_subplot_title(workspace.display_data.stop_info, 0, 0)
-            figure.subplot_table(0, 1,
-                                 workspace.display_data.statistics,
-                                 col_labels=workspace.display_data.col_labels)
+        return manual_names + deviation_names, objectives
 
     #
     # helper function:
-    # Return a list of pipeline modules (only IdentifyObjects modules)
+    # Return the y values the model learns in the multi-objective mode: the scalarisation of the objectives of each
+    # round with weights drawn at random for this round (ParEGO). The Pareto front of the valid rounds is saved as
+    # well. Failed rounds and valid rounds without objectives (e.g. the ones with satisfying settings, whose y is on
+    # another scale) get the worst scalarised quality. y is returned unchanged with less than two objectives
     #
-    def get_module_list(self, pipeline):
-        modules = pipeline.modules()
-        module_list = []
-        for module in modules:
-            #
-            # there is a filter for only using IdentifyObjects modules; the filter can be switchen on by uncommenting
-            # the following two lines and commenting the 3rd line
-            #
-            # if "Identify" in module.module_name:
-            #     module_list.append("{} #{}".format(module.module_name, module.get_module_num()))
-            module_list.append("{} #{}".format(module.module_name, module.get_module_num()))
-        return module_list
+    def scalarise_history(self, history, x, y, valid, compatible):
+        names, objectives = self.get_objectives([c for c, keep in zip(history.load_components(), compatible) if keep])
+        if len(names) < 2:
+            return y
+
+        front = get_pareto_front(objectives) & valid
+        history.save_pareto_front(x[front], objectives[front], names)
+
+        print("PARETO FRONT: {} of {} settings".format(np.sum(front), len(y)))
+
+        weights = self.get_random_state(len(y), "pareto").dirichlet(np.ones(len(names)))
+
+        scalarised = np.full(len(y), np.nan)
+        scalarised[valid] = scalarise_objectives(objectives[valid], weights)
+
+        missing = ~np.isfinite(scalarised)
+        worst = np.max(scalarised[~missing]) if np.any(~missing) else np.max(y)
+        scalarised[missing] = worst
+
+        return scalarised
 
     #
     # helper function:
-    # Return a list of settings from the chosen modules
+    # Return the (min, max) window of plausible input object counts, or None if implausible counts are not rejected
     #
-    def get_settings_from_modules(self, pipeline):
-        setting_list = []
-        modules = pipeline.modules()
-        mod_name_list = []
-
-        for parameter in self.parameters:
-            name_list = parameter.module_names.value_text.split(" ")
-            name = name_list[0]
-            mod_name_list += [name]
+    def get_plausible_count_window(self):
+        if not self.reject_implausible.value:
+            return None
 
-        for module in modules:
-            if module.module_name in mod_name_list:
-                for setting in module.visible_settings():
-                    setting_text = setting.get_text()
-                    if setting_text not in setting_list:
-                        setting_list.append(setting_text)
+        return self.plausible_count.min, self.plausible_count.max
 
-        return setting_list
+    #
+    # helper function:
+    # Return whether the module provides the input objects, i.e. whether it is the module after which the plausible
+    # object count is checked
+    #
+    def provides_input_objects(self, module):
+        return ("objects", self.input_object_name.value) in get_module_outputs(module)
 
     #
     # helper function:
-    # Necessary to refresh the dropdown menus in GUI
+    # Return whether the evaluation results can be trusted. They can not if no input objects were identified, as the
+    # automated evaluation then reports no deviation at all (a false "perfect" score), or if a result is not finite
     #
-    def refreshGUI(self):
-        print("GUI refreshed")
+    def is_valid_evaluation(self, measurements, manual_evaluation_result, auto_evaluation_results):
+        count_feature = "Count_{}".format(self.input_object_name.value)
+        if measurements.has_current_measurements(cellprofiler.measurement.IMAGE, count_feature):
+            if measurements.get_current_image_measurement(count_feature) == 0:
+                return False
+
+        for e in list(np.atleast_1d(manual_evaluation_result)) + list(np.atleast_1d(auto_evaluation_results)):
+            if not np.isfinite(float(e)):
+                return False
+
+        return True
 
     #
     # helper function:
     # Deletes existing files storing previous values for x and y
     #
     def delete_data(self):
-        #
-        # create absolute pathname
-        #
-        x_filename = "x_bo_{}.txt".format(self.get_module_num())
-        y_filename = "y_bo_{}.txt".format(self.get_module_num())
+        self.get_history().delete()
 
-        x_absolute_path = "{}/{}".format(self.pathname.get_absolute_path(), x_filename)
-        y_absolute_path = "{}/{}".format(self.pathname.get_absolute_path(), y_filename)
-
-        #
-        # remove files
-        #
-        os.remove(x_absolute_path)
-        os.remove(y_absolute_path)
+        kernel_fit = getattr(self, "kernel_fit", None)
+        if kernel_fit is not None:
+            kernel_fit.reset()
 
         print("Data deleted")
 
@@ -957,46 +4260,155 @@ The variation steps within the chosen range for choosing a candidate set."""
 
     def bayesian_optimisation(self, manual_result, auto_evaulation_results,
                               values_list, setting_range, range_steps, num_params,
-                              w_auto, w_manual, length_scale, alpha):
+                              w_auto, w_manual, length_scale, alpha, runtime=np.nan, valid=True, report=None,
+                              kinds=None, ordered=None, priors=None, preference=np.nan, components=None, task=None,
+                              binding_plan=None):
+
+        #
+        # need to load and write available data to files to persist it over the iterations; the history contains the
+        # x and y values, the runtime needed to evaluate x and whether the evaluation was valid
+        # normalise y before writing it to the history; the raw evaluation results are written as well, so y can be
+        # computed again when the weights change
+        # the round is proposed from the history and written to it under the lock, as other image sets, in this or
+        # another process, may run a round at the same time
+        #
+        history = self.get_history(binding_plan)
+        with history.lock:
+
+            #
+            # if the settings are still the ones of the last round, the settings proposed after it were never
+            # applied (e.g. the pipeline was not saved before a crash); they are proposed again instead of recording
+            # the round twice
+            #
+            pending = history.load_pending_proposal(values_list, task)
+            if pending is not None:
+                print("RESUMING: the settings proposed after the last round were not evaluated yet")
+                return pending, self.load_history(history, binding_plan)[1]
+
+            #
+            # in an A/B evaluation, y is 0 if the settings were preferred over the best ones so far, 1 if not and 0.5
+            # for a tie; the optimisation itself learns from the preferences
+            #
+            if np.isfinite(preference):
+                y_normalised = 1.0 - preference
+                components = None
+            else:
+                y_normalised = self.normalise_y(manual_result, auto_evaulation_results, w_manual, w_auto)
+
+            #
+            # the round is written to the journal together with the settings proposed after it, in a single record
+            #
+            history.stage(values_list, y_normalised, runtime, valid, preference, components, task)
+
+            next_x, y = self.propose_from_history(history, binding_plan, setting_range, range_steps, num_params,
+                                                  length_scale, alpha, report, kinds, ordered, priors)
+
+            history.commit(next_x)
+
+            return next_x, y
+
+    #
+    # Propose the next setting values from all rounds saved in the history; returns the new x and the y values of the
+    # history, or None, None if the max. number of iterations is reached.
+    # The relevance of the parameters is saved in the history as well, as it decides which parameters are frozen
+    #
+    def propose_from_history(self, history, binding_plan, setting_range, range_steps, num_params, length_scale, alpha,
+                             report=None, kinds=None, ordered=None, priors=None):
 
         #
-        # need to load and write available data to files to persist it over the iterations; files contain x and y values
-        # define the name of the files where x and y values are written to; names store the module number in case
-        # BO module is used in more than one place of the pipeline
+        # load the x, y, t and validity values into numpy arrays
+        # x values are the settings values
+        # y values are the percentaged evaluation deviation values normalised and weighted to one single y value
+        # t values are the runtimes in seconds; NaN where they are unknown
+        # valid is False for the evaluations of degenerate segmentations
         #
+        x, y, t, valid, compatible = self.load_compatible_history(history, binding_plan)
 
         #
-        # create absolute pathname
+        # in the multi-objective mode, the model learns a trade-off of the objectives drawn at random for this round;
+        # the weighted y is still returned, e.g. to tell whether the optimisation improves
         #
-        x_filename = "x_bo_{}.txt".format(self.get_module_num())
-        y_filename = "y_bo_{}.txt".format(self.get_module_num())
+        y_model = y
+        if self.multi_objective.value:
+            y_model = self.scalarise_history(history, x, y, valid, compatible)
 
-        x_absolute_path = "{}/{}".format(self.pathname.get_absolute_path(), x_filename)
-        y_absolute_path = "{}/{}".format(self.pathname.get_absolute_path(), y_filename)
+        preferences = history.load_preferences()[compatible]
+        if not np.any(np.isfinite(preferences)):
+            preferences = None
 
         #
-        # open or create x_file and write the values of the setting parameters to it
+        # the rounds of previous sessions are used as less certain observations; their y is not comparable with the
+        # scalarised objectives or the comparisons of the current session
         #
-        with open(x_absolute_path, "a+") as x_file:
-            for v in values_list:
-                x_file.write("{} ".format(v))
-            x_file.write("\n")
+        x_previous = None
+        y_previous = None
+        if not self.multi_objective.value and preferences is None:
+            x_previous, y_previous = self.load_previous_sessions(history, num_params, binding_plan)
+
+        tasks = None
+        if self.multi_task.value:
+            tasks = list(np.array(history.load_tasks())[compatible])
+
+        frozen = self.get_frozen_parameters(history.load_relevance(), num_params)
+
+        if report is None:
+            report = {}
 
         #
-        # open or create y_file and write the values of the evaluation measurements to it
-        # normalise y before writing it to the file
+        # the thread pools of the linear algebra libraries are limited while the models are fitted and predict
         #
-        with open(y_absolute_path, "a+") as y_file:
-            y_normalised = self.normalise_y(manual_result, auto_evaulation_results, w_manual, w_auto)
-            y_file.write("{}\n".format(y_normalised))
+        with self.limit_threads() as threads:
+            next_x = self.propose_next_x(x, y_model, setting_range, range_steps, num_params, length_scale, alpha, t,
+                                         valid, frozen, report, kinds, ordered, priors, preferences, x_previous,
+                                         y_previous, self.warm_start_weight.value, tasks)
+
+        report["threads"] = threads
+
+        if "relevance" in report:
+            history.append_relevance(report["relevance"])
 
         #
-        # load the x and y values into numpy arrays
-        # x values are the settings values
-        # y values are the percentaged evaluation deviation values normalised and weighted to one single y value
+        # If the max number of iterations is reached, stop B.O.; indicating it with returning None instead of arrays
         #
-        x = np.loadtxt(x_absolute_path)
-        y = np.loadtxt(y_absolute_path)
+        if next_x is None:
+            return None, None
+
+        return next_x, y
+
+    #
+    # helper function:
+    # Return a new random generator for the given iteration of the session; it is not kept on the module, which all
+    # image sets share. The session id is derived from the history file of the module (its output directory and module
+    # number), so two modules, or two optimisations running side by side in one process, draw independent numbers,
+    # while each proposal can be reproduced. Further keys separate the streams used for different purposes in the same
+    # iteration
+    #
+    def get_random_state(self, iteration, *keys):
+        session_id = hashlib.md5(os.path.abspath(self.get_history().path).encode("utf-8"))
+        for key in keys:
+            session_id.update(str(key).encode("utf-8"))
+
+        return np.random.RandomState([int(session_id.hexdigest()[:8], 16), 3*345 + int(iteration)])
+
+    #
+    # Propose the next setting values X from the x and y values of previous rounds; x is a 2D array with one row per
+    # round. The runtimes t are only needed for the cost-aware acquisition; valid marks the rounds whose evaluation
+    # can be trusted (all if None); frozen marks the parameters that keep the value of the best round; kinds are the
+    # kinds of the parameters (all numerical if None), categorical parameters are one-hot encoded for the model;
+    # ordered lists the pairs of columns (i, j) whose values must satisfy x_i < x_j (e.g. the min and max of a range);
+    # priors has a ParameterPrior (or None) per column and weights the random initial design and the acquisition;
+    # preferences are the results of A/B evaluations (None if the rounds were not compared); with preferences, the
+    # model is a preference GP learned from the comparisons; x_previous and y_previous are valid rounds of previous
+    # sessions (warm start), added to the data of the model with their alpha divided by previous_weight; tasks has the
+    # task of each round in the multi-task mode (None otherwise), the proposal is for the task of the last round.
+    # If a report dict is given, the relevance of each parameter and its partial dependence curve are stored in it
+    # once the model hyperparameters are fitted. Returns None if the max. number of iterations is reached.
+    # The method does not read or write any files, so it can also be used to propose settings for rounds that are
+    # evaluated elsewhere (e.g. by the batch optimisation runner)
+    #
+    def propose_next_x(self, x, y, setting_range, range_steps, num_params, length_scale, alpha, t=None, valid=None,
+                       frozen=None, report=None, kinds=None, ordered=None, priors=None, preferences=None,
+                       x_previous=None, y_previous=None, previous_weight=WARM_START_WEIGHT, tasks=None):
 
         #
         # Set up the actual iterative optimisation loop
@@ -1010,8 +4422,9 @@ The variation steps within the chosen range for choosing a candidate set."""
         # use a flexible seed so that each round, different randomised numbers are chosen
         # this is necessary for the randomly chosen X when not enough data is yet available and
         # for the random first 10000 entries of the matrix to chose the candidate set from
+        # the generator belongs to the module, so the global NumPy generator is neither used nor disturbed
         #
-        np.random.seed(3*345 + n_current_iter)
+        random_state = self.get_random_state(n_current_iter)
 
         ########################################################################
         # create a suitable candidate set matrix based on the user input       #
@@ -1019,25 +4432,59 @@ The variation steps within the chosen range for choosing a candidate set."""
         ########################################################################
 
         #
-        # account for case with 1D array in first round and several dimension issues
+        # x has one column per parameter (num_cols)
         #
-        try:
-            num_dimensions = x.ndim
-        except AttributeError:
-            num_dimensions = 0
+        x = np.asarray(x, dtype=float).reshape(-1, num_params)
+        num_cols = num_params
+
+        if valid is None:
+            valid = np.ones(n_current_iter, dtype=bool)
+        valid = np.asarray(valid, dtype=bool)
+
+        if frozen is None:
+            frozen = np.zeros(num_cols, dtype=bool)
+        frozen = np.asarray(frozen, dtype=bool)
+
+        if kinds is None:
+            kinds = [PARAM_FLOAT] * num_cols
 
-        if num_dimensions == 1 and num_params == 1:     # otherwise it would also reshape the first round of x 2D
-            x = x.reshape(-1, 1)
-        elif num_dimensions == 0:                       # accounts for x 1D in first round
-            x = np.array([x])
+        if ordered is None:
+            ordered = []
+
+        if priors is None:
+            priors = [None] * num_cols
+        has_priors = any(prior is not None for prior in priors)
+
+        if y_previous is None or preferences is not None:
+            x_previous = np.zeros((0, num_cols))
+            y_previous = np.zeros(0)
+        x_previous = np.asarray(x_previous, dtype=float).reshape(-1, num_cols)
+        y_previous = np.asarray(y_previous, dtype=float)
+        n_previous = len(y_previous)
 
         #
-        # find out columns of x (num_cols)
+        # in the multi-task mode, the rounds of all tasks are modelled together with one-hot features of their task;
+        # the max. number of iterations and the best round so far refer to the current task. The rounds of other
+        # tasks are not counted as iterations, but they make the random rounds at the start unnecessary
         #
-        try:
-            num_cols = x.shape[1]
-        except IndexError:
-            num_cols = x.shape[0]
+        if tasks is None or preferences is not None:
+            tasks = [""] * len(x)
+        tasks = np.array(tasks)
+        task_names = np.unique(tasks)
+
+        in_task = tasks == (tasks[-1] if len(tasks) > 0 else "")
+        n_other = int(np.sum(valid & ~in_task))
+        n_current_iter = int(np.sum(in_task))
+
+        current = valid & in_task
+        if not np.any(current):
+            current = valid
+
+        #
+        # frozen parameters keep the value of the best valid round
+        #
+        if np.any(frozen) and np.any(valid):
+            x_best = x[current][np.argmin(np.atleast_1d(y)[current])]
 
         #
         # create a 1D candidate set for each x dimension in the range and with the range steps given by user
@@ -1048,80 +4495,97 @@ The variation steps within the chosen range for choosing a candidate set."""
             b = float(setting_range[i][1])
             c = float(range_steps[i])
 
-            candidate = np.arange(a, b, c)
+            if frozen[i] and np.any(valid):
+                candidate = np.array([x_best[i]])
+            else:
+                candidate = np.arange(a, b, c)
             candidate_arrays += [candidate]
 
         # print("CANDIDATE ARRAYS")
         # print(candidate_arrays)
 
-        #
-        # create a matrix for either 1, 2, 3 or 4 parameters with all possible combinations of the 1D-arrays
-        #
-        if num_cols == 1:
-            c = candidate_arrays[0]
-        elif num_cols == 2:
-            c = list(product(candidate_arrays[0], candidate_arrays[1]))
-        elif num_cols == 3:
-            c = list(product(candidate_arrays[0], candidate_arrays[1], candidate_arrays[2]))
-        else:
-            c = list(product(candidate_arrays[0], candidate_arrays[1], candidate_arrays[2], candidate_arrays[3]))
-
-        unstandardised_candidates_array = np.asanyarray(c)
-
-        #
-        # if x is 1D, candidates array needs to be re-shaped
-        #
-        if num_cols == 1:
-            unstandardised_candidates_array = unstandardised_candidates_array.reshape(-1, 1)
-
         #
         # initiate the correction of numbers in array:
         # standardisation of matrix entries; important step in Machine Learning
         # we need to calculate the mean and standard deviation of *all* candidates available (which includes the
-        # already gathered X)
-        # the numbers are used for later calculations
+        # already gathered X); in the grid of all combinations, each column has the mean and standard deviation of
+        # its 1D-array, so they are computed without building the grid.
+        # A column with a single value (e.g. a frozen parameter) is only centred
         #
-
-        # 1st step: get mean from each column in matrix
-        mean_candidates = np.mean(unstandardised_candidates_array, axis=0)
-
-        # 2nd step: subtract mean from matrix
-        cand_1 = unstandardised_candidates_array - mean_candidates
-
-        # 3rd step: calculate standard deviation per column
-        st_dev_candidates = np.std(cand_1, axis=0)
+        mean_candidates = np.array([np.mean(candidate) for candidate in candidate_arrays])
+        st_dev_candidates = np.array([np.std(candidate) for candidate in candidate_arrays])
+        st_dev_candidates[st_dev_candidates == 0] = 1.0
 
         #
-        # check how many entries (rows) the candidate matrix has
+        # check how many entries (rows) the matrix with all possible combinations of the 1D-arrays has
         #
-        num_entries = np.size(unstandardised_candidates_array, axis=0)
+        num_entries = int(np.prod([len(candidate) for candidate in candidate_arrays]))
         # print("NUMBER OF ALL CANDIDATES")
         # print(num_entries)
 
         #
-        # if candidate matrix is too large, take a subset of 10000 randomly chosen entries;
-        # this ensures that the matrix has <= 10.000 row entries
+        # create the matrix of all combinations; if it is too large, draw a subset of MAX_CANDIDATES random
+        # combinations directly instead (duplicates are removed further down).
+        # Combinations violating an order constraint (the min of a range not below its max) are dropped; random
+        # combinations are drawn again until enough feasible ones are found
         #
-        if num_entries > 10000:
-            np.take(unstandardised_candidates_array, np.random.permutation(unstandardised_candidates_array.shape[0]),
-                    axis=0, out=unstandardised_candidates_array)
-            unstandardised_candidates_array = unstandardised_candidates_array[:10000]
+        def is_feasible(combinations):
+            feasible = np.ones(len(combinations), dtype=bool)
+            for i, j in ordered:
+                feasible &= combinations[:, i] < combinations[:, j]
+            return feasible
+
+        if num_entries > MAX_CANDIDATES:
+            unstandardised_candidates_array = np.zeros((0, num_cols))
+
+            for _ in range(10):
+                combinations = np.column_stack([candidate[random_state.randint(len(candidate), size=MAX_CANDIDATES)]
+                                                for candidate in candidate_arrays])
+                unstandardised_candidates_array = np.vstack(
+                    [unstandardised_candidates_array, combinations[is_feasible(combinations)]])
+
+                if len(unstandardised_candidates_array) >= MAX_CANDIDATES:
+                    break
+
+            unstandardised_candidates_array = unstandardised_candidates_array[:MAX_CANDIDATES]
+        else:
+            unstandardised_candidates_array = np.array(list(product(*candidate_arrays)), dtype=float)
+            unstandardised_candidates_array = unstandardised_candidates_array.reshape(-1, num_cols)
+            feasible = is_feasible(unstandardised_candidates_array)
+            unstandardised_candidates_array = unstandardised_candidates_array[feasible]
+
+        if len(unstandardised_candidates_array) == 0:
+            raise ValueError("No setting values lie on the grid of the ranges and steps; the grid of a range setting "
+                             "needs at least two values")
 
         #############################################
         # Init the data for the bayes opt procedure #
         #############################################
 
         #
-        # we need to standardise the current set of x values with the calculated mean and standard deviation
-        # we need to account for case with 1D array in first round
+        # we need to standardise the current set of x values with the calculated mean and standard deviation;
+        # categorical parameters are one-hot encoded instead. The model is fitted on these features, which may be more
+        # than the parameters
         #
-        try:
-            x.shape[1]
-        except IndexError:
-            x = np.array([x])
+        num_choices = [int(setting_range[i][1]) if kinds[i] == PARAM_CHOICE else 1 for i in range(num_cols)]
+
+        x_active_bayesopt, parameter_index = encode_parameters(x, mean_candidates, st_dev_candidates, kinds,
+                                                               num_choices)
 
-        x_1 = x - mean_candidates
-        x_active_bayesopt = x_1 / st_dev_candidates
+        #
+        # with more than one task, the task features follow the parameter features; the rounds of previous sessions
+        # belong to none of the tasks
+        #
+        num_task_features = len(task_names) if len(task_names) > 1 else 0
+        task_features = (tasks[:, None] == task_names[None, :]).astype(float)[:, :num_task_features]
+        x_active_bayesopt = np.hstack((x_active_bayesopt, task_features))
+        num_features = np.size(x_active_bayesopt, axis=1)
+
+        x_previous_bayesopt = np.zeros((0, num_features))
+        if n_previous > 0:
+            x_previous_bayesopt, _ = encode_parameters(x_previous, mean_candidates, st_dev_candidates, kinds,
+                                                       num_choices)
+            x_previous_bayesopt = np.hstack((x_previous_bayesopt, np.zeros((n_previous, num_task_features))))
 
         # print("STANDARDISED X")
         # print(x_active_bayesopt)
@@ -1134,20 +4598,12 @@ The variation steps within the chosen range for choosing a candidate set."""
         #
 
         #
-        # we need to account for case with 1D array for unstandardised candidates
-        #
-        try:
-            unstandardised_candidates_array.shape[1]
-        except IndexError:
-            unstandardised_candidates_array = np.array([unstandardised_candidates_array])
-            unstandardised_candidates_array = unstandardised_candidates_array.reshape(-1, 1)
-
-        #
-        # transform numbers into integers by multiplying them with 1000
+        # transform numbers into integers by multiplying them with 1000; only the settings evaluated for the current
+        # task are removed
         #
         mul_std_cand = np.multiply(unstandardised_candidates_array, 1000)
         mul_std_cand = mul_std_cand.astype(int)
-        mul_x = np.multiply(x, 1000)
+        mul_x = np.multiply(x[in_task], 1000)
         mul_x = mul_x.astype(int)
 
         #
@@ -1167,22 +4623,16 @@ The variation steps within the chosen range for choosing a candidate set."""
         new_candidates_bayesopt = np.divide(new_mul_std_candidates, 1000)   # these are unstandardised and without x
 
         #
-        # now standardise remaining set with the calculated mean and standard deviation
+        # now encode the remaining set in the same way as x
         #
-        cand_2 = new_candidates_bayesopt - mean_candidates
-        candidates_bayesopt = cand_2 / st_dev_candidates
+        candidates_bayesopt, _ = encode_parameters(new_candidates_bayesopt, mean_candidates, st_dev_candidates, kinds,
+                                                   num_choices)
+        candidates_bayesopt = np.hstack((candidates_bayesopt,
+                                         np.tile(task_features[-1:], (len(candidates_bayesopt), 1))))
 
         # print("STANDARDISED CANDIDATES WITHOUT X")
         # print(candidates_bayesopt)
 
-        #
-        # account for the case of x being 1D
-        # needs reshaping before fitting to the model
-        #
-        if num_cols == 1:
-            x_active_bayesopt = x_active_bayesopt.reshape(-1, 1)
-            candidates_bayesopt = candidates_bayesopt.reshape(-1, 1)
-
         #
         # check how many entries (rows) the matrix has now (testing only)
         #
@@ -1191,9 +4641,19 @@ The variation steps within the chosen range for choosing a candidate set."""
         # print(num_entries1)
 
         #
-        # load the already available points y
+        # load the already available points y; failed evaluations are kept out of the regression, they are only used
+        # to learn which settings yield a valid segmentation
+        #
+        y_active_bayesopt = np.atleast_1d(y)[valid]
+
+        #
+        # the model is fitted on the valid rounds and the rounds of previous sessions; the noise of a previous round
+        # is larger by the inverse of its weight
         #
-        y_active_bayesopt = y
+        x_train_bayesopt = np.vstack((x_active_bayesopt[valid], x_previous_bayesopt))
+        y_train_bayesopt = np.concatenate((y_active_bayesopt, y_previous))
+        weight_train = np.concatenate((np.ones(len(y_active_bayesopt)), np.full(n_previous, float(previous_weight))))
+        alpha_train = float(alpha) / weight_train
 
         #
         # Run the procedure once and then return the new best x when no. of iterations is < than max_iter
@@ -1203,9 +4663,11 @@ The variation steps within the chosen range for choosing a candidate set."""
 
             #
             # Update Bayes opt active set with one point selected via EI
-            # (of we have exceeded the initial offset period)
+            # (of we have exceeded the initial offset period); with the rounds of previous sessions, the random
+            # rounds are skipped
             #
-            if n_current_iter > n_offset_bayesopt:
+            if (n_current_iter > n_offset_bayesopt or n_previous + n_other > 0) and \
+                    np.sum(valid) >= 1 and np.sum(valid) + n_previous >= n_offset_bayesopt:
 
                 ###################################
                 # Bayesian Optimisation Procedure #
@@ -1214,9 +4676,12 @@ The variation steps within the chosen range for choosing a candidate set."""
                 print("EXECUTING BAYESIAN OPTIMISATION PROCEDURE")
 
                 #
-                # initialise the kernel (covariance function) for the BO model
+                # initialise the kernel (covariance function) for the BO model;
+                # the RBF kernel has one length scale per parameter (automatic relevance determination), so that the
+                # relevance of each parameter can be read from the fitted length scales
                 #
-                kernel_init = gp.kernels.ConstantKernel(0.1) * gp.kernels.RBF(length_scale=length_scale)
+                kernel_init = gp.kernels.ConstantKernel(0.1) * gp.kernels.RBF(
+                    length_scale=np.full(num_features, float(length_scale)))
 
                 #
                 # after 20 iterations there is enough data to use the optimizer to optimize the kernel's
@@ -1224,29 +4689,45 @@ The variation steps within the chosen range for choosing a candidate set."""
                 #
                 optimizer = None
 
-                if n_current_iter >= 10:
+                if n_current_iter + n_other + n_previous >= 10:
                     optimizer = "fmin_l_bfgs_b"
                     # print("optimiser on")
 
                 #
-                # Define and fit the GP model (using the kernel_bayesopt_init parameters)
+                # Define and fit the GP model (using the kernel_bayesopt_init parameters), or the tree ensemble if
+                # the user chose it as surrogate model
                 #
-                model_bayesopt = gp.GaussianProcessRegressor(kernel=deepcopy(kernel_init),
-                                                             alpha=alpha,
-                                                             n_restarts_optimizer=5,
-                                                             optimizer=optimizer,
-                                                             normalize_y=True)
+                if preferences is not None:
+                    model_bayesopt = PreferenceSurrogate(length_scale)
+                elif self.surrogate.value == SURROGATE_TREES:
+                    model_bayesopt = TreeEnsembleSurrogate(random_state=random_state, n_jobs=self.get_thread_budget())
+                else:
+                    model_bayesopt = gp.GaussianProcessRegressor(kernel=deepcopy(kernel_init),
+                                                                 alpha=alpha_train,
+                                                                 n_restarts_optimizer=5,
+                                                                 optimizer=optimizer,
+                                                                 normalize_y=True,
+                                                                 random_state=random_state)
 
                 #
-                # fit model with available active x and y parameters
+                # fit model with available active x and y parameters; the preference model is fitted on the
+                # comparisons between valid rounds instead, with the round indices mapped to the rows of the valid x
                 #
-                model_bayesopt.fit(x_active_bayesopt, y_active_bayesopt)
+                if preferences is not None:
+                    row = np.cumsum(valid) - 1
+                    duels = [(row[winner], row[loser], weight) for winner, loser, weight in get_duels(preferences)[0]
+                             if valid[winner] and valid[loser]]
+                    model_bayesopt.fit(x_active_bayesopt[valid], duels)
+                elif isinstance(model_bayesopt, TreeEnsembleSurrogate):
+                    model_bayesopt.fit(x_train_bayesopt, y_train_bayesopt, weight_train)
+                else:
+                    self.fit_gaussian_process("quality", model_bayesopt, x_train_bayesopt, y_train_bayesopt)
 
                 #
                 # Find the currently best value (based on the model, not the active data itself as there could be
-                # a tiny difference)
+                # a tiny difference) of the current task
                 #
-                mu_active_bayesopt, sigma_active_bayesopt = model_bayesopt.predict(x_active_bayesopt,
+                mu_active_bayesopt, sigma_active_bayesopt = model_bayesopt.predict(x_active_bayesopt[current],
                                                                                    return_std=True)
                 ind_optimum = np.argmin(mu_active_bayesopt)
                 mu_min_active_bayesopt = mu_active_bayesopt[ind_optimum]
@@ -1258,29 +4739,68 @@ The variation steps within the chosen range for choosing a candidate set."""
                 mu_candidates, sigma_candidates = model_bayesopt.predict(candidates_bayesopt, return_std=True)
 
                 #
-                # Compute the expected improvement for all the candidates
+                # report the relevance and partial dependence of the parameters once the length scales are fitted;
+                # the relevance of the trees is known as soon as they are fitted
+                #
+                if report is not None and not isinstance(model_bayesopt, PreferenceSurrogate) and \
+                        (optimizer is not None or isinstance(model_bayesopt, TreeEnsembleSurrogate)):
+                    self.report_sensitivity(report, model_bayesopt, new_candidates_bayesopt, mu_candidates, frozen,
+                                            parameter_index)
+
+                #
+                # Compute the acquisition function chosen by the user (expected improvement by default) for all the
+                # candidates
+                #
+                acquisition = ACQUISITIONS[self.acquisition.value]
+
+                scores = acquisition.function(mu_candidates, sigma_candidates, mu_min_active_bayesopt,
+                                              n_iter=n_current_iter,
+                                              model=model_bayesopt,
+                                              x_active=x_train_bayesopt,
+                                              y_active=y_train_bayesopt,
+                                              candidates=candidates_bayesopt,
+                                              random_state=random_state)
+
+                #
+                # if some evaluations failed, weigh the scores with the probability that a candidate yields a valid
+                # segmentation
+                #
+                if not np.all(valid):
+                    scores = weigh_acquisition(scores,
+                                               self.predict_feasibility(x_active_bayesopt, valid, candidates_bayesopt,
+                                                                        length_scale, random_state),
+                                               acquisition.scale)
+
+                #
+                # with the cost-aware acquisition, the scores are divided by the predicted runtime of each candidate
+                # (e.g. EI per second)
                 #
-                z = (mu_min_active_bayesopt - mu_candidates) / sigma_candidates
-                ei = (mu_min_active_bayesopt - mu_candidates) * norm.cdf(z) + sigma_candidates * norm.pdf(z)
-                ei[sigma_candidates == 0.0] = 0.0   # Make sure to account for the case where sigma==0 to avoid
-                # numerical issues (would be NaN otherwise)
+                if self.cost_aware.value and t is not None:
+                    runtime_candidates = self.predict_runtime(x_active_bayesopt, t, candidates_bayesopt,
+                                                              length_scale, alpha, random_state)
+                    if runtime_candidates is not None:
+                        scores = weigh_acquisition(scores, 1.0 / runtime_candidates, acquisition.scale)
 
                 #
-                # Find the candidate with the largest expected improvement and choose that one to query/include
+                # weigh the scores with the priors given by the user, raised to the power of beta / n (as in piBO);
+                # beta is a tenth of the max. number of iterations, so the prior loses its influence as data accumulates
                 #
-                eimax = np.max(ei)  # maximum expected improvement
+                if has_priors:
+                    prior_exponent = n_max_iter / 10.0 / n_current_iter
+                    scores = weigh_acquisition(scores,
+                                               get_prior_weights(new_candidates_bayesopt, priors, prior_exponent),
+                                               acquisition.scale)
 
                 #
-                # find all points with the same maximum value of ei in case there are more than one
+                # Find the candidate with the highest score and choose that one to query/include; if there are more
+                # than one, choose randomly among them
                 #
-                i_eimax = np.argwhere(eimax == ei)
-                i_max = np.random.randint(np.size(i_eimax, axis=0), size=1)  # choose randomly among them
-                ind_new_candidate_as_index_in_cand_set = [i_eimax[i_max[0]]]
+                ind_new_candidate = argmax_random_tie(scores, random_state)
 
                 #
                 # get the new suggested x from the candidates
                 #
-                new_x_standardised = candidates_bayesopt[ind_new_candidate_as_index_in_cand_set]
+                next_x = new_candidates_bayesopt[[ind_new_candidate]]
 
             #
             # Skip bayes opt until we reach n_offset_bayesopt and select random points for inclusion
@@ -1289,20 +4809,23 @@ The variation steps within the chosen range for choosing a candidate set."""
             else:
                 print("RANDOMLY choosing new X as not enough data is available")
 
-                ii = np.random.randint(np.size(candidates_bayesopt, axis=0), size=1)
-                new_x_standardised = candidates_bayesopt[ii]
+                #
+                # with priors, the random candidate is drawn from the prior distribution
+                #
+                if has_priors:
+                    prior_weights = get_prior_weights(new_candidates_bayesopt, priors)
+                    ii = [random_state.choice(len(prior_weights), p=prior_weights / np.sum(prior_weights))]
+                else:
+                    ii = random_state.randint(np.size(candidates_bayesopt, axis=0), size=1)
+                next_x = new_candidates_bayesopt[ii]
 
             ###################
             # Return X values #
             ###################
 
             #
-            # now that new setting values X form the candidate set were chosen, they first need to be converted back
-            # by de-standardising them with the standard deviation and mean we have calculated earlier
-            #
-            next_x_meaned = new_x_standardised * st_dev_candidates
-            next_x = next_x_meaned + mean_candidates
-
+            # the new setting values X were chosen from the unstandardised candidates, which are in the same row order
+            # as the encoded ones, so they need not be converted back
             #
             # return the X values to adjust the settings and getting a new y value from the user for next BO round;
             # round values to account for any floating point decimal inaccuracies caused earlier;
@@ -1314,14 +4837,173 @@ The variation steps within the chosen range for choosing a candidate set."""
             # print("NEXT X")
             # print(next_x_round)
 
-            return next_x_round, y_active_bayesopt
+            return next_x_round
 
         #
-        # If the max number of iterations is reached, stop B.O.; indicating it with returning None instead of arrays
+        # If the max number of iterations is reached, stop B.O.; indicating it with returning None
         #
         else:
             print("MAX ITERATIONS REACHED")
-            return None, None
+            return None
+
+    #
+    # helper function:
+    # Store the relevance of each parameter and its partial dependence curve in the report.
+    # The relevance is the inverse of the fitted length scale, normalised to add up to 1; as the x values are
+    # standardised, the length scales of different parameters are comparable. The partial dependence of a parameter
+    # is the mean quality predicted for the candidates sharing each of its values; it is computed for all candidates
+    # at once by summing up the predictions per value
+    #
+    def report_sensitivity(self, report, model, candidates, mu_candidates, frozen, parameter_index=None):
+        if parameter_index is None:
+            parameter_index = np.arange(np.size(candidates, axis=1))
+
+        if isinstance(model, TreeEnsembleSurrogate):
+            relevance = np.asarray(model.feature_importances_, dtype=float)
+        else:
+            length_scales = np.atleast_1d(model.kernel_.k2.length_scale).astype(float)
+            if len(length_scales) == 1:
+                length_scales = np.repeat(length_scales, len(parameter_index))
+
+            relevance = 1.0 / length_scales
+
+        #
+        # the relevance of a categorical parameter is the sum over its one-hot features; the task features following
+        # the parameter features are left out
+        #
+        relevance = np.bincount(parameter_index, weights=relevance[:len(parameter_index)],
+                                minlength=np.size(candidates, axis=1))
+
+        if np.sum(relevance) > 0:
+            relevance = relevance / np.sum(relevance)
+
+        report["relevance"] = relevance
+        report["frozen"] = np.asarray(frozen, dtype=bool)
+
+        report["partial_dependence"] = []
+        for i in range(np.size(candidates, axis=1)):
+            values, inverse = np.unique(candidates[:, i], return_inverse=True)
+            mu_sum = np.bincount(inverse, weights=mu_candidates)
+            count = np.bincount(inverse)
+
+            report["partial_dependence"] += [(values, mu_sum / count)]
+
+    #
+    # helper function:
+    # Return which parameters are frozen: those whose relevance stayed below the threshold in the last rounds. The
+    # relevance history has one row per round; the most relevant parameter of the last round is never frozen
+    #
+    def get_frozen_parameters(self, relevance_history, num_params):
+        frozen = np.zeros(num_params, dtype=bool)
+
+        relevance_history = np.asarray(relevance_history, dtype=float)
+        k = self.freeze_rounds.value
+
+        if not self.freeze_inert.value or relevance_history.ndim != 2 or \
+                relevance_history.shape[1] != num_params or len(relevance_history) < k:
+            return frozen
+
+        frozen = np.all(relevance_history[-k:] < self.relevance_threshold.value, axis=0)
+        frozen[np.argmax(relevance_history[-1])] = False
+
+        return frozen
+
+    #
+    # helper function:
+    # Return the quality recorded for an evaluation that was aborted: the worst valid quality seen so far, but at least
+    # 1 (a deviation of 100%)
+    #
+    def get_failure_penalty(self, y, valid):
+        y = np.atleast_1d(y)[np.asarray(valid, dtype=bool)]
+        y = y[np.isfinite(y)]
+
+        if len(y) == 0:
+            return 1.0
+
+        return max(float(np.max(y)), 1.0)
+
+    #
+    # helper function:
+    # Fit a GP model (regressor or classifier) on x and y. If its optimizer is on and the hyperparameters are fitted in
+    # the background, the model is fitted with the kernel fitted last for the GP of the given name, and the optimizer
+    # runs on the current data in a background thread (see BackgroundKernelFit). A fit still running from the last
+    # round is waited for first, so the kernel used does not depend on how fast the pipeline ran. The first fit of each
+    # GP is done right away
+    #
+    def fit_gaussian_process(self, name, model, x, y):
+        if model.optimizer is None or not self.background_fit.value:
+            return model.fit(x, y)
+
+        kernel_fit = getattr(self, "kernel_fit", None)
+        if kernel_fit is None:
+            kernel_fit = self.kernel_fit = BackgroundKernelFit()
+
+        kernel_fit.wait(name)
+
+        kernel = kernel_fit.get_kernel(name, model.kernel)
+        if kernel is None:
+            model.fit(x, y)
+            kernel_fit.set_kernel(name, model.kernel_)
+
+            return model
+
+        kernel_fit.start(name, deepcopy(model).set_params(kernel=deepcopy(kernel)), x, y, self.get_thread_budget())
+
+        return model.set_params(kernel=kernel, optimizer=None).fit(x, y)
+
+    #
+    # helper function:
+    # Fit a second GP model on the log of the runtimes measured for the active x values and return the runtime in
+    # seconds predicted for each candidate. The log keeps the runtimes positive and copes with settings that are
+    # orders of magnitude slower than others. Returns None if fewer than 3 runtimes are known
+    #
+    def predict_runtime(self, x_active, t, candidates, length_scale, alpha, random_state=None):
+        t = np.asarray(t, dtype=float)
+        measured = np.isfinite(t) & (t > 0)
+
+        if np.sum(measured) < 3:
+            return None
+
+        optimizer = None
+        if np.sum(measured) >= 10:
+            optimizer = "fmin_l_bfgs_b"
+
+        kernel_runtime = gp.kernels.ConstantKernel(0.1) * gp.kernels.RBF(length_scale=length_scale)
+
+        model_runtime = gp.GaussianProcessRegressor(kernel=kernel_runtime,
+                                                    alpha=alpha,
+                                                    n_restarts_optimizer=5,
+                                                    optimizer=optimizer,
+                                                    normalize_y=True,
+                                                    random_state=random_state)
+
+        self.fit_gaussian_process("runtime", model_runtime, x_active[measured], np.log(t[measured]))
+
+        #
+        # the runtime is bounded below by 1 ms so that the division does not blow up for very cheap candidates
+        #
+        return np.maximum(np.exp(model_runtime.predict(candidates)), 1e-3)
+
+    #
+    # helper function:
+    # Fit a GP classifier on which of the active x values gave a valid evaluation and return the probability of a
+    # valid evaluation for each candidate
+    #
+    def predict_feasibility(self, x_active, valid, candidates, length_scale, random_state=None):
+        optimizer = None
+        if len(valid) >= 10:
+            optimizer = "fmin_l_bfgs_b"
+
+        kernel_feasibility = gp.kernels.ConstantKernel(1.0) * gp.kernels.RBF(length_scale=length_scale)
+
+        model_feasibility = gp.GaussianProcessClassifier(kernel=kernel_feasibility,
+                                                         n_restarts_optimizer=5,
+                                                         optimizer=optimizer,
+                                                         random_state=random_state)
+
+        self.fit_gaussian_process("feasibility", model_feasibility, x_active, valid.astype(int))
+
+        return model_feasibility.predict_proba(candidates)[:, list(model_feasibility.classes_).index(1)]
 
     #
     # helper function;
@@ -1393,7 +5075,11 @@ The variation steps within the chosen range for choosing a candidate set."""
 
         with wx.Dialog(None, title="Automated Evaluation finished.", size=(800, 650)) as dlg:
 
-            self.message = ""
+            #
+            # the answer is kept in a dict the button handler can change, not in the module, which all image sets
+            # share
+            #
+            answer = {"message": ""}
 
             #
             # A wx.Sizer automatically adjusts the size of a window's sub-windows
@@ -1477,7 +5163,7 @@ The variation steps within the chosen range for choosing a candidate set."""
             #
             def on_button(event):
                 b = event.GetEventObject().GetLabel()
-                self.message = b
+                answer["message"] = b
                 dlg.EndModal(1)
                 plt.close(figure)
 
@@ -1494,7 +5180,7 @@ The variation steps within the chosen range for choosing a candidate set."""
             # Return the quality measure set by button press (or window close; default = 0); if quality is
             # satisfying, return 1, if not return 0
             #
-            if self.message == "Quality ok":
+            if answer["message"] == "Quality ok":
                 return 1
             else:
                 return 0
@@ -0,0 +1,682 @@
+# coding=utf-8
+
+"""
+Command-line batch optimisation for pipelines using the BayesianOptimisation module.
+
+License: Please note that the CellProfiler Software was released under the BSD 3-Clause License by
+the Broad Institute: Copyright © 2003 - 2018 Broad Institute, Inc. All rights reserved. Please refer to
+CellProfiler's LICENSE document for details.
+
+"""
+
+#################################
+#
+# Imports from useful Python libraries
+#
+#################################
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+import numpy as np
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+#################################
+#
+# Imports from CellProfiler
+#
+#################################
+
+import cellprofiler.preferences
+
+
+__doc__ = """\
+bayesopt_batch
+==============
+
+**bayesopt_batch** runs the optimisation of a BayesianOptimisation module without the GUI, e.g. overnight on a
+many-core machine. It loads a pipeline or project file, reads the parameters and ranges chosen in its
+BayesianOptimisation module and starts a pool of worker processes. Each round, the optimiser proposes one set of
+settings per worker (using the current best quality as placeholder for the pending proposals); the workers run the
+pipeline with the proposed settings on the image sets and return the weighted evaluation result.
+
+An evaluation running longer than the time budget set in the module (or --timeout) is given up and recorded as
+failed; the workers are then restarted, so that a runaway evaluation does not stall the optimisation. The same
+happens to an evaluation whose worker process stops, and to the evaluations of a round that no worker starts within
+10 minutes. A worker that cannot load the pipeline stops the optimisation with its error.
+
+The state of the optimisation is saved after every evaluation, so an interrupted run can be continued with
+--resume. When the optimisation stops, the best settings found are written to a new pipeline file.
+
+Unless the module sets a thread budget, the model uses at most the cores divided by the workers; the number of threads
+it actually used is printed with the progress.
+
+Usage::
+
+    python bayesopt_batch.py CellSegmentation/Automatic_Task2.cpproj --images "CellSegmentation/train images"
+        --workers 16 --output Automatic_Task2_optimised.cppipe
+
+The pipeline may only use an AutomatedEvaluation, as there is no user who could answer a ManualEvaluation. The
+multi-objective mode of the module is not supported; the workers return the weighted evaluation result only.
+"""
+
+#
+# the objects a worker process needs to evaluate proposals; set up once per process by init_worker
+#
+worker_state = {}
+
+#
+# seconds after which the evaluations of a round that no worker has started are given up, if no other evaluation of
+# the round is running; the pool replaces workers that stop, e.g. while they are set up, so it would wait forever
+#
+START_TIMEOUT = 600
+
+
+#
+# helper function:
+# Set up CellProfiler for running without the GUI, with the plugins from the given directory
+#
+def start_cellprofiler(plugins_directory):
+    cellprofiler.preferences.set_headless()
+    cellprofiler.preferences.set_plugin_directory(plugins_directory, globally=False)
+
+
+#
+# helper function:
+# Load a pipeline (.cppipe) or project (.cpproj) file and add the images found in the image directory to it
+#
+def load_pipeline(pipeline_path, image_directory=None):
+    #
+    # imported here, as CellProfiler needs to know that it runs headless before the pipeline is imported
+    #
+    import cellprofiler.pipeline
+    import cellprofiler.modules.loadimages
+
+    pipeline = cellprofiler.pipeline.Pipeline()
+    pipeline.load(pipeline_path)
+
+    if image_directory is not None:
+        urls = []
+        for dirpath, _, filenames in os.walk(image_directory):
+            for filename in sorted(filenames):
+                urls += [cellprofiler.modules.loadimages.pathname2url(
+                    os.path.join(os.path.abspath(dirpath), filename))]
+
+        pipeline.add_urls(urls)
+
+    return pipeline
+
+
+#
+# helper function:
+# Return the first enabled BayesianOptimisation module of the pipeline
+#
+def find_optimiser(pipeline):
+    for module in pipeline.modules():
+        if module.module_name == "BayesianOptimisation" and module.enabled:
+            return module
+
+    raise ValueError("The pipeline does not contain a BayesianOptimisation module")
+
+
+#####################################################
+# Worker processes evaluating the proposed settings #
+#####################################################
+
+#
+# Initialiser of the worker processes. An error is kept and raised by every evaluation of the worker, as the pool
+# would otherwise replace the worker again and again without ever reporting the error
+#
+def init_worker(*args):
+    try:
+        set_up_worker(*args)
+    except Exception:
+        worker_state["error"] = traceback.format_exc()
+
+
+#
+# helper function:
+# Load the pipeline, prepare the image sets and compile the binding plan once per worker. The workers report the
+# start of each evaluation to the started queue, so that the main process can time them
+#
+def set_up_worker(pipeline_path, image_directory, plugins_directory, max_image_sets, started_queue):
+    start_cellprofiler(plugins_directory)
+
+    import cellprofiler.image
+    import cellprofiler.measurement
+    import cellprofiler.utilities.cpjvm
+    import cellprofiler.workspace
+
+    #
+    # the VM ends with the worker process; pool workers leave through os._exit, so an exit handler stopping it would
+    # never run
+    #
+    cellprofiler.utilities.cpjvm.cp_start_vm()
+
+    pipeline = load_pipeline(pipeline_path, image_directory)
+    optimiser = find_optimiser(pipeline)
+
+    #
+    # the optimiser itself does not run in the workers; the workers only evaluate its proposals
+    #
+    optimiser.enabled = False
+
+    #
+    # check the number of input objects right after the module identifying them; an implausible number skips the
+    # rest of the image set, so the measurement and evaluation modules do not run for a useless segmentation
+    #
+    run_module = pipeline.run_module
+
+    def run_module_checked(module, module_workspace):
+        run_module(module, module_workspace)
+
+        count_window = optimiser.get_plausible_count_window()
+        if count_window is not None and optimiser.provides_input_objects(module):
+            count = module_workspace.object_set.get_objects(optimiser.input_object_name.value).count
+            if not count_window[0] <= count <= count_window[1]:
+                worker_state["rejected"] = True
+                module_workspace.disposition = cellprofiler.workspace.DISPOSITION_SKIP
+
+    pipeline.run_module = run_module_checked
+
+    measurements = cellprofiler.measurement.Measurements(mode="memory")
+    workspace = cellprofiler.workspace.Workspace(pipeline, None, None, None, measurements,
+                                                 cellprofiler.image.ImageSetList())
+
+    if not pipeline.prepare_run(workspace):
+        raise RuntimeError("The image sets of the pipeline could not be prepared")
+
+    image_numbers = list(measurements.get_image_numbers())
+    if max_image_sets > 0:
+        image_numbers = image_numbers[:max_image_sets]
+
+    worker_state.update(pipeline=pipeline,
+                        optimiser=optimiser,
+                        binding_plan=optimiser.compile_binding_plan(pipeline),
+                        measurements=measurements,
+                        image_numbers=image_numbers,
+                        started_queue=started_queue)
+
+
+#
+# handlers passed to the pipeline when an image set is run in a worker
+#
+def interaction_handler(module, *args, **kwargs):
+    raise RuntimeError("{} needs user interaction, which is not possible in a batch optimisation".format(
+        module.module_name))
+
+
+def display_handler(*args, **kwargs):
+    pass
+
+
+def cancel_handler():
+    return False
+
+
+#
+# Run the pipeline with the proposed setting values on the image sets of the worker; the result is the mean of the
+# weighted evaluation results over all image sets. The evaluation is only valid if it is valid on every image set and
+# stays within the object-count budget of the module. It is rejected as soon as the number of input objects of an
+# image set is implausible
+#
+def evaluate_proposal(evaluation_id, values):
+    if "error" in worker_state:
+        raise RuntimeError("The worker could not load the pipeline:\n{}".format(worker_state["error"]))
+
+    start_time = time.time()
+
+    worker_state["started_queue"].put((evaluation_id, os.getpid(), start_time))
+
+    pipeline = worker_state["pipeline"]
+    optimiser = worker_state["optimiser"]
+    binding_plan = worker_state["binding_plan"]
+    measurements = worker_state["measurements"]
+
+    binding_plan.apply(values, notify=False)
+
+    y_values = []
+    valid = True
+    worker_state["rejected"] = False
+    for image_number in worker_state["image_numbers"]:
+        pipeline.run_image_set(measurements, image_number, interaction_handler, display_handler, cancel_handler)
+
+        if worker_state["rejected"]:
+            valid = False
+            break
+
+        manual_evaluation_result, auto_evaluation_results, _ = optimiser.get_evaluation_results(measurements)
+
+        valid = valid and optimiser.is_valid_evaluation(measurements,
+                                                        manual_evaluation_result,
+                                                        auto_evaluation_results)
+
+        valid = valid and not exceeds_object_budget(measurements, optimiser.object_budget.value)
+
+        y_values += [optimiser.normalise_y(manual_evaluation_result,
+                                           auto_evaluation_results,
+                                           optimiser.weighting_manual.value,
+                                           optimiser.weighting_auto.value)]
+
+    return {"x": [float(v) for v in binding_plan.get_values()],
+            "y": float(np.mean(y_values)) if len(y_values) > 0 else np.nan,
+            "rejected": worker_state["rejected"],
+            "seconds": time.time() - start_time,
+            "valid": valid,
+            "image_sets": len(y_values),
+            "worker": os.getpid()}
+
+
+#
+# helper function:
+# Return True if an object count measured for the current image set exceeds the budget; 0 means no limit
+#
+def exceeds_object_budget(measurements, max_objects):
+    import cellprofiler.measurement
+
+    if max_objects <= 0:
+        return False
+
+    for feature in measurements.get_feature_names(cellprofiler.measurement.IMAGE):
+        if feature.startswith("Count_") and measurements.get_current_image_measurement(feature) > max_objects:
+            return True
+
+    return False
+
+
+###############################################
+# Optimisation state, proposals and reporting #
+###############################################
+
+#
+# helper function:
+# Load the saved state of an optimisation or create a new one for the parameters of the binding plan
+#
+def load_state(state_path, binding_plan, resume):
+    if resume and os.path.exists(state_path):
+        with open(state_path) as state_file:
+            state = json.load(state_file)
+
+        if state["names"] != binding_plan.names:
+            raise ValueError("The saved optimisation in {} adjusts other settings ({}) than the pipeline ({})".format(
+                state_path, ", ".join(state["names"]), ", ".join(binding_plan.names)))
+
+        #
+        # states saved before failed evaluations were recorded only contain valid evaluations
+        #
+        state.setdefault("valid", [True] * len(state["y"]))
+        state.setdefault("relevance", [])
+
+        return state
+
+    return {"names": binding_plan.names, "x": [], "y": [], "seconds": [], "valid": [], "relevance": [],
+            "workers": {}}
+
+
+#
+# helper function:
+# Save the state of the optimisation; the state is written to a temporary file first and then renamed, so that an
+# interrupted run never leaves a half-written state behind
+#
+def save_state(state_path, state):
+    temporary_path = "{}.tmp".format(state_path)
+
+    with open(temporary_path, "w") as state_file:
+        json.dump(state, state_file, indent=1)
+
+    os.rename(temporary_path, state_path)
+
+
+#
+# helper function:
+# Return the y values of the state with failed evaluations set to infinity, so that they are never the best ones
+#
+def get_valid_y(state):
+    return np.where(np.array(state["valid"], dtype=bool), np.array(state["y"], dtype=float), np.inf)
+
+
+#
+# helper function:
+# Propose settings for all workers of a round. Proposals still being evaluated are added to the data with the best
+# quality found so far ("constant liar") and an unknown runtime, so that the proposals of one round differ from each
+# other. The relevance of the parameters is taken from the first proposal, the only one fitted on evaluated data only,
+# together with the number of threads the model used (None if it is not known).
+# x_previous and y_previous are the rounds of previous sessions the optimisation is warm-started from
+#
+def propose_batch(optimiser, binding_plan, state, batch_size, x_previous=None, y_previous=None):
+    x = [list(row) for row in state["x"]]
+    y = list(state["y"])
+    t = list(state["seconds"])
+    valid = list(state["valid"])
+    proposals = []
+
+    #
+    # the first proposal of a new optimisation are the settings saved in the pipeline
+    #
+    if len(x) == 0:
+        proposals += [[float(v) for v in binding_plan.get_values()]]
+        x += [proposals[0]]
+        y += [0.0]
+        t += [np.nan]
+        valid += [True]
+
+    valid_y = get_valid_y(state)
+    lie = np.min(valid_y) if np.any(np.isfinite(valid_y)) else 0.0
+
+    frozen = optimiser.get_frozen_parameters(state["relevance"], len(binding_plan))
+
+    while len(proposals) < batch_size:
+        report = {} if len(proposals) == 0 else None
+
+        with optimiser.limit_threads() as threads:
+            next_x = optimiser.propose_next_x(np.array(x), np.array(y), binding_plan.ranges, binding_plan.steps,
+                                              len(binding_plan), optimiser.length_scale.value, optimiser.alpha.value,
+                                              np.array(t), np.array(valid), frozen, report, binding_plan.kinds,
+                                              binding_plan.ordered, binding_plan.priors, x_previous=x_previous,
+                                              y_previous=y_previous,
+                                              previous_weight=optimiser.warm_start_weight.value)
+
+        if report is not None and "relevance" in report:
+            state["relevance"] += [[float(r) for r in report["relevance"]]]
+
+        if report is not None:
+            state["threads"] = threads
+
+        if next_x is None:
+            break
+
+        next_x = [float(v) for v in next_x.flatten()]
+        proposals += [next_x]
+        x += [next_x]
+        y += [lie]
+        t += [np.nan]
+        valid += [True]
+
+    return proposals
+
+
+#
+# helper function:
+# Wait for the evaluations of a round. An evaluation is given up if it runs longer than the timeout (0 for no limit),
+# if the worker process running it stops, or if no worker starts it within START_TIMEOUT while no other evaluation of
+# the round is running. Its result is None; the pid of its worker (None if it was not started), the seconds it ran
+# and the reason are returned in given_up
+#
+def collect_results(pending, started_queue, timeout):
+    results = [None] * len(pending)
+    finished = [False] * len(pending)
+    started = {}
+    given_up = {}
+    last_progress = time.time()
+
+    while not all(finished):
+        try:
+            while True:
+                evaluation_id, worker, start_time = started_queue.get_nowait()
+                started[evaluation_id] = (worker, start_time)
+                last_progress = time.time()
+        except queue.Empty:
+            pass
+
+        workers = set(process.pid for process in multiprocessing.active_children())
+        running = False
+
+        for i, (evaluation_id, result) in enumerate(pending):
+            if finished[i]:
+                continue
+
+            if result.ready():
+                results[i] = result.get()
+                finished[i] = True
+                last_progress = time.time()
+
+            elif evaluation_id in started:
+                worker, start_time = started[evaluation_id]
+
+                if worker not in workers:
+                    given_up[i] = (worker, time.time() - start_time, "its worker process stopped")
+                    finished[i] = True
+
+                elif timeout > 0 and time.time() - start_time > timeout:
+                    given_up[i] = (worker, timeout, "timed out after {}s".format(timeout))
+                    finished[i] = True
+
+                else:
+                    running = True
+
+        if not running and time.time() - last_progress > START_TIMEOUT:
+            for i in range(len(pending)):
+                if not finished[i]:
+                    given_up[i] = (None, 0.0, "no worker started it within {}s".format(START_TIMEOUT))
+                    finished[i] = True
+
+        time.sleep(0.05)
+
+    return results, given_up
+
+
+#
+# helper function:
+# Add the result of an evaluation to the state and update the throughput statistics of the worker
+#
+def record_result(state, result):
+    state["x"] += [result["x"]]
+    state["y"] += [result["y"]]
+    state["seconds"] += [result["seconds"]]
+    state["valid"] += [result["valid"]]
+
+    if result["worker"] is None:
+        return
+
+    worker = state["workers"].setdefault(str(result["worker"]), {"evaluations": 0, "image_sets": 0, "seconds": 0.0})
+    worker["evaluations"] += 1
+    worker["image_sets"] += result["image_sets"]
+    worker["seconds"] += result["seconds"]
+
+
+#
+# helper function:
+# Print the progress of the optimisation, the number of threads the model used and the throughput of each worker
+#
+def report_progress(state, max_iterations, start_time):
+    y = get_valid_y(state)
+    ind_best = int(np.argmin(y))
+    elapsed = time.time() - start_time
+
+    print("Evaluations: {}/{} ({} failed)   best quality: {:.4f}   best settings: {}   elapsed: {:.0f}s".format(
+        len(y), max_iterations, state["valid"].count(False), y[ind_best],
+        ", ".join("{}={}".format(name, value) for name, value in zip(state["names"], state["x"][ind_best])),
+        elapsed))
+
+    if len(state["relevance"]) > 0:
+        print("    relevance: {}".format(", ".join(
+            "{}={:.3f}".format(name, r) for name, r in zip(state["names"], state["relevance"][-1]))))
+
+    if state.get("threads") is not None:
+        print("    model threads: {}".format(state["threads"]))
+
+    for worker, statistics in sorted(state["workers"].items()):
+        seconds = max(statistics["seconds"], 1e-9)
+        print("    worker {}: {} evaluations, {:.2f} evaluations/min, {:.2f} image sets/s".format(
+            worker, statistics["evaluations"], 60.0 * statistics["evaluations"] / seconds,
+            statistics["image_sets"] / seconds))
+
+    sys.stdout.flush()
+
+
+#
+# helper function:
+# Return True if the optimisation should stop: max. iterations reached, quality satisfied or no improvement for the
+# number of rounds set in the module. Failed evaluations never satisfy the quality or count as an improvement, and
+# there is no convergence before the first valid evaluation
+#
+def is_finished(state, max_iterations, convergence_rounds):
+    y = list(get_valid_y(state))
+
+    if len(y) >= max_iterations:
+        return True
+
+    if len(y) > 0 and min(y) <= 0.0:
+        return True
+
+    if convergence_rounds > 0 and len(y) > convergence_rounds and np.any(np.isfinite(y)):
+        return min(y[-convergence_rounds:]) >= min(y[:-convergence_rounds])
+
+    return False
+
+
+################
+# Main program #
+################
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Optimise the settings chosen in the BayesianOptimisation module of "
+                                                 "a pipeline without the GUI, using a pool of worker processes.")
+    parser.add_argument("pipeline", help="pipeline (.cppipe) or project (.cpproj) file")
+    parser.add_argument("--images", required=True, help="directory with the images to run the pipeline on")
+    parser.add_argument("--output", help="pipeline file the best settings are written to "
+                                         "(default: <pipeline>_optimised.cppipe)")
+    parser.add_argument("--state", help="file saving the state of the optimisation (default: <output>.json)")
+    parser.add_argument("--resume", action="store_true", help="continue the optimisation saved in the state file")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="number of worker processes (default: number of cores)")
+    parser.add_argument("--iterations", type=int, default=0,
+                        help="max. number of evaluations (default: the max. iterations set in the module)")
+    parser.add_argument("--image-sets", type=int, default=0,
+                        help="number of image sets each proposal is evaluated on (default: all)")
+    parser.add_argument("--timeout", type=float,
+                        help="seconds after which an evaluation is given up (default: the time budget set in the "
+                             "module; 0 for no limit)")
+    parser.add_argument("--plugins-directory", default=os.path.dirname(os.path.abspath(__file__)),
+                        help="directory with the evaluation and optimisation plugins (default: this directory)")
+    options = parser.parse_args(args)
+
+    output_path = options.output or "{}_optimised.cppipe".format(os.path.splitext(options.pipeline)[0])
+    state_path = options.state or "{}.json".format(output_path)
+
+    start_cellprofiler(options.plugins_directory)
+
+    pipeline = load_pipeline(options.pipeline)
+    optimiser = find_optimiser(pipeline)
+    binding_plan = optimiser.compile_binding_plan(pipeline)
+
+    for m in optimiser.measurements:
+        if m.evaluation_measurement.value_text == "Evaluation_ManualQuality":
+            parser.error("the pipeline uses a ManualEvaluation, which needs user interaction")
+
+    if optimiser.multi_objective.value:
+        parser.error("the multi-objective mode is not supported; the workers only return the weighted quality")
+
+    #
+    # the models are fitted in the background while the workers evaluate the proposals, so by default they share the
+    # cores with the workers
+    #
+    if optimiser.thread_budget.value == 0:
+        optimiser.thread_budget.value = max(1, multiprocessing.cpu_count() // options.workers)
+
+    max_iterations = options.iterations or optimiser.max_iter.value
+    state = load_state(state_path, binding_plan, options.resume)
+
+    #
+    # the rounds of previous sessions saved in the warm-start directory of the module, if warm-starting is on
+    #
+    x_previous, y_previous = optimiser.load_previous_sessions(optimiser.get_history(binding_plan), len(binding_plan),
+                                                              binding_plan)
+
+    print("Optimising {} with {} workers: {}".format(options.pipeline, options.workers, ", ".join(binding_plan.names)))
+
+    timeout = options.timeout if options.timeout is not None else optimiser.time_budget.value
+
+    started_queue = multiprocessing.Queue()
+
+    def start_pool():
+        return multiprocessing.Pool(options.workers,
+                                    initializer=init_worker,
+                                    initargs=(os.path.abspath(options.pipeline), os.path.abspath(options.images),
+                                              options.plugins_directory, options.image_sets, started_queue))
+
+    pool = start_pool()
+
+    start_time = time.time()
+
+    try:
+        while not is_finished(state, max_iterations, optimiser.convergence_rounds.value):
+            batch_size = min(options.workers, max_iterations - len(state["y"]))
+            proposals = propose_batch(optimiser, binding_plan, state, batch_size, x_previous, y_previous)
+
+            if len(proposals) == 0:
+                break
+
+            evaluation_ids = range(len(state["y"]), len(state["y"]) + len(proposals))
+            pending = [(evaluation_id, pool.apply_async(evaluate_proposal, (evaluation_id, proposal)))
+                       for evaluation_id, proposal in zip(evaluation_ids, proposals)]
+
+            results, given_up = collect_results(pending, started_queue, timeout)
+
+            for i, (proposal, result) in enumerate(zip(proposals, results)):
+                #
+                # an evaluation that was given up is recorded as failed with the worst quality seen so far
+                #
+                if result is None:
+                    worker, seconds, reason = given_up[i]
+                    print("Evaluation of {} given up: {}".format(proposal, reason))
+                    result = {"x": proposal,
+                              "y": optimiser.get_failure_penalty(state["y"], state["valid"]),
+                              "seconds": seconds,
+                              "valid": False,
+                              "image_sets": 0,
+                              "rejected": False,
+                              "worker": worker}
+
+                #
+                # a rejected evaluation gets the worst quality seen so far, too
+                #
+                elif result["rejected"]:
+                    print("Evaluation of {} rejected: implausible number of objects".format(result["x"]))
+                    result["y"] = optimiser.get_failure_penalty(state["y"], state["valid"])
+
+                record_result(state, result)
+                save_state(state_path, state)
+
+            #
+            # the workers of timed out evaluations are still busy; replace them instead of waiting for them
+            #
+            if len(given_up) > 0:
+                pool.terminate()
+                pool.join()
+                pool = start_pool()
+
+            report_progress(state, max_iterations, start_time)
+
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if len(state["y"]) == 0:
+        print("No settings were evaluated.")
+        return 1
+
+    #
+    # write the best settings found to the new pipeline file
+    #
+    ind_best = int(np.argmin(get_valid_y(state)))
+    binding_plan.apply(state["x"][ind_best], notify=False)
+    pipeline.savetxt(output_path)
+
+    print("Best quality {:.4f} after {} evaluations. Settings written to {}".format(
+        state["y"][ind_best], len(state["y"]), output_path))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
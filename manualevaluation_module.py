@@ -16,6 +16,20 @@ CellProfiler's LICENSE document for details.
 #
 #################################
 
+import contextlib
+import os
+import threading
+
+#
+# the overlay of the best outlines is locked against other processes with fcntl.flock, or with msvcrt.locking on
+# Windows
+#
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
 import numpy
 import skimage.color
 import skimage.segmentation
@@ -47,6 +61,10 @@ The first object chosen in this module will be treated as the main object on whi
 will be saved. Further supporting object outlines can be chosen for display.
 Their quality will not be measured or rated.
 
+Instead of rating the quality on a scale from 1 to 10, the user can compare the outlines of the current settings with
+the outlines of the best settings so far (A/B evaluation) and pick the better ones. Such a comparison takes seconds
+and is more consistent than an absolute rating.
+
 ============ ============ ===============
 Supports 2D? Supports 3D? Respects masks?
 ============ ============ ===============
@@ -80,6 +98,18 @@ Measurements made by this module
 quality of the selected object to a pre-defined minimum quality threshold.
         e.g.    the deviation of a manual quality of 5 to the quality threshold 9 will be 44.4 (%)
 
+-  *Evaluation_Preference*: Measured instead of the manual quality in the A/B evaluation mode: 1 if the current
+outlines are better than the best so far, 0 if they are worse and 0.5 if they are about the same. The outlines of the
+first round have nothing to be compared with; they are the first best so far and measured as 1. If the window is
+closed without an answer, the measurement is NaN and the optimisation skips the round.
+
+
+Technical notes
+^^^^^^^^^^^^^^^
+In the A/B evaluation mode, the overlay of the best outlines so far is saved as a numpy file in the chosen folder and
+replaced whenever the current outlines are preferred. It is kept until it is deleted with the *Delete the best outlines
+so far* button; delete it whenever the data of the **BayesianOptimisation** module is deleted.
+
 """
 
 #
@@ -88,10 +118,32 @@ quality of the selected object to a pre-defined minimum quality threshold.
 CATEGORY = 'Evaluation'
 QUALITY = 'ManualQuality'
 FEATURE_NAME = 'Evaluation_ManualQuality'
+PREFERENCE = 'Preference'
+PREFERENCE_FEATURE_NAME = 'Evaluation_Preference'
 
-NUM_FIXED_SETTINGS = 4
+NUM_FIXED_SETTINGS = 6
 NUM_GROUP_SETTINGS = 2
 
+#
+# evaluation modes
+#
+MODE_RATING = "Rate the quality (1-10)"
+MODE_COMPARISON = "Compare with the best so far (A/B)"
+
+#
+# measured preference of the current outlines over the best outlines so far
+#
+PREFERENCE_CURRENT = 1.0
+PREFERENCE_EQUAL = 0.5
+PREFERENCE_BEST = 0.0
+
+#
+# guards the overlay of the best outlines so far; image sets processed at the same time compare with it one after the
+# other, so that each comparison sees the best outlines of the previous one. Image sets processed by other processes
+# are kept out by the lock file next to the overlay (see lock_incumbent), which is taken while this lock is held
+#
+INCUMBENT_LOCK = threading.Lock()
+
 COLORS = {"White": (1, 1, 1),
           "Black": (0, 0, 0),
           "Red": (1, 0, 0),
@@ -102,6 +154,44 @@ COLORS = {"White": (1, 1, 1),
 COLOR_ORDER = ["Red", "Green", "Blue", "Yellow", "White", "Black"]
 
 
+#
+# helper function:
+# Hold the overlay of the best outlines at path against the threads of this process and against other processes, e.g.
+# the workers of CellProfiler processing other image sets: an exclusive lock on the lock file next to the overlay,
+# taken while INCUMBENT_LOCK is held
+#
+@contextlib.contextmanager
+def lock_incumbent(path):
+    with INCUMBENT_LOCK:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        with open("{}.lock".format(os.path.splitext(path)[0]), "a+") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            else:
+                #
+                # msvcrt locks a byte at the current position and gives up after 10 seconds, so it is tried until it
+                # succeeds
+                #
+                lock_file.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except IOError:
+                        pass
+
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+                else:
+                    lock_file.seek(0)
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
 #
 # Create module class which inherits from cellprofiler.module.Module class
 #
@@ -114,7 +204,7 @@ class ManualEvaluation(cellprofiler.module.Module):
     # released in a new version
     #
     module_name = 'ManualEvaluation'
-    variable_revision_number = 1
+    variable_revision_number = 2
     category = "Advanced"
 
     #######################################################################
@@ -136,6 +226,23 @@ class ManualEvaluation(cellprofiler.module.Module):
         #
         self.set_notes([" ".join(module_explanation)])
 
+        #
+        # Choose between an absolute rating and a comparison with the best outlines so far
+        #
+        self.evaluation_mode = cellprofiler.setting.Choice(
+            "Evaluation mode",
+            [MODE_RATING, MODE_COMPARISON],
+            value=MODE_RATING,
+            doc="""\
+Choose how the identified objects are evaluated:
+
+-  *{}:* Rate the quality of the outlines on a scale from 1 to 10.
+-  *{}:* Compare the outlines side by side with the best outlines so far and pick the better ones. Choose the 
+   *Evaluation_Preference* measurement in the **BayesianOptimisation** module; the optimisation then learns from 
+   the comparisons.
+""".format(MODE_RATING, MODE_COMPARISON)
+        )
+
         #
         # Minimum quality threshold for the identification quality of an object
         #
@@ -149,6 +256,33 @@ This is the quality threshold for the object identification quality evaluation.
         """
         )
 
+        #
+        # Folder in which the overlay of the best outlines so far is kept for the A/B evaluation
+        #
+        self.incumbent_directory = cellprofiler.setting.DirectoryPath(
+            "Folder for the best outlines so far",
+            dir_choices=[
+                cellprofiler.preferences.DEFAULT_OUTPUT_FOLDER_NAME,
+                cellprofiler.preferences.DEFAULT_INPUT_FOLDER_NAME,
+                cellprofiler.preferences.ABSOLUTE_FOLDER_NAME,
+                cellprofiler.preferences.DEFAULT_OUTPUT_SUBFOLDER_NAME,
+                cellprofiler.preferences.DEFAULT_INPUT_SUBFOLDER_NAME],
+            doc="""\
+Choose the folder where the overlay of the best outlines so far is saved. Use the output file location of the 
+**BayesianOptimisation** module."""
+        )
+
+        #
+        # Button for deleting the best outlines so far, e.g. when the data of the optimisation is deleted
+        #
+        self.delete_incumbent_button = cellprofiler.setting.DoSomething(
+            "",
+            "Delete the best outlines so far",
+            self.delete_incumbent,
+            doc="""Delete the overlay of the best outlines so far. Do this whenever you delete the data of the
+**BayesianOptimisation** module, so that a new optimisation does not compare with the outlines of the old one."""
+        )
+
         self.divider = cellprofiler.setting.Divider()
 
         #
@@ -284,7 +418,7 @@ image can be selected in later modules (for instance, **SaveImages**).
     #
     def settings(self):
         result = [self.accuracy_threshold, self.image_name, self.output_image_name,
-                  self.line_mode]
+                  self.line_mode, self.evaluation_mode, self.incumbent_directory]
         for outline in self.outlines:
             result += [outline.color, outline.objects_name]
         return result
@@ -294,7 +428,12 @@ image can be selected in later modules (for instance, **SaveImages**).
     # include buttons and dividers which are not added in the settings method
     #
     def visible_settings(self):
-        result = [self.accuracy_threshold, self.divider, self.image_name]
+        result = [self.evaluation_mode]
+        if self.evaluation_mode.value == MODE_RATING:
+            result += [self.accuracy_threshold]
+        else:
+            result += [self.incumbent_directory, self.delete_incumbent_button]
+        result += [self.divider, self.image_name]
         result += [self.output_image_name, self.line_mode, self.spacer]
         for outline in self.outlines:
             if hasattr(outline, "divider"):
@@ -305,6 +444,17 @@ image can be selected in later modules (for instance, **SaveImages**).
         result += [self.add_outline_button]
         return result
 
+    #
+    # upgrade settings saved with an earlier revision of the module;
+    # the evaluation mode and the folder of the best outlines follow the 4 settings before the outline groups
+    #
+    def upgrade_settings(self, setting_values, variable_revision_number, module_name, from_matlab):
+        if variable_revision_number == 1:
+            setting_values = setting_values[:4] + [MODE_RATING, self.incumbent_directory.value] + setting_values[4:]
+            variable_revision_number = 2
+
+        return setting_values, variable_revision_number, from_matlab
+
     ###################################################################
     # Run method will be executed in a worker thread of the pipeline #
     ###################################################################
@@ -346,6 +496,10 @@ image can be selected in later modules (for instance, **SaveImages**).
         base_pixel_data = image.pixel_data
         out_pixel_data = output_image.pixel_data
 
+        if self.evaluation_mode.value == MODE_COMPARISON:
+            self.run_comparison(workspace, base_pixel_data, out_pixel_data)
+            return
+
         #
         # Interrupt pipeline execution and send interaction request to workspace.
         # As the run-method is executed in a separate thread, it needs to give control to the UI thread.
@@ -389,11 +543,77 @@ image can be selected in later modules (for instance, **SaveImages**).
         #
         workspace.add_measurement(self.outlines[0].objects_name.value, FEATURE_NAME, dev_array)
 
+    #
+    # A/B evaluation: let the user compare the current outlines with the best outlines so far and save the preference
+    # as measurement. The overlay of the preferred outlines is kept as the new best so far; in the first round there
+    # is nothing to compare with, so the current outlines become the best so far without asking
+    #
+    def run_comparison(self, workspace, base_pixel_data, out_pixel_data):
+        with lock_incumbent(self.get_incumbent_path(workspace.measurements)):
+            preference = self.compare_with_incumbent(workspace, base_pixel_data, out_pixel_data)
+
+        workspace.add_measurement(self.outlines[0].objects_name.value, PREFERENCE_FEATURE_NAME,
+                                  numpy.array([float(preference)]))
+
+    #
+    # helper method;
+    # Ask the user for the preference of the current outlines over the best outlines so far and keep the overlay of
+    # the preferred ones
+    #
+    def compare_with_incumbent(self, workspace, base_pixel_data, out_pixel_data):
+        incumbent_path = self.get_incumbent_path(workspace.measurements)
+
+        incumbent_pixel_data = None
+        if os.path.exists(incumbent_path):
+            incumbent_pixel_data = numpy.load(incumbent_path)
+
+            if incumbent_pixel_data.shape != out_pixel_data.shape:
+                incumbent_pixel_data = None
+
+        if incumbent_pixel_data is None:
+            preference = PREFERENCE_CURRENT
+        else:
+            preference = workspace.interaction_request(self, base_pixel_data, out_pixel_data, incumbent_pixel_data)
+
+        if float(preference) == PREFERENCE_CURRENT:
+            if not os.path.isdir(os.path.dirname(incumbent_path)):
+                os.makedirs(os.path.dirname(incumbent_path))
+
+            numpy.save(incumbent_path, out_pixel_data)
+
+        return preference
+
+    #
+    # helper method;
+    # Return the path of the numpy file holding the overlay of the best outlines so far
+    #
+    def get_incumbent_path(self, measurements=None):
+        directory = self.incumbent_directory.get_absolute_path(measurements)
+
+        return os.path.join(directory, "incumbent_overlay_{}.npy".format(self.module_num))
+
+    #
+    # helper method;
+    # Delete the overlay of the best outlines so far; the next comparison starts over with the current outlines
+    #
+    def delete_incumbent(self):
+        incumbent_path = self.get_incumbent_path()
+
+        with lock_incumbent(incumbent_path):
+            if os.path.exists(incumbent_path):
+                os.remove(incumbent_path)
+
+        print("Best outlines so far deleted")
+
     #
     # handle_interaction is called during the run of the pipeline when an interaction request was made;
-    # control is passed to UI thread and user sees UI window created in the interaction method
+    # control is passed to UI thread and user sees UI window created in the interaction method.
+    # In the A/B evaluation mode, the overlay of the best outlines so far is passed as well
     #
-    def handle_interaction(self, base_pixel_data, out_pixel_data):
+    def handle_interaction(self, base_pixel_data, out_pixel_data, incumbent_pixel_data=None):
+        if incumbent_pixel_data is not None:
+            return self.handle_comparison(base_pixel_data, out_pixel_data, incumbent_pixel_data)
+
         #
         # import UI modules (WX and Matplotlib) to show a pop up window for user interaction
         #
@@ -430,9 +650,10 @@ image can be selected in later modules (for instance, **SaveImages**).
 
         with wx.Dialog(None, title="Rate object detection quality", size=(800, 600)) as dlg:
             #
-            # default quality value to be returned when no button was pressed and window was closed
+            # default quality value to be returned when no button was pressed and window was closed; the answer is
+            # kept in a dict the button handler can change, not in the module, which all image sets share
             #
-            self.quality = 0
+            answer = {"quality": 0}
 
             #
             # A wx.Sizer automatically adjusts the size of a window's sub-windows
@@ -520,7 +741,7 @@ image can be selected in later modules (for instance, **SaveImages**).
             #
             def on_button(event):
                 b = event.GetEventObject().GetLabel()
-                self.quality = b
+                answer["quality"] = b
                 dlg.EndModal(1)
                 plt.close(figure)
 
@@ -544,7 +765,76 @@ image can be selected in later modules (for instance, **SaveImages**).
             #
             # Return the quality measure set by button press (or window close; default = 0)
             #
-            return self.quality
+            return answer["quality"]
+
+    #
+    # Show the current outlines next to the best outlines so far and return the preference of the user;
+    # the window is structured like the rating window, with one axes per overlay and one button per answer
+    #
+    def handle_comparison(self, base_pixel_data, out_pixel_data, incumbent_pixel_data):
+        import wx
+        import matplotlib.pyplot as plt
+        import matplotlib.backends.backend_wxagg
+        from matplotlib.backends.backend_wxagg import NavigationToolbar2WxAgg as NavigationToolbar
+
+        with wx.Dialog(None, title="Compare object detection quality", size=(1200, 600)) as dlg:
+            #
+            # no preference when no button was pressed and window was closed; the optimisation skips the round
+            #
+            answer = {"preference": numpy.nan}
+
+            dlg.Sizer = wx.BoxSizer(wx.VERTICAL)
+
+            #
+            # show the current and the best overlay side by side; zooming into one zooms into the other
+            #
+            figure = plt.figure()
+
+            current_axes = figure.add_subplot(1, 2, 1)
+            best_axes = figure.add_subplot(1, 2, 2, sharex=current_axes, sharey=current_axes)
+
+            for axes, pixel_data, title in ((current_axes, out_pixel_data, "Current settings"),
+                                            (best_axes, incumbent_pixel_data, "Best so far")):
+                axes.imshow(base_pixel_data, 'gray', interpolation='none')
+                axes.imshow(pixel_data, 'gray', interpolation='none', alpha=0.5)
+                axes.set_title(title)
+
+            canvas = matplotlib.backends.backend_wxagg.FigureCanvasWxAgg(dlg, -1, figure)
+
+            toolbar = NavigationToolbar(canvas)
+            toolbar.Realize()
+
+            dlg.Sizer.Add(toolbar, 0, wx.LEFT | wx.EXPAND)
+            dlg.Sizer.Add(canvas, 1, wx.EXPAND)
+
+            hsizer = wx.BoxSizer(wx.HORIZONTAL)
+            dlg.Sizer.Add(hsizer, 2, wx.ALIGN_CENTER)
+
+            info_label = wx.StaticText(dlg, label="Which object detection is better? ")
+            hsizer.Add(info_label, 0, wx.ALIGN_CENTER)
+
+            #
+            # one button per answer; the preference of each button is looked up when it is pressed
+            #
+            preferences = {}
+            for label, preference in (("Current settings", PREFERENCE_CURRENT),
+                                      ("About the same", PREFERENCE_EQUAL),
+                                      ("Best so far", PREFERENCE_BEST)):
+                button = wx.Button(dlg, label=label)
+                hsizer.Add(button, 0, wx.ALIGN_CENTER)
+                preferences[button.GetId()] = preference
+
+                def on_button(event):
+                    answer["preference"] = preferences[event.GetEventObject().GetId()]
+                    dlg.EndModal(1)
+                    plt.close(figure)
+
+                button.Bind(wx.EVT_BUTTON, on_button)
+
+            dlg.Layout()
+            dlg.ShowModal()
+
+            return answer["preference"]
 
     #
     # Gets the image pixels from the image in the workspace
@@ -644,6 +934,9 @@ image can be selected in later modules (for instance, **SaveImages**).
 
         input_object_name = self.outlines[0].objects_name.value
 
+        if self.evaluation_mode.value == MODE_COMPARISON:
+            return [input_object_name, PREFERENCE_FEATURE_NAME, cellprofiler.measurement.COLTYPE_FLOAT]
+
         return [input_object_name, FEATURE_NAME, cellprofiler.measurement.COLTYPE_FLOAT]
 
     #
@@ -660,6 +953,9 @@ image can be selected in later modules (for instance, **SaveImages**).
     #
     def get_measurements(self, pipeline, object_name, category):
         if object_name == self.outlines[0].objects_name and category == CATEGORY:
+            if self.evaluation_mode.value == MODE_COMPARISON:
+                return [PREFERENCE]
+
             return [QUALITY]
 
         return []
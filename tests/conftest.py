@@ -0,0 +1,9 @@
+# coding=utf-8
+
+#
+# the modules are CellProfiler plugins in the directory above the tests
+#
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
@@ -0,0 +1,184 @@
+# coding=utf-8
+
+"""
+Tests of the journal keeping the optimisation history of the BayesianOptimisation module.
+"""
+
+import json
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("cellprofiler.module")
+
+import bayesian_module
+
+SIGNATURE = [["IdentifyPrimaryObjects #1", "Threshold correction factor"],
+             ["IdentifyPrimaryObjects #1", "Size of adaptive window"]]
+
+
+def get_history(tmpdir):
+    return bayesian_module.OptimisationHistory(str(tmpdir), 3, SIGNATURE)
+
+
+def test_append_and_load(tmpdir):
+    history = get_history(tmpdir)
+    history.append([1.0, 50], 0.5, 2.0)
+    history.append([1.2, 60], 0.25, 3.0, valid=False)
+
+    x, y, t, valid = get_history(tmpdir).load()
+
+    np.testing.assert_array_equal(x, [[1.0, 50], [1.2, 60]])
+    np.testing.assert_array_equal(y, [0.5, 0.25])
+    np.testing.assert_array_equal(t, [2.0, 3.0])
+    np.testing.assert_array_equal(valid, [True, False])
+
+
+def test_torn_last_line_is_dropped(tmpdir):
+    history = get_history(tmpdir)
+    history.append([1.0, 50], 0.5)
+    history.append([1.2, 60], 0.25)
+
+    #
+    # a crash in the middle of a write leaves the last record cut off
+    #
+    with open(history.path, "a") as journal:
+        journal.write('{"x": [1.4, 70], "y": 0.')
+
+    history = get_history(tmpdir)
+    x, y, _, _ = history.load()
+
+    np.testing.assert_array_equal(x, [[1.0, 50], [1.2, 60]])
+    np.testing.assert_array_equal(y, [0.5, 0.25])
+
+    with open(history.path) as journal:
+        text = journal.read()
+
+    assert text.endswith("\n")
+    assert len(text.splitlines()) == 2
+
+    #
+    # the next round is appended to the recovered journal
+    #
+    history.append([1.4, 70], 0.125)
+
+    np.testing.assert_array_equal(get_history(tmpdir).load()[1], [0.5, 0.25, 0.125])
+
+
+def test_damaged_line_in_the_middle_is_dropped(tmpdir):
+    history = get_history(tmpdir)
+    history.append([1.0, 50], 0.5)
+
+    with open(history.path, "a") as journal:
+        journal.write("not a record\n")
+
+    history.append([1.2, 60], 0.25)
+
+    np.testing.assert_array_equal(get_history(tmpdir).load()[1], [0.5, 0.25])
+
+
+def test_legacy_text_files_are_migrated(tmpdir):
+    history = get_history(tmpdir)
+
+    #
+    # x has one row more than y: the round was never evaluated completely
+    #
+    with open(history.x_path, "w") as x_file:
+        x_file.write("1.0 50 \n1.2 60 \n1.4 70 \n")
+    with open(history.y_path, "w") as y_file:
+        y_file.write("0.5\n0.25\n")
+    with open(history.t_path, "w") as t_file:
+        t_file.write("3.0\n")
+    with open(history.s_path, "w") as s_file:
+        json.dump(SIGNATURE, s_file)
+
+    x, y, t, valid = history.load()
+
+    np.testing.assert_array_equal(x, [[1.0, 50], [1.2, 60]])
+    np.testing.assert_array_equal(y, [0.5, 0.25])
+    np.testing.assert_array_equal(t, [np.nan, 3.0])
+    np.testing.assert_array_equal(valid, [True, True])
+    assert history.has_identities()
+
+    assert os.path.exists(history.path)
+    for path in (history.x_path, history.y_path, history.t_path, history.s_path):
+        assert not os.path.exists(path)
+
+
+def test_legacy_relevance_is_moved_to_the_last_rounds(tmpdir):
+    history = get_history(tmpdir)
+    history.append([1.0, 50], 0.5)
+    history.append([1.2, 60], 0.25)
+
+    with open(history.r_path, "w") as r_file:
+        r_file.write("0.75 0.25 \n")
+
+    relevance = get_history(tmpdir).load_relevance()
+
+    np.testing.assert_array_equal(relevance, [[0.75, 0.25]])
+    assert not os.path.exists(history.r_path)
+
+
+def test_pending_proposal_is_resumed(tmpdir):
+    history = get_history(tmpdir)
+    history.append([1.0, 50], 0.5)
+    history.stage([1.2, 60], 0.25)
+    history.commit([1.4, 70])
+
+    history = get_history(tmpdir)
+
+    #
+    # the settings are still the ones of the last round: the proposal after it was never evaluated
+    #
+    np.testing.assert_array_equal(history.load_pending_proposal([1.2, 60]), [[1.4, 70]])
+
+    #
+    # the proposal was applied, or the round belongs to another task
+    #
+    assert history.load_pending_proposal([1.4, 70]) is None
+    assert history.load_pending_proposal([1.2, 60], "B") is None
+
+
+def test_staged_round_is_loaded_but_not_written(tmpdir):
+    history = get_history(tmpdir)
+    history.append([1.0, 50], 0.5)
+    history.stage([1.2, 60], 0.25)
+
+    np.testing.assert_array_equal(history.load()[1], [0.5, 0.25])
+    np.testing.assert_array_equal(get_history(tmpdir).load()[1], [0.5])
+
+    history.commit()
+
+    np.testing.assert_array_equal(get_history(tmpdir).load()[1], [0.5, 0.25])
+
+
+def test_journal_is_read_once_per_round(tmpdir, monkeypatch):
+    get_history(tmpdir).append([1.0, 50], 0.5)
+
+    history = get_history(tmpdir)
+
+    reads = []
+    recover = history.recover
+    monkeypatch.setattr(history, "recover", lambda: reads.append(1) or recover())
+
+    history.load_pending_proposal([1.0, 50])
+    history.stage([1.2, 60], 0.25)
+    history.load()
+    history.load_components()
+    history.load_preferences()
+    history.load_tasks()
+    history.load_relevance()
+    history.has_identities()
+    history.commit([1.4, 70])
+    history.load()
+
+    assert len(reads) == 1
+
+    #
+    # a round appended by another history is read again
+    #
+    get_history(tmpdir).append([1.4, 70], 0.125)
+
+    np.testing.assert_array_equal(history.load()[1], [0.5, 0.25, 0.125])
+    assert len(reads) == 2